@@ -0,0 +1,100 @@
+import gc
+import os
+import sys
+import time
+import argparse
+import logging
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from mock_server import Organization
+from modules import meraki_api
+from modules.crawl_planner import CrawlPlanner
+
+# Organization sizes, in networks, measured by default
+SIZES = [250, 500, 1000, 2000, 4000]
+
+class OfflineFetcher:
+    """Fetcher answering from a synthetic organization, so only the join itself is timed."""
+
+    def __init__(self, organization):
+        self.organization = organization
+        self.data_dir = None
+
+    def get_networks(self):
+        return self.organization.networks
+
+    def get_organization_devices(self):
+        return self.organization.devices
+
+    def get_configuration_changes(self, t0):
+        return []
+
+    def get_ssids(self, network_id):
+        return self.organization.ssids
+
+    def get_organization_ssid_statuses(self):
+        """Statuses of the access points of every other wireless network; the rest fall back to per-network calls."""
+        return [
+            {
+                'serial': device['serial'],
+                'network': {'id': device['networkId']},
+                'basicServiceSets': [{'ssid': ssid} for ssid in self.organization.ssids]
+            }
+            for device in self.organization.devices
+            if device['model'].startswith('MR') and int(device['networkId'][2:]) % 4 == 0
+        ]
+
+    def add_locations(self, devices):
+        return devices
+
+def time_organization_details(networks, devices_per_network, ssids_per_network, bulk_ssids, repeats):
+    """Return the best time, in seconds, to build the organization details of a synthetic organization."""
+    organization = Organization(networks, devices_per_network, ssids_per_network)
+    best = float('inf')
+    for _ in range(repeats):
+        planner = CrawlPlanner(OfflineFetcher(organization), bulk_ssids=bulk_ssids)
+        gc.collect()
+        gc.disable()  # As timeit does, so collections of the growing heap do not blur the trend
+        try:
+            started = time.perf_counter()
+            meraki_api.get_organization_details(planner)
+            best = min(best, time.perf_counter() - started)
+        finally:
+            gc.enable()
+    return best
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Check that building the organization details scales linearly with the organization size")
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help="Networks per organization, smallest first")
+    parser.add_argument('--devices-per-network', type=int, default=10)
+    parser.add_argument('--ssids-per-network', type=int, default=3)
+    parser.add_argument('--repeats', type=int, default=3, help="Runs per size; the best one is kept")
+    parser.add_argument('--tolerance', type=float, default=2.0, help="Largest allowed growth of the time per network between the smallest and largest size")
+    return parser.parse_args(args)
+
+def main(args=None):
+    args = parse_args(args)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    failures = 0
+    for bulk_ssids in (False, True):
+        print(f"\nOrganization details, {'bulk' if bulk_ssids else 'per-network'} SSIDs")
+        print(f"{'networks':>10}{'devices':>10}{'time (s)':>10}{'us/network':>12}")
+        per_network = []
+        for networks in args.sizes:
+            elapsed = time_organization_details(networks, args.devices_per_network, args.ssids_per_network, bulk_ssids, args.repeats)
+            per_network.append(elapsed / networks)
+            print(f"{networks:>10}{networks * args.devices_per_network:>10}{elapsed:>10.3f}{per_network[-1] * 1e6:>12.1f}")
+        growth = per_network[-1] / per_network[0]
+        if growth > args.tolerance:
+            failures += 1
+            print(f"FAIL: the time per network grew {growth:.1f}x from {args.sizes[0]} to {args.sizes[-1]} networks")
+        else:
+            print(f"OK: the time per network grew {growth:.1f}x from {args.sizes[0]} to {args.sizes[-1]} networks")
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
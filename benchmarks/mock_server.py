@@ -0,0 +1,305 @@
+import time
+import random
+import hashlib
+import asyncio
+import argparse
+import logging
+from aiohttp import web
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+class Organization:
+    """Synthetic Meraki organization: networks, devices per network and SSIDs."""
+
+    def __init__(self, networks, devices_per_network, ssids_per_network, seed=0, org_id='bench', first_network=0):
+        rng = random.Random(seed + first_network)
+        self.id = org_id
+        self.networks = []
+        self.devices = []
+        for i in range(first_network, first_network + networks):
+            network_id = f"N_{i}"
+            wireless = i % 2 == 0
+            self.networks.append({
+                'id': network_id,
+                'organizationId': org_id,
+                'name': f"Network {i}",
+                'productTypes': ['appliance', 'wireless'] if wireless else ['appliance', 'switch'],
+                'timeZone': 'Europe/Paris',
+                'tags': []
+            })
+            lat, lng = rng.uniform(43.0, 50.0), rng.uniform(-1.0, 7.0)
+            for j in range(devices_per_network):
+                model = 'MR46' if wireless and j % 2 == 0 else 'MS225-24P'
+                self.devices.append({
+                    'serial': f"Q2XX-{i:04d}-{j:04d}",
+                    'networkId': network_id,
+                    'name': f"Device {i}-{j}",
+                    'model': model,
+                    'mac': f"e0:55:3d:{i // 256 % 256:02x}:{i % 256:02x}:{j % 256:02x}",
+                    'lat': lat,
+                    'lng': lng,
+                    'address': f"{i} Benchmark Street",
+                    'productType': 'wireless' if model.startswith('MR') else 'switch'
+                })
+        self.ssids = [
+            {'number': k, 'name': f"SSID {k}", 'enabled': k == 0, 'authMode': 'open'}
+            for k in range(ssids_per_network)
+        ]
+        self.devices_by_network = {}
+        for device in self.devices:
+            self.devices_by_network.setdefault(device['networkId'], []).append(device)
+
+class MockServer:
+    """Local stand-in for the Meraki, CloudiFi and Nominatim APIs.
+
+    Meraki listings are paginated with Link headers and rate limited per
+    organization with X-Rate-Limit-* headers and 429 Retry-After answers.
+    Latency and 5xx errors can be injected on every endpoint. With etags,
+    Meraki responses carry an ETag and answer If-None-Match with 304.
+    CloudiFi calls need an access token from /auth/form, which expires after
+    token_ttl seconds and is then answered with 401.
+    """
+
+    def __init__(self, organizations, rate_limit=10, latency=0.0, error_rate=0.0, seed=0, etags=False, token_ttl=3600):
+        self.organizations = {organization.id: organization for organization in organizations}
+        self.network_orgs = {network['id']: organization for organization in organizations for network in organization.networks}
+        self.rate_limit = rate_limit
+        self.latency = latency
+        self.error_rate = error_rate
+        self.etags = etags
+        self.token_ttl = token_ttl
+        self.tokens = {}  # Expiry of every access token issued
+        self.random = random.Random(seed)
+        self.buckets = {}  # [tokens, updated_at] per organization
+        self.locations = {}
+        self.stats = {}
+
+    def create_app(self):
+        app = web.Application(middlewares=[self.middleware])
+        app.router.add_get('/api/v1/organizations', self.get_organizations)
+        app.router.add_get('/api/v1/organizations/{org_id}/networks', self.get_networks)
+        app.router.add_get('/api/v1/organizations/{org_id}/devices', self.get_organization_devices)
+        app.router.add_get('/api/v1/organizations/{org_id}/configurationChanges', self.get_configuration_changes)
+        app.router.add_get('/api/v1/organizations/{org_id}/wireless/ssids/statuses/byDevice', self.get_ssid_statuses)
+        app.router.add_get('/api/v1/networks/{network_id}/devices', self.get_network_devices)
+        app.router.add_get('/api/v1/networks/{network_id}/wireless/ssids', self.get_ssids)
+        app.router.add_get('/reverse', self.reverse)
+        app.router.add_post('/auth/form', self.authenticate)
+        for kind in ('langs', 'countries', 'timezones'):
+            app.router.add_get(f"/{kind}", self.reference_handler(kind))
+        app.router.add_get('/locations', self.list_locations)
+        app.router.add_post('/locations', self.create_location)
+        app.router.add_patch('/locations/{location_id}', self.update_location)
+        app.router.add_delete('/locations/{location_id}', self.delete_location)
+        app.router.add_get('/_stats', self.get_stats)
+        app.router.add_post('/_reset', self.reset_stats)
+        return app
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        if request.path.startswith('/_'):
+            return await handler(request)
+        api = self.api_name(request.path)
+        stats = self.stats.setdefault(api, {'requests': 0, 'rate_limited': 0, 'errors': 0})
+        stats['requests'] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if api == 'meraki':
+            bucket = self.buckets.setdefault(self.bucket_name(request), [self.rate_limit, time.monotonic()])
+            retry_after = self.take_token(bucket)
+            if retry_after:
+                stats['rate_limited'] += 1
+                return web.Response(status=429, headers={'Retry-After': str(retry_after)})
+        if api == 'cloudifi' and request.path != '/auth/form':
+            token = request.headers.get('Authorization', '').removeprefix('Bearer ')
+            if self.tokens.get(token, 0) < time.time():
+                stats['unauthorized'] = stats.get('unauthorized', 0) + 1
+                return web.Response(status=401)
+        if self.error_rate and self.random.random() < self.error_rate:
+            stats['errors'] += 1
+            return web.Response(status=self.random.choice([500, 502, 503]))
+        response = await handler(request)
+        if api == 'meraki':
+            response.headers['X-Rate-Limit-Limit'] = str(int(self.rate_limit))
+            response.headers['X-Rate-Limit-Remaining'] = str(int(bucket[0]))
+            response.headers['X-Rate-Limit-Reset'] = str(int(time.time()) + 1)
+            if self.etags and response.status == 200 and request.method == 'GET':
+                etag = f'"{hashlib.sha1(response.body).hexdigest()}"'
+                if request.headers.get('If-None-Match') == etag:
+                    stats['not_modified'] = stats.get('not_modified', 0) + 1
+                    return web.Response(status=304, headers={'ETag': etag})
+                response.headers['ETag'] = etag
+        return response
+
+    @staticmethod
+    def api_name(path):
+        if path.startswith('/api/v1/'):
+            return 'meraki'
+        if path == '/reverse':
+            return 'nominatim'
+        return 'cloudifi'
+
+    def bucket_name(self, request):
+        """Return the organization whose rate limit a Meraki request counts against."""
+        parts = request.path.split('/')
+        if len(parts) > 4 and parts[3] == 'organizations':
+            return parts[4]
+        if len(parts) > 4 and parts[3] == 'networks' and parts[4] in self.network_orgs:
+            return self.network_orgs[parts[4]].id
+        return None  # Calls outside any organization share one budget
+
+    def take_token(self, bucket):
+        """Consume a token of a [tokens, updated_at] bucket; return the Retry-After seconds when none is left."""
+        now = time.monotonic()
+        bucket[0] = min(self.rate_limit, bucket[0] + (now - bucket[1]) * self.rate_limit)
+        bucket[1] = now
+        if bucket[0] < 1:
+            return 1
+        bucket[0] -= 1
+        return 0
+
+    def get_organization(self, request):
+        organization = self.organizations.get(request.match_info['org_id'])
+        if organization is None:
+            raise web.HTTPNotFound()
+        return organization
+
+    def paginate(self, request, items, items_key=None):
+        """Return a page of items with a Link header to the next page, wrapped in items_key if given."""
+        per_page = int(request.query.get('perPage', 1000))
+        start = int(request.query.get('startingAfter', 0))
+        page = items[start:start + per_page]
+        response = web.json_response({items_key: page} if items_key else page)
+        if start + per_page < len(items):
+            next_url = request.url.update_query({'startingAfter': start + per_page})
+            response.headers['Link'] = f'<{next_url}>; rel=next'
+        return response
+
+    async def get_organizations(self, request):
+        return self.paginate(request, [{'id': org_id, 'name': f"Organization {org_id}"} for org_id in self.organizations])
+
+    async def get_networks(self, request):
+        return self.paginate(request, self.get_organization(request).networks)
+
+    async def get_organization_devices(self, request):
+        return self.paginate(request, self.get_organization(request).devices)
+
+    async def get_ssid_statuses(self, request):
+        organization = self.get_organization(request)
+        access_points = [device for device in organization.devices if device['model'].startswith('MR')]
+        statuses = [
+            {
+                'serial': device['serial'],
+                'name': device['name'],
+                'network': {'id': device['networkId']},
+                'basicServiceSets': [{'ssid': {'number': ssid['number'], 'name': ssid['name'], 'enabled': ssid['enabled']}} for ssid in organization.ssids]
+            }
+            for device in access_points
+        ]
+        return self.paginate(request, statuses, 'items')
+
+    async def get_configuration_changes(self, request):
+        return web.json_response([])
+
+    async def get_network_devices(self, request):
+        network_id = request.match_info['network_id']
+        organization = self.network_orgs.get(network_id)
+        return web.json_response(organization.devices_by_network.get(network_id, []) if organization else [])
+
+    async def get_ssids(self, request):
+        organization = self.network_orgs.get(request.match_info['network_id'])
+        return web.json_response(organization.ssids if organization else [])
+
+    async def reverse(self, request):
+        lat, lng = request.query.get('lat'), request.query.get('lon')
+        return web.json_response({
+            'lat': lat,
+            'lon': lng,
+            'display_name': f"{lat}, {lng}",
+            'address': {'city': 'Paris', 'state': 'Ile-de-France', 'postcode': '75001', 'country': 'France'}
+        })
+
+    async def authenticate(self, request):
+        if not (await request.json()).get('refresh_token'):
+            return web.Response(status=401)
+        token = f"bench-{len(self.tokens) + 1}"
+        self.tokens[token] = time.time() + self.token_ttl
+        return web.json_response({'token': token, 'expires_in': self.token_ttl})
+
+    def reference_handler(self, kind):
+        members = {
+            'langs': [{'id': 1, 'name': 'English'}, {'id': 2, 'name': 'French'}],
+            'countries': [{'id': 1, 'name': 'France'}, {'id': 2, 'name': 'Germany'}],
+            'timezones': [{'id': 1, 'name': 'Europe/Paris'}, {'id': 2, 'name': 'UTC'}]
+        }[kind]
+
+        async def handler(request):
+            if request.headers.get('If-None-Match') == '"bench"':
+                return web.Response(status=304)
+            return web.json_response({'hydra:member': members}, headers={'ETag': '"bench"'})
+        return handler
+
+    async def list_locations(self, request):
+        page = int(request.query.get('page', 1))
+        per_page = 100
+        locations = list(self.locations.values())
+        body = {'hydra:member': locations[(page - 1) * per_page:page * per_page]}
+        if page * per_page < len(locations):
+            body['hydra:view'] = {'hydra:next': f"/locations?page={page + 1}"}
+        return web.json_response(body)
+
+    async def create_location(self, request):
+        location = await request.json()
+        location['id'] = max(self.locations, default=0) + 1
+        self.locations[location['id']] = location
+        return web.json_response(location, status=201)
+
+    async def update_location(self, request):
+        location = self.locations.get(int(request.match_info['location_id']))
+        if location is None:
+            return web.Response(status=404)
+        location.update(await request.json())
+        return web.json_response(location)
+
+    async def delete_location(self, request):
+        if self.locations.pop(int(request.match_info['location_id']), None) is None:
+            return web.Response(status=404)
+        return web.Response(status=204)
+
+    async def get_stats(self, request):
+        return web.json_response(self.stats)
+
+    async def reset_stats(self, request):
+        self.stats = {}
+        return web.json_response({})
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Serve a synthetic Meraki organization with CloudiFi and Nominatim stubs")
+    parser.add_argument('--port', type=int, default=8999)
+    parser.add_argument('--organizations', type=int, default=1, help="Organizations served, the first one with the id bench")
+    parser.add_argument('--networks', type=int, default=100, help="Networks per organization")
+    parser.add_argument('--devices-per-network', type=int, default=5)
+    parser.add_argument('--ssids-per-network', type=int, default=3)
+    parser.add_argument('--rate-limit', type=float, default=10, help="Meraki requests per second before answering 429")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Share of requests answered with a 5xx error")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--etags', action='store_true', help="Answer Meraki conditional requests with 304 Not Modified")
+    parser.add_argument('--token-ttl', type=float, default=3600, help="Seconds a CloudiFi access token is accepted")
+    return parser.parse_args(args)
+
+def main(args=None):
+    args = parse_args(args)
+    organizations = [
+        Organization(args.networks, args.devices_per_network, args.ssids_per_network, args.seed,
+                     'bench' if k == 0 else f"bench{k}", k * args.networks)
+        for k in range(args.organizations)
+    ]
+    server = MockServer(organizations, args.rate_limit, args.latency, args.error_rate, args.seed, args.etags, args.token_ttl)
+    devices = sum(len(organization.devices) for organization in organizations)
+    logging.info(f"Serving {args.organizations} organizations, {args.networks} networks each and {devices} devices on port {args.port}")
+    web.run_app(server.create_app(), port=args.port, print=None, access_log=None)
+
+if __name__ == "__main__":
+    main()
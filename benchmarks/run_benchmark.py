@@ -0,0 +1,255 @@
+import os
+import sys
+import json
+import time
+import inspect
+import argparse
+import importlib
+import logging
+import tempfile
+import resource
+import subprocess
+import urllib.request
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+# Synthetic organizations; every value can be overridden on the command line
+SCENARIOS = {
+    'small': {'networks': 20, 'devices_per_network': 5, 'ssids_per_network': 2},
+    'medium': {'networks': 200, 'devices_per_network': 10, 'ssids_per_network': 3},
+    'large': {'networks': 2000, 'devices_per_network': 20, 'ssids_per_network': 4},
+    'slow': {'networks': 200, 'devices_per_network': 10, 'ssids_per_network': 3, 'latency': 0.1},
+    'flaky': {'networks': 200, 'devices_per_network': 10, 'ssids_per_network': 3, 'error_rate': 0.05},
+}
+
+# Stages of main.main, as (name, module, owner attribute or None, function name)
+STAGES = [
+    ('prefetch', 'main', None, 'prefetch_meraki_data'),
+    ('organization_details', 'modules.meraki_api', None, 'get_organization_details'),
+    ('extra_data', 'modules.fetch_extra_data', 'MerakiFetcher', 'fetch_extra_data'),
+    ('cloudifi_details', 'modules.cloudifi_api', 'CloudiFi', 'fetch_and_save_details'),
+    ('prepare_locations', 'modules.cloudifi_api', 'CloudiFi', 'prepare_location_details'),
+    ('push_locations', 'modules.cloudifi_api', 'CloudiFi', 'create_locations_from_saved_data'),
+    ('pipeline', 'modules.pipeline', 'Pipeline', 'run'),
+]
+
+def reset_peak_rss():
+    """Reset the peak RSS of the process where the kernel allows it (Linux only)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def peak_rss_mb():
+    """Return the peak RSS of the process in MB."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024 / 1024 if sys.platform == 'darwin' else maxrss / 1024
+
+class StageRecorder:
+    """Time the stages of main.main and count the requests each one sends to the stand-in server."""
+
+    def __init__(self, server_url):
+        self.server_url = server_url
+        self.results = []
+        self.active = None
+
+    def server_stats(self):
+        with urllib.request.urlopen(f"{self.server_url}/_stats") as response:
+            return json.load(response)
+
+    def start(self, name):
+        self.active = name
+        reset_peak_rss()
+        return time.perf_counter(), self.server_stats()
+
+    def stop(self, name, started):
+        wall_time = time.perf_counter() - started[0]
+        after = self.server_stats()
+        requests = {
+            api: stats['requests'] - started[1].get(api, {}).get('requests', 0)
+            for api, stats in after.items()
+        }
+        rate_limited = sum(stats['rate_limited'] - started[1].get(api, {}).get('rate_limited', 0) for api, stats in after.items())
+        errors = sum(stats['errors'] - started[1].get(api, {}).get('errors', 0) for api, stats in after.items())
+        total = sum(requests.values())
+        self.results.append({
+            'stage': name,
+            'requests': total,
+            'requests_by_api': {api: count for api, count in requests.items() if count},
+            'rate_limited': rate_limited,
+            'errors': errors,
+            'wall_time': round(wall_time, 3),
+            'requests_per_second': round(total / wall_time, 1) if wall_time else 0.0,
+            'peak_rss_mb': round(peak_rss_mb(), 1)
+        })
+        self.active = None
+
+    def wrap(self, name, function):
+        """Return function measured as the named stage, unless it runs inside another stage."""
+        if inspect.iscoroutinefunction(function):
+            async def wrapper(*args, **kwargs):
+                if self.active is not None:
+                    return await function(*args, **kwargs)
+                started = self.start(name)
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    self.stop(name, started)
+        else:
+            def wrapper(*args, **kwargs):
+                if self.active is not None:
+                    return function(*args, **kwargs)
+                started = self.start(name)
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.stop(name, started)
+        return wrapper
+
+    def install(self):
+        for name, owner, function_name in stage_owners():
+            setattr(owner, function_name, self.wrap(name, getattr(owner, function_name)))
+
+def stage_owners():
+    """Yield (stage name, module or class, function name) for every measured stage."""
+    for name, module_name, owner_name, function_name in STAGES:
+        owner = importlib.import_module(module_name)
+        if owner_name is not None:
+            owner = getattr(owner, owner_name)
+        yield name, owner, function_name
+
+def start_server(port, scenario):
+    """Start the stand-in server in a subprocess and wait until it answers."""
+    command = [sys.executable, os.path.join(BENCHMARKS_DIR, 'mock_server.py'), '--port', str(port)]
+    for key, value in scenario.items():
+        command += [f"--{key.replace('_', '-')}", str(value)]
+    process = subprocess.Popen(command)
+    deadline = time.time() + 10
+    while True:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/_stats").close()
+            return process
+        except OSError:
+            if time.time() > deadline or process.poll() is not None:
+                process.kill()
+                raise RuntimeError(f"Mock server did not start on port {port}")
+            time.sleep(0.1)
+
+def configure_environment(port):
+    """Point every base URL at the stand-in server before the modules read their configuration."""
+    server_url = f"http://127.0.0.1:{port}"
+    os.environ.update({
+        'MERAKI_BASE_URL': f"{server_url}/api/v1",
+        'MERAKI_ORG_ID': 'bench',
+        'MERAKI_API_KEY': 'bench',
+        'NOMINATIM_DOMAIN': f"127.0.0.1:{port}",
+        'NOMINATIM_SCHEME': 'http',
+        'CLOUDIFI_BASE_URL': server_url,
+        'CLOUDIFI_REFRESH_TOKEN': 'bench',
+        'CLOUDIFI_TEMPLATE_ID': '1',
+        'USER_AGENT': 'external_sce_meraki-benchmark',
+    })
+    return server_url
+
+def run_scenario(name, scenario, port, runs):
+    """Run main.main against a fresh server and working directory; return one report per run."""
+    server = start_server(port, scenario)
+    workdir = tempfile.mkdtemp(prefix=f"bench_{name}_")
+    os.chdir(workdir)
+    # Reopened in the new working directory, so scenarios start cold
+    importlib.import_module('modules.response_cache').response_cache.close()
+    importlib.import_module('modules.inventory').inventory.close()
+    try:
+        sync = sys.modules['main']
+        reports = []
+        for run in range(1, runs + 1):
+            recorder = StageRecorder(f"http://127.0.0.1:{port}")
+            originals = [(owner, function_name, getattr(owner, function_name)) for _, owner, function_name in stage_owners()]
+            recorder.install()
+            try:
+                started = time.perf_counter()
+                total_started = recorder.server_stats()
+                sync.main()
+                wall_time = time.perf_counter() - started
+                total_requests = sum(
+                    stats['requests'] - total_started.get(api, {}).get('requests', 0)
+                    for api, stats in recorder.server_stats().items()
+                )
+            finally:
+                for owner, function_name, function in originals:
+                    setattr(owner, function_name, function)
+            reports.append({
+                'scenario': name,
+                'run': run,
+                'parameters': scenario,
+                'stages': recorder.results,
+                'requests': total_requests,
+                'wall_time': round(wall_time, 3),
+                'requests_per_second': round(total_requests / wall_time, 1) if wall_time else 0.0
+            })
+        return reports
+    finally:
+        os.chdir(REPO_DIR)
+        server.terminate()
+        server.wait()
+
+def print_report(report):
+    print(f"\nScenario {report['scenario']} run {report['run']}: {report['parameters']}")
+    print(f"{'stage':<22}{'requests':>10}{'429':>6}{'5xx':>6}{'wall (s)':>10}{'req/s':>9}{'peak RSS (MB)':>15}")
+    for stage in report['stages']:
+        print(
+            f"{stage['stage']:<22}{stage['requests']:>10}{stage['rate_limited']:>6}{stage['errors']:>6}"
+            f"{stage['wall_time']:>10.2f}{stage['requests_per_second']:>9.1f}{stage['peak_rss_mb']:>15.1f}"
+        )
+    print(f"{'total':<22}{report['requests']:>10}{'':>12}{report['wall_time']:>10.2f}{report['requests_per_second']:>9.1f}")
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark main.main against a local Meraki/CloudiFi/Nominatim stand-in")
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS), help="Scenario to run, may be repeated (default: small)")
+    parser.add_argument('--runs', type=int, default=1, help="Consecutive runs per scenario; later runs measure incremental syncs")
+    parser.add_argument('--port', type=int, default=8999)
+    parser.add_argument('--networks', type=int)
+    parser.add_argument('--devices-per-network', type=int)
+    parser.add_argument('--ssids-per-network', type=int)
+    parser.add_argument('--rate-limit', type=float)
+    parser.add_argument('--latency', type=float)
+    parser.add_argument('--error-rate', type=float)
+    parser.add_argument('--output', help="Write the reports to this JSON file")
+    parser.add_argument('--verbose', action='store_true', help="Keep the INFO logs of the sync")
+    return parser.parse_args(args)
+
+def main(args=None):
+    args = parse_args(args)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    overrides = {
+        key: value for key, value in vars(args).items()
+        if key in ('networks', 'devices_per_network', 'ssids_per_network', 'rate_limit', 'latency', 'error_rate') and value is not None
+    }
+    configure_environment(args.port)
+    sys.path.insert(0, REPO_DIR)
+    importlib.import_module('main')  # Imported once the environment points at the stand-in
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    reports = []
+    for name in args.scenario or ['small']:
+        for report in run_scenario(name, {**SCENARIOS[name], **overrides}, args.port, args.runs):
+            print_report(report)
+            reports.append(report)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(reports, f, indent=4)
+        print(f"\nReports written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -2,86 +2,267 @@ import os
 import sys
 import logging
 import time
-import requests
 import asyncio
-import json
+import argparse
+import subprocess
 
 # Add the modules path to sys.path
 sys.path.append(os.path.join(os.path.dirname(__file__), 'modules'))
 
-from modules import common, meraki_api, cloudifi_api
-from modules.fetch_extra_data import MerakiFetcher
-from modules.cloudifi_api import CloudiFi
+# The HTTP clients (requests, aiohttp) and the geocoder (geopy) are imported by
+# the phases that use them, so a phase only pays for its own dependencies
+from modules import common
+from modules.config import STREAM_OUTPUT, EXPORT_JSON, PIPELINE_MODE, MAX_RUN_ATTEMPTS, MERAKI_ORG_ID, MERAKI_ORG_IDS, MERAKI_DATA_DIR
+from modules.metrics import metrics
+from modules.inventory import inventory
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+BENCHMARK_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks', 'run_benchmark.py')
 
-def main():
-    logging.info("Starting main function")
-    common.create_directories()
-    last_fetch_time = common.load_last_fetch_time()
+async def prefetch_meraki_data(planner):
+    from modules.meraki_async import AsyncMerakiClient
+    async with AsyncMerakiClient(journal=planner.fetcher.journal) as client:
+        await planner.prefetch(client)
+
+def crawl(fetcher):
+    """Prefetch and save the Meraki data of the fetcher's organization, retrying once. Return True when it succeeded."""
+    from modules import meraki_api
+    loop = asyncio.get_event_loop()
 
+    # Prefetch Meraki resources concurrently within the organization rate limit
+    logging.info("Prefetching Meraki resources")
     try:
-        # Fetch organization details
+        loop.run_until_complete(prefetch_meraki_data(fetcher.planner))
+        logging.info("Meraki resources prefetched successfully")
+    except Exception as e:
+        logging.warning(f"Concurrent prefetch failed, falling back to sequential fetching: {e}")
+
+    # Fetch organization details
+    if EXPORT_JSON:
         logging.info("Fetching organization details")
-        organization_details = meraki_api.get_organization_details()
-        common.save_to_json(organization_details, 'organization_details.json')
+        if STREAM_OUTPUT:
+            common.save_to_ndjson(meraki_api.iter_organization_details(fetcher.planner), 'organization_details.json')
+        else:
+            organization_details = meraki_api.get_organization_details(fetcher.planner)
+            common.save_to_json(organization_details, 'organization_details.json')
         logging.info("Organization details fetched and saved successfully")
 
-        # Fetch updates
-        logging.info("Fetching additionnal details")
-        fetcher = MerakiFetcher()
-        first_run_success = fetcher.fetch_extra_data()
-        if not first_run_success:
-            logging.info("Retrying fetch updates due to an error in the first run")
-            time.sleep(5)  # Wait for a short period before retrying
-            fetcher.fetch_extra_data()
+    # Fetch updates
+    logging.info("Fetching additionnal details")
+    if fetcher.fetch_extra_data():
+        return True
+    logging.info("Retrying fetch updates due to an error in the first run")
+    time.sleep(5)  # Wait for a short period before retrying
+    return fetcher.fetch_extra_data()
+
+def run(geocoder=None, cloudifi=None):
+    """Run the sync once.
+
+    Return None when it succeeded, the delay before a retry after a rate limit
+    or server error, or False when it failed and a retry would not help.
+    geocoder and cloudifi are reused between the runs of the daemon.
+    """
+    import requests
+    from modules.fetch_extra_data import MerakiFetcher
+    from modules.cloudifi_api import CloudiFi
+
+    common.create_directories()
+
+    if MERAKI_ORG_IDS:
+        from modules.multi_org import MultiOrgSync
+        if PIPELINE_MODE:
+            logging.warning("PIPELINE_MODE is not supported with MERAKI_ORG_IDS, running the organizations in phases")
+        try:
+            logging.info("Running the multi-organization sync")
+            if asyncio.get_event_loop().run_until_complete(MultiOrgSync(geocoder=geocoder, cloudifi=cloudifi).run()):
+                logging.info("All organizations synced successfully")
+                return None
+        except Exception as e:
+            logging.error(f"An unexpected error occurred: {e}")
+        return False
+
+    last_fetch_time = common.load_last_fetch_time()
+
+    try:
+        # Every Meraki resource is fetched once and shared through the fetcher's crawl planner
+        fetcher = MerakiFetcher(last_fetch_time, geocoder=geocoder)
+        loop = asyncio.get_event_loop()
+
+        # Devices a fetch phase left without an address
+        fetcher.geocoder.locate_inventory(inventory, fetcher.org_id)
+
+        if PIPELINE_MODE:
+            from modules.pipeline import Pipeline
+            logging.info("Running the Meraki to CloudiFi pipeline")
+            if loop.run_until_complete(Pipeline(fetcher, cloudifi or CloudiFi()).run()):
+                logging.info("Pipeline finished successfully")
+                return None
+            return False
+
+        # fetch_extra_data records the last fetch time once the inventory is saved
+        if not crawl(fetcher):
+            logging.error("Fetching updates failed; nothing pushed and last fetch time not updated")
+            return False
         logging.info("Updates fetched successfully")
-        # Update the last fetch time
-        common.save_last_fetch_time()
-        logging.info("Last fetch time updated successfully")
 
         # Propagate Meraki data to Cloudi-FI
         logging.info("Initializing CloudiFi class")
-        cf = CloudiFi()
+        cf = cloudifi or CloudiFi()
 
         logging.info("Fetching and saving details from CloudiFi")
-        loop = asyncio.get_event_loop()
         loop.run_until_complete(cf.fetch_and_save_details())
         logging.info("Details fetched and saved successfully")
 
-        logging.info("Loading Meraki data from JSON file")
-        with open("results/meraki_data/networks_devices_ssids.json") as f:
-            meraki_data = json.load(f)
-        logging.info("Meraki data loaded successfully")
-
-        logging.info("Preparing location details")
-        cf.prepare_location_details(meraki_data)
+        logging.info("Preparing location details from the inventory")
+        cf.prepare_location_details(inventory.iter_network_records([MERAKI_ORG_ID]))
         logging.info("Location details prepared successfully")
 
-        logging.info("Creating locations in CloudiFi from the saved JSON file")
+        logging.info("Creating locations in CloudiFi from the inventory")
         loop.run_until_complete(cf.create_locations_from_saved_data())
         logging.info("All locations created successfully")
-        
+        return None
+
     except requests.HTTPError as e:
         logging.error(f"HTTP error occurred: {e}")
         if e.response.status_code == 429:
             retry_after = int(e.response.headers.get('Retry-After', 1))
             logging.warning(f"Rate limit hit. Retrying after {retry_after} seconds.")
-            time.sleep(retry_after)
-            main()
+            return retry_after
         elif e.response.status_code in [500, 502, 503, 504]:
             logging.warning("Server error. Retrying...")
-            time.sleep(5)
-            main()
+            return 5
         else:
             logging.error(f"API error details: {e.response.text}")
     except requests.RequestException as e:
         logging.error(f"Request exception occurred: {e}")
     except Exception as e:
         logging.error(f"An unexpected error occurred: {e}")
+    return False
+
+def sync(geocoder=None, cloudifi=None):
+    """Run the sync, retrying after rate limit and server errors. Return True when it succeeded."""
+    # Each attempt resumes the crawl from the checkpoint journal left by the previous one
+    for attempt in range(1, MAX_RUN_ATTEMPTS + 1):
+        retry_after = run(geocoder, cloudifi)
+        if retry_after is None:
+            return True
+        if retry_after is False:
+            return False
+        if attempt < MAX_RUN_ATTEMPTS:
+            time.sleep(retry_after)
+    logging.error(f"Giving up after {MAX_RUN_ATTEMPTS} attempts; the next run resumes from the checkpoint")
+    return False
+
+def organization_ids():
+    """Return the organizations the geocode, prepare and push phases work on, from the inventory for 'all'."""
+    if not MERAKI_ORG_IDS:
+        return [MERAKI_ORG_ID]
+    if [org_id.lower() for org_id in MERAKI_ORG_IDS] == ['all']:
+        return inventory.organization_ids()
+    return list(MERAKI_ORG_IDS)
+
+def fetch():
+    """Crawl Meraki into the inventory, leaving the devices to geocode for the geocode phase."""
+    common.create_directories()
+    if MERAKI_ORG_IDS:
+        from modules.multi_org import MultiOrgSync
+        synced, failed = asyncio.get_event_loop().run_until_complete(MultiOrgSync(geocode=False).fetch())
+        return bool(synced) and not failed
+    from modules.fetch_extra_data import MerakiFetcher
+    return crawl(MerakiFetcher(common.load_last_fetch_time(), geocode=False))
+
+def geocode():
+    """Add the address of the inventory devices that were fetched without one."""
+    from modules.geocoding import GeocodingStage
+    geocoder = GeocodingStage()
+    for org_id in organization_ids():
+        located = geocoder.locate_inventory(inventory, org_id)
+        logging.info(f"Geocoded {located} devices of organization {org_id}")
+        if located and EXPORT_JSON:
+            inventory.export_json(org_id, common.org_data_dir(org_id) if MERAKI_ORG_IDS else MERAKI_DATA_DIR)
+    return True
+
+def prepare():
+    """Map the inventory networks to CloudiFi locations, with the reference data of the last push."""
+    from modules.cloudifi_api import CloudiFi
+    cf = CloudiFi()
+    if not cf.load_details():
+        logging.info("No CloudiFi details saved yet, fetching them")
+        asyncio.get_event_loop().run_until_complete(cf.fetch_and_save_details())
+    cf.prepare_location_details(inventory.iter_network_records(organization_ids()))
+    return True
+
+def push():
+    """Push the prepared locations to CloudiFi."""
+    from modules.cloudifi_api import CloudiFi
+    asyncio.get_event_loop().run_until_complete(CloudiFi().create_locations_from_saved_data())
+    return True
+
+def run_phase(phase):
+    """Run a phase with fresh metrics, closing the HTTP session it may have opened. Return True when it succeeded."""
+    metrics.reset()
+    try:
+        return phase()
+    finally:
+        if 'modules.http_client' in sys.modules:  # Only the phases that sent requests loaded it
+            from modules.http_client import close_async_session
+            asyncio.get_event_loop().run_until_complete(close_async_session())
+        metrics.log_summary()
+        metrics.export()
+
+def main():
+    logging.info("Starting main function")
+    return run_phase(sync)
+
+PHASES = {
+    'fetch': fetch,
+    'geocode': geocode,
+    'prepare': prepare,
+    'push': push,
+    'all': sync
+}
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Sync Meraki networks to Cloudi-Fi locations")
+    parser.add_argument('--daemon', action='store_true', help="Keep running the all command every SYNC_INTERVAL seconds")
+    parser.add_argument('--profile', action='store_true', help="Profile each phase and write a report under results/profiles")
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.add_parser('all', help="Run every phase with retries (default)")
+    commands.add_parser('fetch', help="Crawl Meraki into the inventory without geocoding")
+    commands.add_parser('geocode', help="Geocode the inventory devices that have no address yet")
+    commands.add_parser('prepare', help="Map the inventory networks to Cloudi-Fi locations")
+    commands.add_parser('push', help="Push the prepared locations to Cloudi-Fi")
+    # Its arguments, --help included, are those of benchmarks/run_benchmark.py
+    commands.add_parser('bench', add_help=False, help="Run benchmarks/run_benchmark.py against the local stand-in")
+    args, args.arguments = parser.parse_known_args(args)
+    args.command = args.command or 'all'
+    if args.arguments and args.command != 'bench':
+        parser.error(f"unrecognized arguments: {' '.join(args.arguments)}")
+    if args.daemon and args.command != 'all':
+        parser.error("--daemon only applies to the all command")
+    if args.profile and (args.daemon or args.command == 'bench'):
+        parser.error("--profile applies to a single run of a phase or of the all command")
+    return args
 
 if __name__ == "__main__":
+    args = parse_args()
+    if args.command == 'bench':
+        # Run apart, as the benchmark points the configuration at its stand-in before importing it
+        sys.exit(subprocess.call([sys.executable, BENCHMARK_SCRIPT, *args.arguments]))
+    common.configure_logging()
     logging.info("Starting Meraki Dashboard data fetching script")
-    main()
+    if args.profile:
+        from modules.profiling import Profiler
+        profiler = Profiler(args.command).install()
+    if args.daemon:
+        from modules.daemon import SyncDaemon
+        SyncDaemon(sync).run()
+        succeeded = True
+    elif args.command == 'all':
+        succeeded = main()
+    else:
+        succeeded = run_phase(PHASES[args.command])
+    if args.profile:
+        profiler.uninstall()
+        profiler.save()
     logging.info("Script finished executing")
+    sys.exit(0 if succeeded else 1)
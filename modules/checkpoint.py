@@ -0,0 +1,96 @@
+import os
+import json
+import time
+import logging
+from .config import CHECKPOINT_FILE, CHECKPOINT_MAX_AGE
+from .models import encode
+
+class CheckpointJournal:
+    """Append-only journal of crawl progress, used to resume an interrupted crawl.
+
+    Each line records either the start of the run, a fetched page of an
+    organization listing (with the cursor of the next page) or a completed
+    network. The journal is removed once the crawl outputs have been saved.
+    """
+
+    def __init__(self, path=CHECKPOINT_FILE, max_age=CHECKPOINT_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self.started_at = None
+        self.pages = {}
+        self.networks = {}
+        self.file = None
+        self._load()
+
+    def start(self, started_at):
+        """Start a new run, or keep the start time of the run being resumed."""
+        if self.started_at is None:
+            self.started_at = started_at
+            self._append({'type': 'run', 'started_at': started_at})
+        else:
+            logging.info(f"Resuming crawl from checkpoint with {len(self.networks)} completed networks")
+        return self.started_at
+
+    @staticmethod
+    def page_key(url, params=None):
+        return json.dumps([url, params or {}], sort_keys=True)
+
+    def resume_pages(self, key, url):
+        """Return the items already fetched for a listing and the URL to continue from."""
+        items = []
+        for page_items, next_url in self.pages.get(key, []):
+            items.extend(page_items)
+            url = next_url
+        return items, url
+
+    def record_page(self, key, items, next_url):
+        self.pages.setdefault(key, []).append((items, next_url))
+        self._append({'type': 'page', 'key': key, 'items': items, 'next': next_url})
+
+    def get_network(self, network_id):
+        return self.networks.get(network_id)
+
+    def record_network(self, network_id, network_data):
+        self.networks[network_id] = network_data
+        self._append({'type': 'network', 'network_id': network_id, 'data': network_data})
+
+    def complete(self):
+        """Discard the journal once the run has been saved successfully."""
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.started_at = None
+        self.pages = {}
+        self.networks = {}
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _append(self, record):
+        if self.file is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self.file = open(self.path, 'a')
+        self.file.write(json.dumps(record, default=encode) + '\n')
+        self.file.flush()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # Line cut short by a crash
+                if record['type'] == 'run':
+                    self.started_at = record['started_at']
+                elif record['type'] == 'page':
+                    self.pages.setdefault(record['key'], []).append((record['items'], record['next']))
+                elif record['type'] == 'network':
+                    self.networks[record['network_id']] = record['data']
+
+        if self.started_at is None or time.time() - self.started_at > self.max_age:
+            logging.info(f"Discarding stale checkpoint {self.path}")
+            self.complete()
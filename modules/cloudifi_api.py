@@ -1,123 +1,206 @@
 import os
 import json
-import requests
+import time
 import logging
 import asyncio
-import aiohttp
-from aiohttp import ClientSession, ClientResponseError
-from .config import CLOUDIFI_BASE_URL, CLOUDIFI_REFRESH_TOKEN, CLOUDIFI_TEMPLATE_ID, CLOUDIFI_DATA_DIR
+import contextlib
+from urllib.parse import urljoin
+from .config import (CLOUDIFI_BASE_URL, CLOUDIFI_TEMPLATE_ID, CLOUDIFI_DATA_DIR, CLOUDIFI_CONCURRENCY, CLOUDIFI_REFERENCE_TTL,
+                     CLOUDIFI_DRY_RUN, CLOUDIFI_DELETE_REMOVED, STREAM_OUTPUT, EXPORT_JSON, HTTP_MAX_RETRIES)
 from modules import common 
 from .common import create_directories
+from .reference_index import ReferenceIndex
+from .models import Location, parse_network_data
+from .inventory import inventory
+from .push_manifest import PushManifest
+from .cloudifi_auth import tokens
+from .metrics import metrics
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Methods retried after a connection error; a POST may already have been applied
+IDEMPOTENT_METHODS = {'GET', 'PATCH', 'DELETE'}
+
+def retry_after(response, default):
+    """Return the seconds of the Retry-After header of a response, default when it has none in seconds."""
+    try:
+        return float(response.headers['Retry-After'])
+    except (KeyError, ValueError):
+        return default
 
 class CloudiFi:
     def __init__(self):
         self.cf_base_url = CLOUDIFI_BASE_URL
-        self.cf_refresh_token = CLOUDIFI_REFRESH_TOKEN
+        self.tokens = tokens  # Access token shared with every other CloudiFi client of the run
         self.cf_template_id = CLOUDIFI_TEMPLATE_ID
         self.details_file = os.path.join(CLOUDIFI_DATA_DIR, "details.json")
-        # self.cf_refresh_token = self.authenticate()
-
-    # def authenticate(self):
-    #     url = f"{self.cf_base_url}/auth/form"
-    #     headers = {'Content-Type': 'application/json'}
-    #     data = {'refresh_token': self.cf_refresh_token}
-
-    #     try:
-    #         response = requests.post(url, headers=headers, json=data)
-    #         response.raise_for_status()
-    #         token = response.json().get('token')
-    #         logging.info("Authentication successful")
-    #         return token
-    #     except requests.exceptions.RequestException as e:
-    #         logging.error(f"Authentication failed: {e}")
-    #         if response is not None:
-    #             logging.error(f"Request URL: {url}")
-    #             logging.error(f"Request Headers: {headers}")
-    #             logging.error(f"Request Body: {json.dumps(data)}")
-    #             logging.error(f"Response Status Code: {response.status_code}")
-    #             logging.error(f"Response Text: {response.text}")
-    #         raise
+        self.location_details_file = os.path.join(CLOUDIFI_DATA_DIR, "location_details.json")
+        self.location_details_stream_file = common.ndjson_path("location_details.json", CLOUDIFI_DATA_DIR)
+        self.push_report_file = os.path.join(CLOUDIFI_DATA_DIR, "push_report.json")
+        self.push_plan_file = os.path.join(CLOUDIFI_DATA_DIR, "push_plan.json")
+        self.details = None  # Reference data of the last fetch, kept warm between daemon cycles
+        self.reference_index = None
+        self.indexed_members = None
 
     async def fetch_and_save_details(self):
-        async with aiohttp.ClientSession() as session:
-            # self.cf_refresh_token = await self.authenticate(session)
-            details = await self.fetch_details(session)
+        from .http_client import async_session
+        cached = self.load_details()
+        session = async_session()
+        details = await self.fetch_details(session, cached)
+        if details != cached:
             common.create_directories()
-            with open(self.details_file, "w") as f:
-                json.dump(details, f, indent=4)
+            common.write_json_atomic(self.details_file, details, indent=4)
             logging.info(f"Saved details to {self.details_file}")
+        self.details = details
+
+    def load_details(self):
+        if self.details is not None:
+            return self.details
+        try:
+            with open(self.details_file) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
 
-    async def fetch_details(self, session):
+    async def fetch_details(self, session, cached=None):
+        """Fetch langs, countries and timezones concurrently, reusing fresh cached copies."""
+        cached = cached or {}
         urls = {
             "langs": f"{self.cf_base_url}/langs",
             "countries": f"{self.cf_base_url}/countries",
             "timezones": f"{self.cf_base_url}/timezones"
         }
 
-        headers = {
-            'Authorization': f'Bearer {self.cf_refresh_token}'
-        }
+        results = await asyncio.gather(*(
+            self.fetch_reference(session, key, url, cached.get(key)) for key, url in urls.items()
+        ))
+        return dict(zip(urls, results))
 
-        details = {}
-        for key, url in urls.items():
-            async with session.get(url, headers=headers) as response:
-                response.raise_for_status()
-                details[key] = await response.json()
-                logging.info(f"Fetched {key} successfully")
+    async def fetch_reference(self, session, key, url, cached):
+        """Return a reference collection, revalidating the cached copy once its TTL has expired."""
+        if cached and 'fetched_at' in cached:
+            if time.time() - cached['fetched_at'] < CLOUDIFI_REFERENCE_TTL:
+                logging.info(f"Using cached {key}")
+                return cached
+            collection = await self.fetch_collection(session, url, cached)
+            if collection is None:
+                logging.info(f"Cached {key} is still valid")
+                return dict(cached, fetched_at=time.time())
+        else:
+            collection = await self.fetch_collection(session, url)
+        logging.info(f"Fetched {len(collection['hydra:member'])} {key} successfully")
+        return collection
+
+    async def fetch_collection(self, session, url, validators=None):
+        """Fetch every member of a hydra collection, following hydra:next links.
 
-        return details
+        The first request is made conditional on the validators of a previous
+        fetch; None is returned when the server answers 304 Not Modified.
+        """
+        headers = self.get_headers()
+        if validators and validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators and validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+        collection = {'hydra:member': [], 'fetched_at': time.time()}
+        while url:
+            async with self.request(session, 'GET', url, headers=headers) as response:
+                if response.status == 304:
+                    return None
+                response.raise_for_status()
+                if 'etag' not in collection:
+                    collection['etag'] = response.headers.get('ETag')
+                    collection['last_modified'] = response.headers.get('Last-Modified')
+                data = await response.json()
+            collection['hydra:member'].extend(data.get('hydra:member', []))
+            next_page = data.get('hydra:view', {}).get('hydra:next')
+            url = urljoin(url, next_page) if next_page else None  # A path from the server root, which may hold the API prefix
+            headers = self.get_headers()
+        return collection
 
     def prepare_location_details(self, meraki_data):
-        with open(self.details_file) as f:
-            details = json.load(f)
+        """Map Meraki networks to CloudiFi locations and save them in the inventory.
+
+        meraki_data is either the networks_devices_ssids dict or an iterator of
+        (network_id, network_data) pairs, such as the inventory records.
+        """
+        reference_index = self.get_reference_index()
+
+        self.save_location_details(self.iter_location_details(meraki_data, reference_index))
+        reference_index.log_summary()
+
+    def get_reference_index(self):
+        """Return the reference index of the current details, rebuilt only when their members changed."""
+        details = self.load_details()
+        members = {key: collection.get('hydra:member') for key, collection in details.items()}
+        if self.reference_index is None or members != self.indexed_members:
+            self.reference_index = ReferenceIndex(details)
+            self.indexed_members = members
+        else:
+            self.reference_index.reset_unresolved()
+        return self.reference_index
+
+    def save_location_details(self, location_details):
+        """Save (network_id, location_data) pairs to the inventory and export the locations."""
+        count = inventory.replace_locations(location_details)
+        logging.info(f"Saved {count} location details to the inventory")
+        if not EXPORT_JSON:
+            return
+        if STREAM_OUTPUT:
+            with common.NdjsonWriter(self.location_details_stream_file) as writer:
+                for _, location_data in inventory.iter_locations():
+                    writer.write(location_data)
+        else:
+            common.write_json_atomic(self.location_details_file, [location_data for _, location_data in inventory.iter_locations()], indent=4)
+            logging.info(f"Saved location details to {self.location_details_file}")
 
-        location_details = []
-        for network_id, network_data in meraki_data.items():
+    def iter_location_details(self, meraki_data, reference_index):
+        """Yield the (network_id, location_data) pairs of the networks that map to a CloudiFi location."""
+        items = meraki_data.items() if isinstance(meraki_data, dict) else meraki_data
+        for network_id, network_data in items:
             try:
-                logging.info(f"Processing network {network_id}: {network_data}")
-                network_name = network_data["network"]["name"]
-                logging.info(f"Network name: {network_name}")
+                network_data = parse_network_data(network_data)
+                network = network_data["network"]
+                logging.debug(f"Processing network {network_id}: {network.name}")
 
                 device = network_data["devices"][0]
-                logging.info(f"Device: {device}")
+                logging.debug(f"Device: {device.serial}")
 
-                address = device["address"]
-                postcode = device["postcode"]
-                country_name = device["country"]
-                timezone_name = network_data["network"]["timeZone"]
-                lang_name = "English"  # Assuming default language is English; adjust if needed
+                required = {
+                    'network name': network.name,
+                    'timeZone': network.time_zone,
+                    'address': device.address,
+                    'postcode': device.postcode,
+                    'country': device.country,
+                    'mac': device.mac,
+                    'device name': device.name
+                }
+                missing = [name for name, value in required.items() if value is None]
+                if missing:
+                    raise KeyError(missing[0])
 
-                logging.info(f"Country Name: {country_name}, Timezone Name: {timezone_name}, Language Name: {lang_name}")
+                country_name = device.country
+                timezone_name = network.time_zone
+                lang_name = "English"  # Assuming default language is English; adjust if needed
 
                 # Find IDs based on names
-                country_id = self.get_id_by_name(details['countries']['hydra:member'], country_name, 'Country')
-                timezone_id = self.get_id_by_name(details['timezones']['hydra:member'], timezone_name, 'Timezone')
-                lang_id = self.get_id_by_name(details['langs']['hydra:member'], lang_name, 'Language')
-
-                logging.info(f"Matched Country ID: {country_id}, Timezone ID: {timezone_id}, Language ID: {lang_id}")
-
-                location_data = {
-                    "name": network_name,
-                    "lang": f"/langs/{lang_id}",
-                    "template": f"/templates/{self.cf_template_id}",
-                    "timezone": f"/timezones/{timezone_id}",
-                    "country": f"/countries/{country_id}",
-                    "addressLocality": address,
-                    "postalCode": postcode,
-                    "streetAddress": address,
-                    "bandwidthIn": 0,
-                    "bandwidthOut": 0,
-                    "identifiers": [
-                        {
-                            "key": device["mac"],
-                            "alias": device["name"]
-                        }
-                    ]
-                }
-                location_details.append(location_data)
+                country_id = reference_index.lookup('Country', country_name)
+                timezone_id = reference_index.lookup('Timezone', timezone_name)
+                lang_id = reference_index.lookup('Language', lang_name)
+
+                logging.debug(f"Network {network_id}: matched Country ID: {country_id}, Timezone ID: {timezone_id}, Language ID: {lang_id}")
+
+                location = Location(
+                    name=network.name,
+                    lang=f"/langs/{lang_id}",
+                    template=f"/templates/{self.cf_template_id}",
+                    timezone=f"/timezones/{timezone_id}",
+                    country=f"/countries/{country_id}",
+                    address=device.address,
+                    postcode=device.postcode,
+                    mac=device.mac,
+                    alias=device.name
+                )
+                yield network_id, location.to_dict()
 
             except KeyError as e:
                 logging.error(f"Missing required field {e} in network {network_id}")
@@ -126,40 +209,239 @@ class CloudiFi:
             except Exception as e:
                 logging.error(f"Unexpected error: {e} in network {network_id}")
 
-        with open("results/cloudifi_data/location_details.json", "w") as f:
-            json.dump(location_details, f, indent=4)
-        logging.info("Saved location details to results/cloudifi_data/location_details.json")
+    def get_headers(self, content_type=None):
+        headers = {}
+        if content_type:
+            headers['Content-Type'] = content_type
+        return headers
+
+    @contextlib.asynccontextmanager
+    async def request(self, session, method, url, headers=None, max_retries=HTTP_MAX_RETRIES, **kwargs):
+        """Send a request with the shared access token and the shared retry policy.
+
+        429 and 5xx answers are retried after Retry-After or the backoff delay,
+        connection errors only for idempotent methods. A 401 refreshes the
+        token and is retried once. The last response is handed to the caller.
+        """
+        from aiohttp import ClientError
+        from .http_client import RETRY_STATUSES, backoff_delay
+        refreshed = False
+        attempt = 0
+        while True:
+            token = await self.tokens.get_token(session)
+            try:
+                response = await session.request(method, url, headers={**(headers or {}), 'Authorization': f'Bearer {token}'}, **kwargs)
+            except (ClientError, asyncio.TimeoutError) as e:
+                if method not in IDEMPOTENT_METHODS or attempt >= max_retries:
+                    raise
+                delay, reason = backoff_delay(attempt), 'backoff'
+                logging.warning(f"Request error for {method} {url}: {e}. Retrying in {delay} seconds.")
+            else:
+                if response.status == 401 and not refreshed:
+                    response.release()
+                    logging.warning(f"CloudiFi rejected the access token on {method} {url}, refreshing it")
+                    self.tokens.invalidate(token)
+                    refreshed = True
+                    continue
+                if response.status not in RETRY_STATUSES or attempt >= max_retries:
+                    break
+                response.release()
+                if response.status == 429:
+                    delay, reason = retry_after(response, backoff_delay(attempt)), 'rate_limit'
+                    logging.warning(f"Rate limit reached on {method} {url}. Retrying after {delay} seconds.")
+                else:
+                    delay, reason = backoff_delay(attempt), 'backoff'
+                    logging.warning(f"Server error {response.status} for {method} {url}. Retrying in {delay} seconds.")
+            metrics.record_retry(method, url)
+            metrics.record_sleep(method, url, delay, reason)
+            await asyncio.sleep(delay)
+            attempt += 1
+        try:
+            yield response
+        finally:
+            response.release()
+
+    async def create_locations_from_saved_data(self, complete=True):
+        """Push the saved locations that changed since the last push and write a per-location report.
+
+        Locations are diffed against the push manifest: only added and changed
+        ones are sent. Existing locations are then listed once and matched by
+        identifier MAC, then by name, so only missing locations are created and
+        only changed fields patched. Removed locations are only looked for when
+        the run is complete, i.e. every network was mapped.
+        """
+        manifest = PushManifest()
+        operations = []
+        report = []
+        for key, location_data in inventory.iter_locations():
+            action = manifest.action(key, location_data)
+            if action == 'unchanged':
+                report.append({'name': location_data['name'], 'action': 'unchanged', 'id': manifest.entries[key]['id']})
+            else:
+                operations.append((action, key, location_data))
+        removed = manifest.removed() if complete else []
+        logging.info(f"Location diff: {sum(action == 'add' for action, _, _ in operations)} added, "
+                     f"{sum(action == 'change' for action, _, _ in operations)} changed, {len(removed)} removed, {len(report)} unchanged")
+
+        if CLOUDIFI_DRY_RUN:
+            self.save_push_plan(operations, removed)
+            return
+
+        from .http_client import async_session
+        session = async_session()
+        if operations:
+            existing = self.index_locations(await self.list_locations(session))
+            semaphore = asyncio.Semaphore(CLOUDIFI_CONCURRENCY)
+
+            async def upsert(location):
+                async with semaphore:
+                    return await self.upsert_location(session, existing, location)
+
+            results = await asyncio.gather(*(upsert(location_data) for _, _, location_data in operations))
+            for (_, key, location_data), result in zip(operations, results):
+                manifest.record(key, location_data, result)
+            report.extend(results)
+        report.extend(await self.remove_locations(session, manifest, removed))
+
+        manifest.save()
+        self.save_push_report(report)
+
+    async def remove_locations(self, session, manifest, removed):
+        """Delete the removed locations, or only report them unless CLOUDIFI_DELETE_REMOVED is set.
+
+        A location matched or pushed for another network in the same run has
+        moved to it and is only dropped from the manifest, never deleted.
+        """
+        results = []
+        for key, entry in removed:
+            if manifest.in_use(entry.get('id')):
+                result = {'name': entry['name'], 'action': 'moved', 'id': entry['id']}
+            elif CLOUDIFI_DELETE_REMOVED and entry.get('id') is not None:
+                result = await self.delete_location(session, entry['id'], entry['name'])
+            else:
+                result = {'name': entry['name'], 'action': 'removed', 'id': entry.get('id')}
+            if result['action'] != 'delete_failed':
+                manifest.forget(key)
+            results.append(result)
+        return results
 
-    def get_id_by_name(self, items, name, item_type):
-        logging.info(f"Searching for {item_type} with name {name}")
-        for item in items:
-            if item['name'].lower() == name.lower():
-                logging.info(f"Found {item_type}: {item}")
-                return item['id']
-        logging.warning(f"{item_type} with name {name} not found.")
-        return None
+    def save_push_plan(self, operations, removed):
+        """Write the operations a push would send, without sending them."""
+        plan = [{'name': location_data['name'], 'action': action, 'location': location_data} for action, _, location_data in operations]
+        plan += [{'name': entry['name'], 'action': 'delete' if CLOUDIFI_DELETE_REMOVED else 'removed', 'id': entry.get('id')} for _, entry in removed]
+        common.write_json_atomic(self.push_plan_file, plan, indent=4)
+        logging.info(f"Dry run: {len(plan)} location operations written to {self.push_plan_file}, nothing pushed")
 
-    async def create_locations_from_saved_data(self):
-        with open("results/cloudifi_data/location_details.json") as f:
-            location_details = json.load(f)
+    def save_push_report(self, report):
+        common.write_json_atomic(self.push_report_file, report, indent=4)
+        summary = {}
+        for result in report:
+            summary[result['action']] = summary.get(result['action'], 0) + 1
+        logging.info(f"Location push summary: {summary}. Report saved to {self.push_report_file}")
 
-        async with aiohttp.ClientSession() as session:
-            for location in location_details:
-                await self.create_location(session, location)
+    async def list_locations(self, session):
+        """Fetch every existing CloudiFi location."""
+        locations = (await self.fetch_collection(session, f"{self.cf_base_url}/locations"))['hydra:member']
+        logging.info(f"Found {len(locations)} existing locations")
+        return locations
+
+    def index_locations(self, locations):
+        """Index locations by lowercase identifier key and by name."""
+        index = {}
+        for location in locations:
+            for identifier in location.get('identifiers', []):
+                if isinstance(identifier, dict) and identifier.get('key'):
+                    index[('key', identifier['key'].lower())] = location
+            if location.get('name'):
+                index[('name', location['name'])] = location
+        return index
+
+    def find_location(self, index, location_data):
+        for identifier in location_data.get('identifiers', []):
+            existing = index.get(('key', identifier['key'].lower()))
+            if existing is not None:
+                return existing
+        return index.get(('name', location_data['name']))
+
+    def location_changes(self, existing, location_data):
+        """Return the fields of location_data that differ from the existing location."""
+        changes = {}
+        for key, value in location_data.items():
+            if key == 'identifiers':
+                existing_keys = {identifier.get('key', '').lower() for identifier in existing.get(key, []) if isinstance(identifier, dict)}
+                if not {identifier['key'].lower() for identifier in value} <= existing_keys:
+                    changes[key] = value
+            elif existing.get(key) != value:
+                changes[key] = value
+        return changes
+
+    async def upsert_location(self, session, index, location_data):
+        """Create the location if it does not exist yet, otherwise patch the changed fields."""
+        existing = self.find_location(index, location_data)
+        if existing is None:
+            return await self.create_location(session, location_data)
+        changes = self.location_changes(existing, location_data)
+        if not changes:
+            return {'name': location_data['name'], 'action': 'unchanged', 'id': existing.get('id')}
+        return await self.update_location(session, existing, changes, location_data['name'])
 
     async def create_location(self, session, location_data):
+        from aiohttp import ClientError
         url = f"{self.cf_base_url}/locations"
-        headers = {
-            'Authorization': f'Bearer {self.cf_refresh_token}',
-            'Content-Type': 'application/json'
-        }
+        result = {'name': location_data['name'], 'action': 'create'}
 
-        async with session.post(url, headers=headers, json=location_data) as response:
-            if response.status == 201:
-                logging.info(f"Location {location_data['name']} created successfully.")
-            else:
-                try:
-                    response_data = await response.json()
-                    logging.error(f"Failed to create location {location_data['name']}. Response: {response_data}")
-                except Exception as e:
-                    logging
\ No newline at end of file
+        try:
+            async with self.request(session, 'POST', url, headers=self.get_headers('application/json'), json=location_data) as response:
+                result['status'] = response.status
+                if response.status == 201:
+                    result['id'] = (await response.json()).get('id')
+                    logging.info(f"Location {location_data['name']} created successfully.")
+                else:
+                    result['action'] = 'create_failed'
+                    result['error'] = await response.text()
+                    logging.error(f"Failed to create location {location_data['name']}. Response: {result['error']}")
+        except ClientError as e:
+            result['action'] = 'create_failed'
+            result['error'] = str(e)
+            logging.error(f"Failed to create location {location_data['name']}: {e}")
+        return result
+
+    async def delete_location(self, session, location_id, name):
+        from aiohttp import ClientError
+        url = f"{self.cf_base_url}/locations/{location_id}"
+        result = {'name': name, 'action': 'delete', 'id': location_id}
+
+        try:
+            async with self.request(session, 'DELETE', url) as response:
+                result['status'] = response.status
+                if response.status in (200, 204, 404):
+                    logging.info(f"Location {name} deleted successfully.")
+                else:
+                    result['action'] = 'delete_failed'
+                    result['error'] = await response.text()
+                    logging.error(f"Failed to delete location {name}. Response: {result['error']}")
+        except ClientError as e:
+            result['action'] = 'delete_failed'
+            result['error'] = str(e)
+            logging.error(f"Failed to delete location {name}: {e}")
+        return result
+
+    async def update_location(self, session, existing, changes, name):
+        from aiohttp import ClientError
+        url = f"{self.cf_base_url}/locations/{existing['id']}"
+        result = {'name': name, 'action': 'update', 'id': existing['id'], 'fields': sorted(changes)}
+
+        try:
+            async with self.request(session, 'PATCH', url, headers=self.get_headers('application/merge-patch+json'), json=changes) as response:
+                result['status'] = response.status
+                if response.status == 200:
+                    logging.info(f"Location {name} updated successfully.")
+                else:
+                    result['action'] = 'update_failed'
+                    result['error'] = await response.text()
+                    logging.error(f"Failed to update location {name}. Response: {result['error']}")
+        except ClientError as e:
+            result['action'] = 'update_failed'
+            result['error'] = str(e)
+            logging.error(f"Failed to update location {name}: {e}")
+        return result
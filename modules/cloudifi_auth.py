@@ -0,0 +1,80 @@
+import json
+import time
+import base64
+import asyncio
+import logging
+from .config import CLOUDIFI_BASE_URL, CLOUDIFI_REFRESH_TOKEN, CLOUDIFI_TOKEN_REFRESH_MARGIN, CLOUDIFI_TOKEN_TTL
+
+def token_expiry(token):
+    """Return the exp claim of a JWT access token, or None when the token is opaque."""
+    try:
+        payload = token.split('.')[1]
+        return float(json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))['exp'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+class TokenManager:
+    """CloudiFi access token, exchanged from the refresh token and shared by every worker.
+
+    The token is kept with its expiry and refreshed CLOUDIFI_TOKEN_REFRESH_MARGIN
+    seconds (at most half its lifetime) before it, behind a lock: concurrent
+    workers that find it expiring wait for a single refresh instead of sending
+    one each. A token the API rejects with a 401 is invalidated, so the next
+    caller refreshes it.
+    """
+
+    def __init__(self, base_url=CLOUDIFI_BASE_URL, refresh_token=CLOUDIFI_REFRESH_TOKEN, margin=CLOUDIFI_TOKEN_REFRESH_MARGIN, ttl=CLOUDIFI_TOKEN_TTL):
+        self.base_url = base_url
+        self.refresh_token = refresh_token
+        self.margin = margin
+        self.ttl = ttl  # Lifetime assumed when the token response gives none
+        self.token = None
+        self.refresh_at = 0
+        self.lock = None
+        self.lock_loop = None
+
+    def valid(self):
+        return self.token is not None and time.time() < self.refresh_at
+
+    def get_lock(self):
+        """Return the refresh lock of the running event loop; the daemon may run cycles in new loops."""
+        loop = asyncio.get_running_loop()
+        if self.lock is None or self.lock_loop is not loop:
+            self.lock = asyncio.Lock()
+            self.lock_loop = loop
+        return self.lock
+
+    async def get_token(self, session):
+        """Return a valid access token, refreshing it once for every waiting worker when it expires."""
+        if self.valid():
+            return self.token
+        async with self.get_lock():
+            if not self.valid():  # Unless a worker refreshed it while this one waited
+                await self.refresh(session)
+        return self.token
+
+    def invalidate(self, token):
+        """Drop a token the API rejected, unless it was already replaced."""
+        if token == self.token:
+            self.refresh_at = 0
+
+    async def refresh(self, session):
+        """Exchange the refresh token for an access token through /auth/form."""
+        async with session.post(f"{self.base_url}/auth/form", json={'refresh_token': self.refresh_token}) as response:
+            if response.status >= 400:
+                logging.error(f"CloudiFi authentication failed with status {response.status}: {await response.text()}")
+            response.raise_for_status()
+            data = await response.json()
+        self.token = data['token']
+        self.refresh_token = data.get('refresh_token') or self.refresh_token  # Kept when the API rotates it
+        now = time.time()
+        if data.get('expires_in'):
+            lifetime = float(data['expires_in'])
+        else:
+            expires_at = token_expiry(self.token)
+            lifetime = expires_at - now if expires_at else self.ttl
+        self.refresh_at = now + lifetime - min(self.margin, lifetime / 2)
+        logging.info(f"CloudiFi access token refreshed, valid for {lifetime:.0f} seconds")
+
+# Shared by every CloudiFi client of the run
+tokens = TokenManager()
@@ -1,25 +1,12 @@
 import os
 import logging
 import time
-import requests
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
 import json
+import gzip
 from .config import *
-
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-
-# Retry strategy for HTTP requests
-retry_strategy = Retry(
-    total=3,
-    backoff_factor=5,
-    status_forcelist=[429, 500, 502, 503, 504],
-    method_whitelist=["HEAD", "GET", "OPTIONS", "POST"]
-)
-adapter = HTTPAdapter(max_retries=retry_strategy)
-http = requests.Session()
-http.mount("https://", adapter)
+from .metrics import metrics
+from .response_cache import response_cache
+from .models import encode
 
 # def create_directories():
 #     """Create directories for storing JSON data files."""
@@ -29,6 +16,10 @@ http.mount("https://", adapter)
 #     except Exception as e:
 #         logging.error(f"Failed to create directories: {e}")
 
+def configure_logging(level=LOG_LEVEL):
+    """Configure the root logger; called once by the entry point, modules only log."""
+    logging.basicConfig(level=level.upper(), format='%(asctime)s - %(levelname)s - %(message)s')
+
 def create_directories():
     """Create directories for storing JSON data files."""
     try:
@@ -38,22 +29,85 @@ def create_directories():
     except Exception as e:
         logging.error(f"Failed to create directories: {e}")
 
-def save_to_json(data, filename):
+def write_json_atomic(filepath, data, **kwargs):
+    """Write JSON to a temporary file renamed over filepath, so a partial file is never left behind."""
+    tmp_filepath = f"{filepath}.tmp"
+    try:
+        with open(tmp_filepath, 'w') as f:
+            json.dump(data, f, default=encode, **kwargs)
+        os.replace(tmp_filepath, filepath)
+    finally:
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+
+def save_to_json(data, filename, directory=MERAKI_DATA_DIR):
     """Save data to a JSON file."""
-    filepath = os.path.join(MERAKI_DATA_DIR, filename)
+    filepath = os.path.join(directory, filename)
     try:
-        with open(filepath, 'w') as f:
-            json.dump(data, f, indent=4)
+        write_json_atomic(filepath, data, indent=4)
         logging.info(f"Data has been written to {filepath}")
     except IOError as e:
         logging.error(f"Failed to write data to {filepath}: {e}")
 
-def load_last_fetch_time():
+def ndjson_path(filename, directory=MERAKI_DATA_DIR):
+    """Return the NDJSON path used in streaming mode for a JSON output file."""
+    filepath = os.path.join(directory, os.path.splitext(filename)[0] + '.ndjson')
+    return filepath + '.gz' if STREAM_COMPRESS else filepath
+
+class NdjsonWriter:
+    """Write records one JSON document per line, optionally gzip-compressed.
+
+    Records go to a temporary file that replaces the target only once every
+    record has been written.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.tmp_filepath = f"{filepath}.tmp"
+        self.count = 0
+        self.file = None
+
+    def __enter__(self):
+        opener = gzip.open if self.filepath.endswith('.gz') else open
+        self.file = opener(self.tmp_filepath, 'wt')
+        return self
+
+    def write(self, record):
+        self.file.write(json.dumps(record, default=encode) + '\n')
+        self.count += 1
+
+    def __exit__(self, exc_type, exc, tb):
+        self.file.close()
+        if exc_type is None:
+            os.replace(self.tmp_filepath, self.filepath)
+            logging.info(f"{self.count} records have been written to {self.filepath}")
+        else:
+            os.remove(self.tmp_filepath)
+
+def save_to_ndjson(records, filename, directory=MERAKI_DATA_DIR):
+    """Stream records to the NDJSON counterpart of filename."""
+    filepath = ndjson_path(filename, directory)
+    try:
+        with NdjsonWriter(filepath) as writer:
+            for record in records:
+                writer.write(record)
+    except IOError as e:
+        logging.error(f"Failed to write data to {filepath}: {e}")
+
+def save_network_records(networks_data, filename, directory=MERAKI_DATA_DIR):
+    """Stream (network_id, network_data) pairs as NDJSON records."""
+    save_to_ndjson(({'network_id': network_id, **network_data} for network_id, network_data in networks_data), filename, directory)
+
+def org_data_dir(org_id):
+    """Return the output directory of an organization in a multi-organization sync."""
+    return os.path.join(MERAKI_DATA_DIR, 'orgs', str(org_id))
+
+def load_last_fetch_time(filepath=LAST_FETCH_FILE):
     """Load the last fetch time from a JSON file."""
     try:
-        if not os.path.exists(LAST_FETCH_FILE):
-            save_last_fetch_time(0)
-        with open(LAST_FETCH_FILE, 'r') as f:
+        if not os.path.exists(filepath):
+            save_last_fetch_time(0, filepath)
+        with open(filepath, 'r') as f:
             last_fetch = json.load(f)['last_fetch']
         logging.info(f"Last fetch time loaded: {last_fetch}")
         return last_fetch
@@ -61,23 +115,27 @@ def load_last_fetch_time():
         logging.warning(f"Failed to load last fetch time: {e}")
         return 0
 
-def save_last_fetch_time(timestamp=None):
+def save_last_fetch_time(timestamp=None, filepath=LAST_FETCH_FILE):
     """Save the current time as the last fetch time to a JSON file."""
     current_time = timestamp if timestamp is not None else time.time()
     try:
-        with open(LAST_FETCH_FILE, 'w') as f:
-            json.dump({'last_fetch': current_time}, f)
+        write_json_atomic(filepath, {'last_fetch': current_time})
         logging.info("Last fetch time has been updated")
     except IOError as e:
         logging.error(f"Failed to save last fetch time: {e}")
 
 def fetch_data(url, params=None):
     """Fetch data from a given URL with optional parameters."""
+    import requests
+    from .http_client import http
     try:
-        response = http.get(url, headers=HEADERS, params=params)
+        page = response_cache.lookup(url, params)
+        if page is not None and page.fresh:
+            return response_cache.hit(url, page)[0]
+        response = http.get(url, headers={**HEADERS, **response_cache.validators(page)}, params=params)
         check_api_limits(response)
         response.raise_for_status()
-        return response.json()
+        return response_cache.update(url, params, page, response.status_code, response.headers, response.content, None)[0]
     except requests.HTTPError as http_err:
         logging.error(f"HTTP error occurred while fetching data from {url}: {http_err}")
         raise
@@ -95,4 +153,5 @@ def check_api_limits(response):
             sleep_time = reset_time - time.time()
             if sleep_time > 0:
                 logging.warning(f"API limit reached. Waiting for {sleep_time} seconds before continuing.")
+                metrics.record_sleep(response.request.method, response.url, sleep_time)
                 time.sleep(sleep_time)
\ No newline at end of file
@@ -8,7 +8,9 @@ load_dotenv()
 MERAKI_API_KEY = os.getenv('MERAKI_API_KEY')
 MERAKI_ORG_ID = os.getenv('MERAKI_ORG_ID')
 USER_AGENT = os.getenv('USER_AGENT')
-MERAKI_BASE_URL = "https://api.meraki.com/api/v1"
+MERAKI_BASE_URL = os.getenv('MERAKI_BASE_URL', "https://api.meraki.com/api/v1")
+NOMINATIM_DOMAIN = os.getenv('NOMINATIM_DOMAIN', 'nominatim.openstreetmap.org')  # Reverse geocoding server, with port if any
+NOMINATIM_SCHEME = os.getenv('NOMINATIM_SCHEME', 'https')
 HEADERS = {
     "Content-Type": "application/json",
     "Accept": "application/json",
@@ -21,4 +23,62 @@ LAST_FETCH_FILE = 'results/last_fetch.json'
 CLOUDIFI_REFRESH_TOKEN = os.getenv("CLOUDIFI_REFRESH_TOKEN")
 CLOUDIFI_BASE_URL = os.getenv("CLOUDIFI_BASE_URL")
 CLOUDIFI_TEMPLATE_ID = os.getenv("CLOUDIFI_TEMPLATE_ID")
-CLOUDIFI_DATA_DIR = os.path.join(RESULTS_DIR, 'cloudifi_data')
\ No newline at end of file
+CLOUDIFI_DATA_DIR = os.path.join(RESULTS_DIR, 'cloudifi_data')
+MERAKI_RATE_LIMIT = float(os.getenv('MERAKI_RATE_LIMIT', 10))  # Requests per second per organization
+MERAKI_CONCURRENCY = int(os.getenv('MERAKI_CONCURRENCY', 8))  # Maximum in-flight Meraki requests
+MERAKI_ORG_IDS = [org_id.strip() for org_id in os.getenv('MERAKI_ORG_IDS', '').split(',') if org_id.strip()]  # Organizations synced in parallel instead of MERAKI_ORG_ID; 'all' for every organization of the API key
+MERAKI_ORG_CONCURRENCY = int(os.getenv('MERAKI_ORG_CONCURRENCY', 4))  # Organizations crawled at the same time, each within its own MERAKI_RATE_LIMIT
+MERAKI_BULK_SSIDS = os.getenv('MERAKI_BULK_SSIDS', 'false').lower() == 'true'  # Build SSIDs from the organization-wide SSID statuses (number, name, enabled only)
+# Page sizes of the Meraki listings, shared by the sync and async clients so that
+# the pages one of them cached or journaled are reused by the other
+ORGANIZATIONS_PER_PAGE = 9000
+NETWORKS_PER_PAGE = 1000
+DEVICES_PER_PAGE = 1000
+SSID_STATUSES_PER_PAGE = 500
+CONFIGURATION_CHANGES_PER_PAGE = 5000
+GEOCODER_BACKEND = os.getenv('GEOCODER_BACKEND', 'nominatim')  # nominatim (public or self-hosted through NOMINATIM_DOMAIN) or offline
+GEOCODER_RATE_LIMIT = float(os.getenv('GEOCODER_RATE_LIMIT', 1))  # Nominatim requests per second; the public server allows 1
+GEOCODER_WORKERS = int(os.getenv('GEOCODER_WORKERS', 4))  # Concurrent Nominatim lookups within the rate limit
+GEOCODER_TIMEOUT = float(os.getenv('GEOCODER_TIMEOUT', 10))  # Seconds before a Nominatim lookup fails
+OFFLINE_GEOCODER_DATASET = os.getenv('OFFLINE_GEOCODER_DATASET', os.path.join('data', 'postcodes.csv'))  # CSV of lat, lng, country, postcode, city, state
+GEOCODE_CACHE_FILE = os.path.join(RESULTS_DIR, 'geocode_cache.sqlite')
+GEOCODE_PRECISION = int(os.getenv('GEOCODE_PRECISION', 4))  # Decimal places kept in cache keys (~11 m)
+GEOCODE_CACHE_TTL = int(os.getenv('GEOCODE_CACHE_TTL', 30 * 24 * 3600))  # Seconds before a cached address expires
+GEOCODE_LRU_SIZE = int(os.getenv('GEOCODE_LRU_SIZE', 10000))  # In-process entries kept in front of the cache file
+INCREMENTAL_SYNC = os.getenv('INCREMENTAL_SYNC', 'true').lower() == 'true'  # Only re-fetch networks changed since the last fetch
+FINGERPRINTS_FILE = os.path.join(MERAKI_DATA_DIR, 'fingerprints.json')
+CLOUDIFI_CONCURRENCY = int(os.getenv('CLOUDIFI_CONCURRENCY', 10))  # Maximum in-flight CloudiFi location requests
+CLOUDIFI_TOKEN_REFRESH_MARGIN = int(os.getenv('CLOUDIFI_TOKEN_REFRESH_MARGIN', 60))  # Seconds before its expiry the access token is refreshed
+CLOUDIFI_TOKEN_TTL = int(os.getenv('CLOUDIFI_TOKEN_TTL', 3600))  # Access token lifetime assumed when /auth/form gives none
+CLOUDIFI_REFERENCE_TTL = int(os.getenv('CLOUDIFI_REFERENCE_TTL', 24 * 3600))  # Seconds before reference data is revalidated
+KEEP_RAW_PAYLOADS = os.getenv('KEEP_RAW_PAYLOADS', 'false').lower() == 'true'  # Spill the raw Meraki listings to raw_*.ndjson before trimming them to the consumed fields
+CLOUDIFI_DRY_RUN = os.getenv('CLOUDIFI_DRY_RUN', 'false').lower() == 'true'  # Write the planned location operations to push_plan.json instead of sending them
+CLOUDIFI_DELETE_REMOVED = os.getenv('CLOUDIFI_DELETE_REMOVED', 'false').lower() == 'true'  # Delete the locations of networks no longer in Meraki instead of only reporting them
+INVENTORY_FILE = os.path.join(RESULTS_DIR, 'inventory.sqlite')
+EXPORT_JSON = os.getenv('EXPORT_JSON', 'true').lower() == 'true'  # Also export the inventory to the JSON result files
+STREAM_OUTPUT = os.getenv('STREAM_OUTPUT', 'false').lower() == 'true'  # Write per-record NDJSON files instead of whole JSON documents
+STREAM_COMPRESS = os.getenv('STREAM_COMPRESS', 'false').lower() == 'true'  # Gzip the NDJSON files
+PIPELINE_MODE = os.getenv('PIPELINE_MODE', 'false').lower() == 'true'  # Stream networks from Meraki to CloudiFi instead of running phases
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', 100))  # Maximum items waiting between two pipeline stages
+RESPONSE_CACHE = os.getenv('RESPONSE_CACHE', 'true').lower() == 'true'  # Keep Meraki listing pages on disk and revalidate them instead of re-downloading them
+RESPONSE_CACHE_FILE = os.path.join(RESULTS_DIR, 'response_cache.sqlite')
+RESPONSE_CACHE_TTLS = dict((endpoint.strip(), int(ttl)) for endpoint, ttl in (item.split('=') for item in os.getenv('RESPONSE_CACHE_TTLS', '').split(',') if item.strip()))  # Seconds a cached page is used without a request, as /networks/{id}/wireless/ssids=3600,...; overrides the defaults of response_cache.py
+RESPONSE_CACHE_MAX_AGE = int(os.getenv('RESPONSE_CACHE_MAX_AGE', 7 * 24 * 3600))  # Seconds after which a page that was not revalidated is evicted
+CHECKPOINT_FILE = os.path.join(MERAKI_DATA_DIR, 'checkpoint.ndjson')
+CHECKPOINT_MAX_AGE = int(os.getenv('CHECKPOINT_MAX_AGE', 6 * 3600))  # Seconds after which an unfinished crawl is restarted instead of resumed
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')  # DEBUG, INFO, WARNING or ERROR; set once by the entry point
+MAX_RUN_ATTEMPTS = int(os.getenv('MAX_RUN_ATTEMPTS', 3))  # Attempts after rate limit or server errors before giving up
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', MERAKI_CONCURRENCY * (MERAKI_ORG_CONCURRENCY if MERAKI_ORG_IDS else 1) + CLOUDIFI_CONCURRENCY))  # Keep-alive connections kept open per client
+HTTP_MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', 5))  # Retries on 429, 5xx and connection errors
+HTTP_BACKOFF_FACTOR = float(os.getenv('HTTP_BACKOFF_FACTOR', 1))  # Seconds before the first retry, doubled on each retry
+HTTP_BACKOFF_MAX = float(os.getenv('HTTP_BACKOFF_MAX', 30))  # Maximum seconds between two retries
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv('HTTP_KEEPALIVE_TIMEOUT', 60))  # Seconds an idle connection is kept open
+SYNC_INTERVAL = int(os.getenv('SYNC_INTERVAL', 900))  # Seconds between the starts of two syncs in daemon mode
+SYNC_JITTER = int(os.getenv('SYNC_JITTER', 60))  # Random seconds added to each interval so instances do not sync in lockstep
+HEALTH_HOST = os.getenv('HEALTH_HOST', '127.0.0.1')
+HEALTH_PORT = int(os.getenv('HEALTH_PORT', 8080))  # Port of the daemon /health and /metrics endpoint; 0 disables it
+HEALTH_MAX_FAILURES = int(os.getenv('HEALTH_MAX_FAILURES', 3))  # Consecutive failed syncs before /health answers 503
+PROFILE_DIR = os.path.join(RESULTS_DIR, 'profiles')
+PROFILE_TOP = int(os.getenv('PROFILE_TOP', 20))  # Functions and allocation sites listed per phase in the --profile report
+METRICS_FILE = os.getenv('METRICS_FILE', os.path.join(RESULTS_DIR, 'metrics.json'))
+METRICS_PROM_FILE = os.getenv('METRICS_PROM_FILE', os.path.join(RESULTS_DIR, 'metrics.prom'))  # Point at the node_exporter textfile directory to scrape it
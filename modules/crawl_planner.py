@@ -0,0 +1,250 @@
+import math
+import asyncio
+import logging
+from . import common
+from .config import MERAKI_BULK_SSIDS, KEEP_RAW_PAYLOADS, SSID_STATUSES_PER_PAGE
+from .models import Network, Device, Ssid
+from .response_cache import response_cache
+
+def ssids_by_network(statuses):
+    """Partition the organization SSID statuses (one entry per access point) into SSID lists per networkId."""
+    networks = {}
+    for device in statuses:
+        network_ssids = networks.setdefault(device.get('network', {}).get('id'), {})
+        for basic_service_set in device.get('basicServiceSets', []):
+            ssid = basic_service_set.get('ssid', {})
+            if 'number' in ssid:
+                network_ssids.setdefault(ssid['number'], Ssid.from_dict(ssid))
+    return {network_id: [ssids[number] for number in sorted(ssids)] for network_id, ssids in networks.items()}
+
+class CrawlPlanner:
+    """Fetch each Meraki resource at most once per run and share it between all outputs.
+
+    Devices come from the organization-wide listing and are grouped by networkId,
+    so organization_details.json, devices_with_location.json and
+    networks_devices_ssids.json are all built from the same in-memory dataset.
+    With an incremental state, only networks changed since the last fetch are
+    geocoded and have their SSIDs fetched; the others are carried forward. A
+    network whose SSIDs cannot be fetched keeps its previous ones and stays
+    changed for the next run.
+    Listings are parsed into Network, Device and Ssid records as they arrive.
+    """
+
+    def __init__(self, fetcher, state=None, bulk_ssids=MERAKI_BULK_SSIDS):
+        self.fetcher = fetcher
+        self.state = state
+        self.bulk_ssids = bulk_ssids
+        self._bulk_ssids = None
+        self._networks = None
+        self._organization_devices = None
+        self._configuration_changes = None
+        self._changed_network_ids = None
+        self._planned_devices = None
+        self._devices_to_locate = {}
+        self._devices = None
+        self._devices_by_network = None
+        self._ssids = {}
+        self._failed_ssids = set()
+
+    def parse(self, records, model, filename):
+        """Keep only the fields the sync consumes, spilling the raw payloads to disk when KEEP_RAW_PAYLOADS is set."""
+        if KEEP_RAW_PAYLOADS:
+            common.save_to_ndjson(records, filename, self.fetcher.data_dir)
+        return [model.from_dict(record) for record in records]
+
+    def get_networks(self):
+        """Return the organization networks, fetching them on first use."""
+        if self._networks is None:
+            self._networks = self.parse(self.fetcher.get_networks(), Network, 'raw_networks.json')
+        return self._networks
+
+    def get_organization_devices(self):
+        """Return the organization device listing as fetched, without location details."""
+        if self._organization_devices is None:
+            self._organization_devices = self.parse(self.fetcher.get_organization_devices(), Device, 'raw_devices.json')
+        return self._organization_devices
+
+    def get_changed_network_ids(self):
+        """Return the IDs of the networks that must be re-fetched in this run."""
+        if self._changed_network_ids is None:
+            if self.state is None:
+                self._changed_network_ids = {network.id for network in self.get_networks()}
+            else:
+                if self._configuration_changes is None:
+                    t0 = self.state.change_log_t0
+                    self._configuration_changes = self.fetcher.get_configuration_changes(t0) if t0 else []
+                self._changed_network_ids = self.state.changed_network_ids(
+                    self.get_networks(), self.get_organization_devices(), self._configuration_changes
+                )
+                # Cached SSIDs of reconfigured networks must not outlive their change
+                response_cache.invalidate_networks({change['networkId'] for change in self._configuration_changes if change.get('networkId')})
+        return self._changed_network_ids
+
+    def plan_devices(self):
+        """Return the devices of the run, carrying unchanged networks forward.
+
+        Devices of new or changed networks still need location details; they are
+        kept per network until locate_network or get_devices resolves them.
+        """
+        if self._planned_devices is None:
+            changed = self.get_changed_network_ids()
+            previous_devices = self.state.previous_devices() if self.state is not None else {}
+            devices = []
+            for device in self.get_organization_devices():
+                if device.network_id not in changed and device.serial in previous_devices:
+                    devices.append(previous_devices[device.serial])
+                else:
+                    devices.append(device)
+                    self._devices_to_locate.setdefault(device.network_id, []).append(device)
+            self._planned_devices = devices
+            located = sum(len(network_devices) for network_devices in self._devices_to_locate.values())
+            logging.info(f"Fetched {len(devices)} organization devices, {located} new or changed")
+        return self._planned_devices
+
+    def locate_network(self, network_id):
+        """Add location details to the new or changed devices of a network."""
+        self.plan_devices()
+        devices = self._devices_to_locate.pop(network_id, None)
+        if devices:
+            self.fetcher.add_locations(devices)
+
+    def get_devices(self):
+        """Return all organization devices with location details, fetching them on first use."""
+        if self._devices is None:
+            devices = self.plan_devices()
+            self.fetcher.add_locations([device for network_devices in self._devices_to_locate.values() for device in network_devices])
+            self._devices_to_locate.clear()
+            self._devices = devices
+        return self._devices
+
+    def get_devices_by_network(self):
+        """Return the organization devices grouped by networkId."""
+        if self._devices_by_network is None:
+            devices_by_network = {}
+            for device in self.plan_devices():
+                devices_by_network.setdefault(device.network_id, []).append(device)
+            self._devices_by_network = devices_by_network
+        return self._devices_by_network
+
+    def get_network_devices(self, network_id):
+        """Return the devices belonging to a given network, with location details."""
+        self.locate_network(network_id)
+        return self.get_devices_by_network().get(network_id, [])
+
+    def get_access_points(self, network_id):
+        """Return the access points of a given network, derived from the device listing."""
+        return [device for device in self.get_network_devices(network_id) if device.is_access_point]
+
+    def get_pending_wireless_ids(self):
+        """Return the changed wireless networks whose SSIDs have not been fetched yet."""
+        changed = self.get_changed_network_ids()
+        return [
+            network.id for network in self.get_networks()
+            if network.wireless and network.id in changed and network.id not in self._ssids
+        ]
+
+    def use_bulk_ssids(self, network_ids):
+        """Return True when the organization-wide listing takes fewer calls than one per network."""
+        if not self.bulk_ssids or self._bulk_ssids is not None or not network_ids:
+            return False
+        access_points = sum(1 for device in self.get_organization_devices() if device.is_access_point)
+        return len(network_ids) > max(1, math.ceil(access_points / SSID_STATUSES_PER_PAGE))
+
+    def load_bulk_ssids(self, statuses, network_ids):
+        """Take the SSIDs of network_ids from the organization listing; absent networks fall back to per-network calls."""
+        self._bulk_ssids = ssids_by_network(statuses)
+        for network_id in network_ids:
+            if network_id in self._bulk_ssids:
+                self._ssids[network_id] = self._bulk_ssids[network_id]
+        logging.info(f"Took SSIDs of {len(self._bulk_ssids)} networks from the organization listing")
+
+    def prefetch_bulk_ssids(self):
+        """Fetch the organization SSID listing once when it is cheaper than per-network calls."""
+        network_ids = self.get_pending_wireless_ids()
+        if self.use_bulk_ssids(network_ids):
+            try:
+                self.load_bulk_ssids(self.fetcher.get_organization_ssid_statuses(), network_ids)
+            except Exception as e:
+                self._bulk_ssids = {}
+                logging.warning(f"Organization SSID listing failed, fetching SSIDs per network: {e}")
+
+    async def prefetch_bulk_ssids_async(self, client):
+        """Async counterpart of prefetch_bulk_ssids."""
+        network_ids = self.get_pending_wireless_ids()
+        if self.use_bulk_ssids(network_ids):
+            try:
+                self.load_bulk_ssids(await client.get_organization_ssid_statuses(), network_ids)
+            except Exception as e:
+                self._bulk_ssids = {}
+                logging.warning(f"Organization SSID listing failed, fetching SSIDs per network: {e}")
+
+    def keep_previous_ssids(self, network_id, error):
+        """Return the previous SSIDs of a network whose SSIDs could not be fetched, and keep it changed for the next run."""
+        logging.error(f"Failed to fetch SSIDs for network {network_id}, keeping the previous ones: {error}")
+        self._failed_ssids.add(network_id)
+        if self.state is None:
+            return []
+        self.state.retry(network_id)
+        return self.state.previous_ssids(network_id)
+
+    def ssids_failed(self, network_id):
+        """Return True when the SSIDs of the network could not be fetched in this run."""
+        return network_id in self._failed_ssids
+
+    def get_ssids(self, network_id):
+        """Return the SSIDs of a given network, fetching them on first use."""
+        if network_id not in self._ssids and self.bulk_ssids and self._bulk_ssids is None:
+            self.prefetch_bulk_ssids()  # Once per run; networks missing from the listing fall through
+        if network_id not in self._ssids:
+            if self.state is None or network_id in self.get_changed_network_ids():
+                try:
+                    self._ssids[network_id] = [Ssid.from_dict(ssid) for ssid in self.fetcher.get_ssids(network_id)]
+                except Exception as e:
+                    self._ssids[network_id] = self.keep_previous_ssids(network_id, e)
+            else:
+                self._ssids[network_id] = self.state.previous_ssids(network_id)
+        return self._ssids[network_id]
+
+    async def get_ssids_async(self, client, network_id):
+        """Async counterpart of get_ssids, fetching through the async client."""
+        if network_id not in self._ssids:
+            if self.state is None or network_id in self.get_changed_network_ids():
+                try:
+                    self._ssids[network_id] = [Ssid.from_dict(ssid) for ssid in await client.get_ssids(network_id)]
+                except Exception as e:
+                    self._ssids[network_id] = self.keep_previous_ssids(network_id, e)
+            else:
+                self._ssids[network_id] = self.state.previous_ssids(network_id)
+        return self._ssids[network_id]
+
+    async def prefetch_listings(self, client):
+        """Fetch the organization-wide listings (networks, devices, change log) concurrently."""
+        t0 = self.state.change_log_t0 if self.state is not None else None
+        networks, devices, configuration_changes = await asyncio.gather(
+            client.get_networks(),
+            client.get_organization_devices(),
+            client.get_configuration_changes(t0) if t0 else asyncio.sleep(0, result=[])
+        )
+        self._networks = self.parse(networks, Network, 'raw_networks.json')
+        self._organization_devices = self.parse(devices, Device, 'raw_devices.json')
+        self._configuration_changes = configuration_changes
+
+    async def prefetch(self, client):
+        """Fetch networks, organization devices and SSIDs concurrently through the async client.
+
+        Page fetches of every network run in parallel, paced by the client's token bucket.
+        """
+        await self.prefetch_listings(client)
+        await self.prefetch_bulk_ssids_async(client)
+
+        wireless_ids = [
+            network_id for network_id in self.get_pending_wireless_ids()
+            if self.fetcher.journal.get_network(network_id) is None
+        ]
+        logging.info(f"Fetching SSIDs for {len(wireless_ids)} wireless networks")
+        # Geocoding of the whole organization runs in a thread while the SSIDs are fetched
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(
+            loop.run_in_executor(None, self.get_devices),
+            *(self.get_ssids_async(client, network_id) for network_id in wireless_ids)
+        )
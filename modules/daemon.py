@@ -0,0 +1,173 @@
+import json
+import time
+import random
+import signal
+import asyncio
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from .config import SYNC_INTERVAL, SYNC_JITTER, HEALTH_HOST, HEALTH_PORT, HEALTH_MAX_FAILURES
+from .cloudifi_api import CloudiFi
+from .geocoding import GeocodingStage
+from .metrics import metrics
+from .http_client import close_async_session
+
+class SyncDaemon:
+    """Run the sync every interval seconds in a long-lived process.
+
+    The HTTP connection pools, the geocoder with its cache and the CloudiFi
+    reference index are created once and stay warm between cycles. A first
+    SIGTERM or SIGINT lets the running cycle finish before exiting; a second
+    one interrupts it, and the checkpoint journal resumes it on the next start.
+    The HTTP summary and the JSON metrics cover one cycle, the Prometheus
+    counters the whole life of the daemon.
+    """
+
+    def __init__(self, sync, interval=SYNC_INTERVAL, jitter=SYNC_JITTER, health_host=HEALTH_HOST, health_port=HEALTH_PORT):
+        self.sync = sync  # Callable(geocoder, cloudifi) returning True when the sync succeeded
+        self.interval = interval
+        self.jitter = jitter
+        self.health_host = health_host
+        self.health_port = health_port
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()  # The health endpoint reads the status from its own threads
+        self.server = None
+        self.status = {
+            'state': 'starting',
+            'started_at': time.time(),
+            'cycles': 0,
+            'failures': 0,
+            'consecutive_failures': 0,
+            'last_run': None,
+            'last_duration': None,
+            'last_success': None,
+            'next_run': None
+        }
+
+    def run(self):
+        """Sync until a stop signal is received."""
+        signal.signal(signal.SIGTERM, self.handle_signal)
+        signal.signal(signal.SIGINT, self.handle_signal)
+        self.start_health_server()
+        geocoder = GeocodingStage()
+        cloudifi = CloudiFi()
+        logging.info(f"Sync daemon started, syncing every {self.interval}s plus up to {self.jitter}s of jitter")
+        try:
+            while not self.stopping.is_set():
+                started = time.time()
+                self.run_cycle(geocoder, cloudifi)
+                self.wait(started + self.interval + random.uniform(0, self.jitter))
+        finally:
+            self.shutdown(geocoder)
+
+    def run_cycle(self, geocoder, cloudifi):
+        started = time.time()
+        baseline = metrics.snapshot()
+        self.update(state='syncing', last_run=started, next_run=None)
+        try:
+            succeeded = self.sync(geocoder, cloudifi)
+        except Exception as e:
+            logging.error(f"Sync cycle failed: {e}")
+            succeeded = False
+        duration = time.time() - started
+        with self.lock:
+            self.status['cycles'] += 1
+            self.status['last_duration'] = round(duration, 3)
+            if succeeded:
+                self.status['consecutive_failures'] = 0
+                self.status['last_success'] = time.time()
+            else:
+                self.status['failures'] += 1
+                self.status['consecutive_failures'] += 1
+        logging.info(f"Sync cycle {'succeeded' if succeeded else 'failed'} in {duration:.1f}s")
+        cycle = metrics.since(baseline)
+        cycle.log_summary()
+        cycle.export(prom_file=None)
+        metrics.export(json_file=None)  # Prometheus counters stay monotonic
+
+    def wait(self, next_run):
+        """Sleep until next_run, waking up early on a stop signal."""
+        self.update(state='waiting', next_run=next_run)
+        delay = next_run - time.time()
+        if delay > 0 and not self.stopping.is_set():
+            logging.info(f"Next sync in {delay:.0f}s")
+            self.stopping.wait(delay)
+
+    def handle_signal(self, signum, frame):
+        if self.stopping.is_set():
+            logging.warning("Second stop signal, interrupting the running cycle; it resumes from the checkpoint on the next start")
+            raise SystemExit(1)
+        logging.info(f"Received {signal.Signals(signum).name}, stopping once the running cycle is over")
+        self.update(state='stopping')
+        self.stopping.set()
+
+    def shutdown(self, geocoder):
+        logging.info("Shutting down the sync daemon")
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        try:
+            asyncio.get_event_loop().run_until_complete(close_async_session())
+        except Exception as e:
+            logging.warning(f"Failed to close the HTTP session: {e}")
+        geocoder.cache.close()
+        metrics.export(json_file=None)  # The JSON export keeps the last cycle
+
+    def update(self, **fields):
+        with self.lock:
+            self.status.update(fields)
+
+    def health(self):
+        """Return the status of the daemon and whether it is healthy."""
+        with self.lock:
+            status = dict(self.status)
+        status['healthy'] = status['consecutive_failures'] < HEALTH_MAX_FAILURES
+        return status
+
+    def to_prometheus(self):
+        """Render the daemon status after the HTTP metrics."""
+        status = self.health()
+        lines = [
+            '# HELP meraki_sync_cycles_total Sync cycles run by the daemon.',
+            '# TYPE meraki_sync_cycles_total counter',
+            f'meraki_sync_cycles_total{{result="success"}} {status["cycles"] - status["failures"]}',
+            f'meraki_sync_cycles_total{{result="failure"}} {status["failures"]}',
+            '# HELP meraki_sync_last_success_timestamp_seconds End of the last successful sync.',
+            '# TYPE meraki_sync_last_success_timestamp_seconds gauge',
+            f"meraki_sync_last_success_timestamp_seconds {status['last_success'] or 0:.3f}",
+            '# HELP meraki_sync_healthy Whether fewer than HEALTH_MAX_FAILURES consecutive syncs failed.',
+            '# TYPE meraki_sync_healthy gauge',
+            f"meraki_sync_healthy {int(status['healthy'])}"
+        ]
+        return metrics.to_prometheus() + '\n'.join(lines) + '\n'
+
+    def start_health_server(self):
+        """Serve /health (JSON status, 503 when unhealthy) and /metrics (Prometheus) in a background thread."""
+        if not self.health_port:
+            return
+        daemon = self
+
+        class HealthHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/health':
+                    status = daemon.health()
+                    self.reply(200 if status['healthy'] else 503, 'application/json', json.dumps(status))
+                elif self.path == '/metrics':
+                    self.reply(200, 'text/plain; version=0.0.4', daemon.to_prometheus())
+                else:
+                    self.reply(404, 'text/plain', 'Not found\n')
+
+            def reply(self, code, content_type, body):
+                body = body.encode()
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug(f"Health endpoint: {format % args}")
+
+        self.server = ThreadingHTTPServer((self.health_host, self.health_port), HealthHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        logging.info(f"Health and metrics endpoint listening on http://{self.health_host}:{self.health_port}")
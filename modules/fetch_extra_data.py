@@ -1,52 +1,94 @@
+import os
 import logging
 import time
-import requests
-from geopy.geocoders import Nominatim
-from .common import fetch_data, save_to_json, load_last_fetch_time, save_last_fetch_time, create_directories, check_api_limits
-from .config import MERAKI_BASE_URL, MERAKI_ORG_ID, MERAKI_API_KEY, USER_AGENT
-
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+from .common import fetch_data, save_to_json, load_last_fetch_time, save_last_fetch_time, create_directories, check_api_limits, configure_logging
+from .config import (MERAKI_BASE_URL, MERAKI_ORG_ID, MERAKI_API_KEY, USER_AGENT, INCREMENTAL_SYNC, EXPORT_JSON, MERAKI_DATA_DIR, LAST_FETCH_FILE,
+                     NETWORKS_PER_PAGE, DEVICES_PER_PAGE, SSID_STATUSES_PER_PAGE, CONFIGURATION_CHANGES_PER_PAGE)
+from .crawl_planner import CrawlPlanner
+from .geocoding import GeocodingStage, apply_address
+from .incremental import IncrementalState
+from .checkpoint import CheckpointJournal
+from .models import parse_network_data
+from .metrics import metrics
+from .http_client import http
+from .response_cache import response_cache
+from .inventory import inventory
 
 class MerakiFetcher:
-    def __init__(self):
+    def __init__(self, last_fetch_time=None, org_id=MERAKI_ORG_ID, data_dir=MERAKI_DATA_DIR, last_fetch_file=LAST_FETCH_FILE, geocoder=None, geocode=True):
         self.base_url = MERAKI_BASE_URL
-        self.org_id = MERAKI_ORG_ID
+        self.org_id = org_id
+        self.data_dir = data_dir  # Where the outputs, fingerprints and checkpoint of this organization live
+        self.last_fetch_file = last_fetch_file
         self.headers = {
             "Content-Type": "application/json",
             "Accept": "application/json",
             "X-Cisco-Meraki-API-Key": MERAKI_API_KEY,
             "User-Agent": USER_AGENT
         }
-        self.geolocator = Nominatim(user_agent=USER_AGENT)  # Initialize geolocator
-
-    def fetch_data_with_pagination(self, url, params=None):
-        """Fetch data from the Meraki API with pagination support."""
+        if geocode:
+            self.geocoder = geocoder if geocoder is not None else GeocodingStage()  # Cached, pooled reverse geocoding, shared between organizations
+        else:
+            self.geocoder = None  # Devices are left without an address for the geocode phase
+        os.makedirs(data_dir, exist_ok=True)
+        self.journal = CheckpointJournal(os.path.join(data_dir, 'checkpoint.ndjson'))  # Progress of an interrupted crawl to resume from
+        self.started_at = self.journal.start(time.time())  # Recorded as the next last fetch time so no change is missed
+        if last_fetch_time is None:
+            create_directories()
+            last_fetch_time = load_last_fetch_time(last_fetch_file)
+        state = IncrementalState(last_fetch_time, org_id, os.path.join(data_dir, 'fingerprints.json')) if INCREMENTAL_SYNC else None
+        self.planner = CrawlPlanner(self, state)  # Shared per-run cache of fetched resources
+
+    def fetch_data_with_pagination(self, url, params=None, checkpoint=False, items_key=None):
+        """Fetch data from the Meraki API with pagination support.
+
+        With checkpoint, every page is journaled so an interrupted listing
+        resumes from its last page cursor. items_key names the list of
+        endpoints that wrap their page in an object. Pages of cached
+        endpoints go through the response cache.
+        """
         items = []
+        if checkpoint:
+            key = self.journal.page_key(url, params)
+            items, next_url = self.journal.resume_pages(key, url)
+            if next_url != url:
+                url, params = next_url, None
         while url:
-            response = requests.get(url, headers=self.headers, params=params)
-            check_api_limits(response)
-
-            if response.status_code == 429:
-                retry_after = int(response.headers.get('Retry-After', 1))
-                logging.warning(f"Rate limit reached. Retrying after {retry_after} seconds.")
-                time.sleep(retry_after)
-                continue
-
-            response.raise_for_status()
-            data = response.json()
+            page = response_cache.lookup(url, params)
+            if page is not None and page.fresh:
+                data, next_url = response_cache.hit(url, page)
+            else:
+                response = http.get(url, headers={**self.headers, **response_cache.validators(page)}, params=params)
+                check_api_limits(response)
+
+                if response.status_code == 429:
+                    retry_after = int(response.headers.get('Retry-After', 1))
+                    logging.warning(f"Rate limit reached. Retrying after {retry_after} seconds.")
+                    metrics.record_retry('GET', url)
+                    metrics.record_sleep('GET', url, retry_after)
+                    time.sleep(retry_after)
+                    continue
+
+                response.raise_for_status()
+                data, next_url = response_cache.update(
+                    url, params, page, response.status_code, response.headers, response.content, response.links.get('next', {}).get('url')
+                )
+            if items_key is not None:
+                data = data[items_key]
             items.extend(data)
 
-            # Check if there is a next page
-            url = response.links.get('next', {}).get('url')
+            url = next_url
+            params = None  # The next page URL already carries the query string
+            if checkpoint:
+                self.journal.record_page(key, data, url)
         return items
 
     def get_networks(self):
         """Get networks for the organization from the Meraki API."""
         url = f"{self.base_url}/organizations/{self.org_id}/networks"
-        params = {'perPage': 100}
+        params = {'perPage': NETWORKS_PER_PAGE}
         logging.info(f"Fetching networks from {url}")
-        return self.fetch_data_with_pagination(url, params)
+        return self.fetch_data_with_pagination(url, params, checkpoint=True)
 
     def get_devices(self, network_id):
         """Get devices for a given network."""
@@ -56,96 +98,136 @@ class MerakiFetcher:
         devices = self.fetch_data_with_pagination(url, params)
 
         # Add location information
-        for device in devices:
-            if 'lat' in device and 'lng' in device:
-                location = self.geolocator.reverse((device['lat'], device['lng']), exactly_one=True)
-                address = location.raw.get('address', {})
-                device['country'] = address.get('country', 'Unknown')
-                device['city'] = address.get('city', 'Unknown')
-                device['state'] = address.get('state', 'Unknown')
-                device['postcode'] = address.get('postcode', 'Unknown')
-
-        return devices
-    
+        return self.add_locations(devices)
+
+    def get_organization_devices(self):
+        """Get all devices of the organization in a single paginated listing."""
+        url = f"{self.base_url}/organizations/{self.org_id}/devices"
+        params = {'perPage': DEVICES_PER_PAGE}
+        logging.info(f"Fetching organization devices from {url}")
+        return self.fetch_data_with_pagination(url, params, checkpoint=True)
+
+    def get_organization_ssid_statuses(self):
+        """Get the SSIDs broadcast by every access point of the organization."""
+        url = f"{self.base_url}/organizations/{self.org_id}/wireless/ssids/statuses/byDevice"
+        params = {'perPage': SSID_STATUSES_PER_PAGE}
+        logging.info(f"Fetching organization SSID statuses from {url}")
+        return self.fetch_data_with_pagination(url, params, items_key='items')
+
+    def get_configuration_changes(self, t0):
+        """Get the organization configuration changes made since t0."""
+        url = f"{self.base_url}/organizations/{self.org_id}/configurationChanges"
+        params = {'t0': t0, 'perPage': CONFIGURATION_CHANGES_PER_PAGE}
+        logging.info(f"Fetching configuration changes since {t0}")
+        return self.fetch_data_with_pagination(url, params)
+
+    def reverse_geocode(self, lat, lng):
+        """Return the address of the coordinates, None if they could not be geocoded."""
+        return self.geocoder.reverse(lat, lng)
+
+    def add_location(self, device, address=None):
+        """Add the address fields of the device coordinates."""
+        if device.has_coordinates:
+            if address is None:
+                address = self.reverse_geocode(device.lat, device.lng)
+            apply_address(device, address)
+        return device
+
+    def add_locations(self, devices):
+        """Resolve each distinct quantized coordinate once and fan it out to every device sharing it."""
+        if self.geocoder is None:
+            return devices
+        return self.geocoder.locate(devices)
+
     def get_ssids(self, network_id):
         """Get SSIDs for a given wireless network."""
         url = f"{self.base_url}/networks/{network_id}/wireless/ssids"
         logging.info(f"Fetching SSIDs for network {network_id}")
-        try:
-            ssids = self.fetch_data_with_pagination(url)
-            logging.debug(f"Fetched SSIDs for network {network_id}: {ssids}")
-            return ssids
-        except Exception as e:
-            logging.error(f"Failed to fetch SSIDs for network {network_id}: {e}")
-            return []
+        ssids = self.fetch_data_with_pagination(url)
+        logging.debug(f"Fetched SSIDs for network {network_id}: {ssids}")
+        return ssids
 
     def fetch_network_details(self, network, last_fetch_time):
-        """Fetch devices and SSIDs for a given network and return a combined structure."""
-        network_id = network['id']
-        network_type = network.get('productTypes', [])
+        """Build the combined devices and SSIDs structure for a given network."""
+        network_id = network.id
         network_data = {
             'network': network,
             'devices': [],
             'ssids': []
         }
         try:
-            # Fetch devices
-            devices = self.get_devices(network_id)
+            # Devices come from the organization-wide listing fetched once per run
+            devices = self.planner.get_network_devices(network_id)
             network_data['devices'] = devices
 
             # Fetch SSIDs if it's a wireless network
-            if 'wireless' in network_type:
-                ssids = self.get_ssids(network_id)
+            if network.wireless:
+                ssids = self.planner.get_ssids(network_id)
                 if not ssids:
                     logging.warning(f"No SSIDs found for wireless network {network_id}")
                 network_data['ssids'] = ssids
                 logging.debug(f"Fetched SSIDs for network {network_id}: {ssids}")
 
+            # A network whose SSIDs failed is fetched again on resume
+            if not self.planner.ssids_failed(network_id):
+                self.journal.record_network(network_id, network_data)
+
         except Exception as e:
             logging.error(f"An error occurred while fetching details for network {network_id}: {e}")
         
         return network_data
 
+    def iter_network_details(self, networks, last_fetch_time):
+        """Yield (network_id, network_data) pairs as each network completes."""
+        for network in networks:
+            network_data = self.journal.get_network(network.id)
+            if network_data is None:
+                network_data = self.fetch_network_details(network, last_fetch_time)
+            yield network.id, parse_network_data(network_data)
+
     def fetch_all_network_details(self, networks, last_fetch_time):
         """Fetch devices and SSIDs for multiple networks without batching."""
-        networks_data = {}
-        for network in networks:
-            network_data = self.fetch_network_details(network, last_fetch_time)
-            networks_data[network['id']] = network_data
-        return networks_data
+        return dict(self.iter_network_details(networks, last_fetch_time))
 
     def fetch_extra_data(self):
         create_directories()  # Ensure directories are created
-        last_fetch_time = load_last_fetch_time()
+        last_fetch_time = load_last_fetch_time(self.last_fetch_file)
         try:
             # Fetch networks
-            networks = self.get_networks()
-            save_to_json(networks, 'networks.json')
+            networks = self.planner.get_networks()
 
             # Fetch devices location details
-            all_devices = []
-            for network in networks:
-                devices = self.get_devices(network['id'])
-                all_devices.extend(devices)
-
-            save_to_json(all_devices, 'devices_with_location.json')
-
-            # Fetch devices and SSIDs for each network
-            networks_data = self.fetch_all_network_details(networks, last_fetch_time)
-            save_to_json(networks_data, 'networks_devices_ssids.json')
-            
-            # Save the aggregated data
-            save_to_json(networks_data, 'networks_devices_ssids.json')
-            
+            self.planner.get_devices()
+
+            # Build devices and SSIDs for each network; only the changed ones are rewritten in the inventory
+            changed = self.planner.get_changed_network_ids() if self.planner.state is not None else None
+            inventory.save_networks(self.org_id, self.iter_network_details(networks, last_fetch_time), changed)
+
+            if EXPORT_JSON:
+                self.export_json(networks)
+
+            # Record the fingerprints the next incremental run compares against
+            if self.planner.state is not None:
+                self.planner.state.save()
+
             # Update the last fetch time
-            save_last_fetch_time()
+            save_last_fetch_time(self.started_at, self.last_fetch_file)
+
+            # The outputs are saved, nothing left to resume
+            self.journal.complete()
 
         except Exception as e:
             logging.error(f"An error occurred: {e}")
             return False  # Indicate failure
         return True  # Indicate success
 
+    def export_json(self, networks):
+        """Export the networks, devices and per-network inventory of the organization to the JSON result files."""
+        save_to_json(networks, 'networks.json', self.data_dir)
+        inventory.export_json(self.org_id, self.data_dir)
+
 if __name__ == "__main__":
+    configure_logging()
     logging.info("Starting Meraki Dashboard data fetching script")
     fetcher = MerakiFetcher()
     fetcher.fetch_extra_data()
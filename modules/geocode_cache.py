@@ -0,0 +1,84 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from .config import GEOCODE_CACHE_FILE, GEOCODE_PRECISION, GEOCODE_CACHE_TTL, GEOCODE_LRU_SIZE
+
+class GeocodeCache:
+    """Persistent reverse geocoding cache keyed by quantized coordinates.
+
+    Addresses are stored in a SQLite file that survives across runs, with an
+    in-process LRU in front of it. Entries older than the TTL are evicted,
+    and ignored by both the LRU and the SQLite lookups of a long-lived process.
+    """
+
+    def __init__(self, path=GEOCODE_CACHE_FILE, precision=GEOCODE_PRECISION, ttl=GEOCODE_CACHE_TTL, lru_size=GEOCODE_LRU_SIZE):
+        self.precision = precision
+        self.ttl = ttl
+        self.lru_size = lru_size
+        self.lru = OrderedDict()  # (address, fetched_at) by key
+        self.lock = threading.Lock()  # Shared by the organizations of a multi-organization sync
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)  # Used from the pipeline geocoding thread
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS geocodes ("
+            "lat REAL NOT NULL, lng REAL NOT NULL, address TEXT NOT NULL, fetched_at REAL NOT NULL, "
+            "PRIMARY KEY (lat, lng))"
+        )
+        self.evict_expired()
+
+    def key(self, lat, lng):
+        """Round coordinates to the configured precision."""
+        return round(float(lat), self.precision), round(float(lng), self.precision)
+
+    def get(self, lat, lng):
+        """Return the cached address for the coordinates, or None on a miss."""
+        key = self.key(lat, lng)
+        expires_before = time.time() - self.ttl
+        with self.lock:
+            if key in self.lru:
+                address, fetched_at = self.lru[key]
+                if fetched_at >= expires_before:
+                    self.lru.move_to_end(key)
+                    return address
+                del self.lru[key]
+            row = self.conn.execute(
+                "SELECT address, fetched_at FROM geocodes WHERE lat = ? AND lng = ? AND fetched_at >= ?",
+                (*key, expires_before)
+            ).fetchone()
+            if row is None:
+                return None
+            address = json.loads(row[0])
+            self._remember(key, address, row[1])
+            return address
+
+    def set(self, lat, lng, address):
+        """Store the address for the coordinates."""
+        key = self.key(lat, lng)
+        fetched_at = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO geocodes (lat, lng, address, fetched_at) VALUES (?, ?, ?, ?)",
+                (*key, json.dumps(address), fetched_at)
+            )
+            self.conn.commit()
+            self._remember(key, address, fetched_at)
+
+    def evict_expired(self):
+        """Delete entries older than the TTL."""
+        deleted = self.conn.execute("DELETE FROM geocodes WHERE fetched_at < ?", (time.time() - self.ttl,)).rowcount
+        self.conn.commit()
+        if deleted:
+            logging.info(f"Evicted {deleted} expired geocode cache entries")
+
+    def close(self):
+        self.conn.close()
+
+    def _remember(self, key, address, fetched_at):
+        self.lru[key] = (address, fetched_at)
+        self.lru.move_to_end(key)
+        if len(self.lru) > self.lru_size:
+            self.lru.popitem(last=False)
@@ -0,0 +1,266 @@
+import sys
+import csv
+import math
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .config import (USER_AGENT, NOMINATIM_DOMAIN, NOMINATIM_SCHEME, GEOCODER_BACKEND, GEOCODER_RATE_LIMIT,
+                     GEOCODER_WORKERS, GEOCODER_TIMEOUT, OFFLINE_GEOCODER_DATASET)
+from .geocode_cache import GeocodeCache
+from .common import configure_logging
+from .metrics import metrics
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:  # The pure Python KDTree below is used instead
+    cKDTree = None
+
+# Address fields copied to devices, named as in Nominatim addresses and the offline dataset
+ADDRESS_FIELDS = ('country', 'city', 'state', 'postcode')
+GEOCODE_ATTEMPTS = 3
+
+def apply_address(device, address):
+    """Add the address fields to a device, 'Unknown' for those the address lacks.
+
+    A failed lookup (address None) leaves the fields None, so the device is
+    geocoded again by locate_inventory.
+    """
+    for field in ADDRESS_FIELDS:
+        setattr(device, field, address.get(field, 'Unknown') if address is not None else None)
+    return device
+
+def to_xyz(lat, lng):
+    """Map coordinates to a point of the unit sphere, where straight-line nearest is great-circle nearest."""
+    lat, lng = math.radians(float(lat)), math.radians(float(lng))
+    return (math.cos(lat) * math.cos(lng), math.cos(lat) * math.sin(lng), math.sin(lat))
+
+class KDTree:
+    """Nearest neighbour index over 3D points, used when scipy is not installed."""
+
+    def __init__(self, points):
+        self.points = points
+        self.root = self._build(list(range(len(points))), 0)
+
+    def _build(self, indexes, depth):
+        if not indexes:
+            return None
+        axis = depth % 3
+        indexes.sort(key=lambda i: self.points[i][axis])
+        median = len(indexes) // 2
+        return (indexes[median], axis, self._build(indexes[:median], depth + 1), self._build(indexes[median + 1:], depth + 1))
+
+    def query(self, point):
+        """Return (distance, index) of the nearest point."""
+        best = [float('inf'), None]
+
+        def search(node):
+            if node is None:
+                return
+            index, axis, left, right = node
+            candidate = self.points[index]
+            distance = sum((a - b) ** 2 for a, b in zip(candidate, point))
+            if distance < best[0]:
+                best[:] = [distance, index]
+            diff = point[axis] - candidate[axis]
+            near, far = (left, right) if diff < 0 else (right, left)
+            search(near)
+            if diff * diff < best[0]:
+                search(far)
+
+        search(self.root)
+        return math.sqrt(best[0]), best[1]
+
+class NominatimBackend:
+    """Reverse geocoding through the public Nominatim server or a self-hosted one."""
+
+    remote = True  # Rate limited, cached and resolved by a worker pool
+
+    def __init__(self, domain=NOMINATIM_DOMAIN, scheme=NOMINATIM_SCHEME, user_agent=USER_AGENT, timeout=GEOCODER_TIMEOUT):
+        from geopy.geocoders import Nominatim  # Loaded with the backend, the offline one does without geopy
+        self.geolocator = Nominatim(user_agent=user_agent, domain=domain, scheme=scheme, timeout=timeout)
+        self.url = f"{scheme}://{domain}/reverse"  # Endpoint the geocoding metrics are recorded under
+
+    def reverse(self, lat, lng):
+        """Return the address of the coordinates; empty when Nominatim has none (e.g. at sea)."""
+        started = time.monotonic()
+        try:
+            location = self.geolocator.reverse((lat, lng), exactly_one=True)
+        except Exception:
+            metrics.record('GET', self.url, 'error', time.monotonic() - started)
+            raise
+        metrics.record('GET', self.url, 200, time.monotonic() - started)
+        return location.raw.get('address', {}) if location is not None else {}
+
+class OfflineBackend:
+    """Reverse geocoding from a local postcode dataset, without any network call.
+
+    The dataset is a CSV file with lat, lng, country and optional postcode,
+    city and state columns; each coordinate resolves to its nearest row.
+    """
+
+    remote = False
+
+    def __init__(self, dataset=OFFLINE_GEOCODER_DATASET):
+        points = []
+        self.addresses = []
+        with open(dataset, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                points.append(to_xyz(row['lat'], row['lng']))
+                self.addresses.append({field: row[field] for field in ADDRESS_FIELDS if row.get(field)})
+        self.tree = cKDTree(points) if cKDTree is not None else KDTree(points)
+        logging.info(f"Loaded {len(points)} places from the offline geocoder dataset {dataset}")
+
+    def reverse(self, lat, lng):
+        _, index = self.tree.query(to_xyz(lat, lng))
+        return dict(self.addresses[index])
+
+def create_backend(name=GEOCODER_BACKEND):
+    """Return the geocoder backend configured by GEOCODER_BACKEND."""
+    if name == 'offline':
+        return OfflineBackend()
+    if name == 'nominatim':
+        return NominatimBackend()
+    raise ValueError(f"Unknown geocoder backend {name}, expected nominatim or offline")
+
+class RateLimiter:
+    """Space calls at least 1 / rate seconds apart across threads."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_at = 0
+
+    def wait(self):
+        """Block until the next call is allowed and return the time waited."""
+        with self.lock:
+            now = time.monotonic()
+            delay = max(0, self.next_at - now)
+            self.next_at = max(now, self.next_at) + self.interval
+        if delay:
+            time.sleep(delay)
+        return delay
+
+class GeocodingStage:
+    """Resolve the distinct coordinates of a batch of devices.
+
+    Coordinates are quantized and deduplicated across the batch, cached
+    addresses are reused, and the rest go to the backend through a worker
+    pool that respects its rate limit. A failed lookup leaves the devices
+    without an address instead of aborting the batch; the geocode phase or
+    the next run retries them.
+    """
+
+    def __init__(self, backend=None, cache=None, workers=GEOCODER_WORKERS, rate=GEOCODER_RATE_LIMIT):
+        self.backend = backend if backend is not None else create_backend()
+        self.cache = cache if cache is not None else GeocodeCache()  # Addresses persisted across runs
+        self.workers = workers if self.backend.remote else 1  # Offline lookups are CPU bound
+        self.limiter = RateLimiter(rate if self.backend.remote else 0)
+
+    def key(self, lat, lng):
+        return self.cache.key(lat, lng)
+
+    def resolve(self, keys):
+        """Return the address of each quantized coordinate, None for failed lookups."""
+        addresses = {}
+        missing = []
+        for key in set(keys):
+            address = self.cache.get(*key) if self.backend.remote else None
+            if address is None:
+                missing.append(key)
+            else:
+                addresses[key] = address
+        if not missing:
+            return addresses
+
+        logging.info(f"Geocoding {len(missing)} locations ({len(addresses)} cached) with {self.workers} workers")
+        if self.workers > 1 and len(missing) > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                results = list(executor.map(self.lookup, missing))
+        else:
+            results = [self.lookup(key) for key in missing]
+
+        failures = 0
+        for key, address in zip(missing, results):
+            addresses[key] = address
+            if address is None:
+                failures += 1
+            elif self.backend.remote:
+                self.cache.set(*key, address)  # Written from this thread only
+        if failures:
+            logging.warning(f"Failed to geocode {failures} of {len(missing)} locations")
+        return addresses
+
+    def lookup(self, key):
+        """Reverse geocode one coordinate, retrying transient errors."""
+        for attempt in range(GEOCODE_ATTEMPTS):
+            if self.backend.remote:
+                metrics.record_sleep('GET', self.backend.url, self.limiter.wait())
+            try:
+                return self.backend.reverse(*key)
+            except Exception as e:
+                logging.warning(f"Geocoding {key} failed (attempt {attempt + 1}/{GEOCODE_ATTEMPTS}): {e}")
+                if attempt + 1 < GEOCODE_ATTEMPTS:
+                    from .http_client import backoff_delay
+                    time.sleep(backoff_delay(attempt))
+        return None
+
+    def reverse(self, lat, lng):
+        """Return the address of a single coordinate."""
+        key = self.key(lat, lng)
+        return self.resolve([key])[key]
+
+    def locate(self, devices):
+        """Add the address fields to every device with coordinates."""
+        devices_by_key = {}
+        for device in devices:
+            if device.has_coordinates:
+                devices_by_key.setdefault(self.key(device.lat, device.lng), []).append(device)
+        logging.debug(f"Resolving {len(devices_by_key)} distinct locations for {len(devices)} devices")
+        addresses = self.resolve(devices_by_key)
+        for key, located_devices in devices_by_key.items():
+            for device in located_devices:
+                apply_address(device, addresses[key])
+        return devices
+
+    def locate_inventory(self, store, org_id):
+        """Geocode the devices of an organization that a fetch without geocoding left without an address.
+
+        Return the number of devices located; only their networks are rewritten.
+        """
+        pending = store.unlocated_network_ids(org_id)
+        if not pending:
+            return 0
+        records = [(network_id, network_data) for network_id, network_data in store.iter_network_records([org_id]) if network_id in pending]
+        devices = [device for _, network_data in records for device in network_data['devices'] if device.has_coordinates and device.country is None]
+        self.locate(devices)
+        store.save_networks(org_id, records, complete=False)
+        return len(devices)
+
+def convert_geonames(postal_codes_file, country_info_file, output_file):
+    """Build an offline geocoder dataset from the GeoNames postal code and countryInfo dumps."""
+    country_names = {}
+    with open(country_info_file, encoding='utf-8') as f:
+        for line in f:
+            if not line.startswith('#'):
+                columns = line.rstrip('\n').split('\t')
+                if len(columns) > 4:
+                    country_names[columns[0]] = columns[4]
+
+    count = 0
+    with open(postal_codes_file, encoding='utf-8') as source, open(output_file, 'w', newline='', encoding='utf-8') as target:
+        writer = csv.writer(target)
+        writer.writerow(['lat', 'lng', 'country', 'postcode', 'city', 'state'])
+        for line in source:
+            columns = line.rstrip('\n').split('\t')
+            if len(columns) < 11 or not columns[9] or not columns[10]:
+                continue
+            writer.writerow([columns[9], columns[10], country_names.get(columns[0], columns[0]), columns[1], columns[2], columns[3]])
+            count += 1
+    logging.info(f"Wrote {count} places to {output_file}")
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4:
+        sys.exit("Usage: python -m modules.geocoding <allCountries.txt> <countryInfo.txt> <output.csv>")
+    configure_logging()
+    convert_geonames(*sys.argv[1:])
@@ -0,0 +1,60 @@
+import asyncio
+import requests
+import aiohttp
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .config import HTTP_POOL_SIZE, HTTP_MAX_RETRIES, HTTP_BACKOFF_FACTOR, HTTP_BACKOFF_MAX, HTTP_KEEPALIVE_TIMEOUT
+from .metrics import metrics
+
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+def backoff_delay(attempt):
+    """Seconds to wait before retry number attempt (from 0), shared by the sync and async clients."""
+    return min(HTTP_BACKOFF_FACTOR * 2 ** attempt, HTTP_BACKOFF_MAX)
+
+def create_session():
+    """Create a requests session with pooled keep-alive connections and the shared retry policy."""
+    retry_strategy = Retry(
+        total=HTTP_MAX_RETRIES,
+        backoff_factor=HTTP_BACKOFF_FACTOR,
+        backoff_max=HTTP_BACKOFF_MAX,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=["HEAD", "GET", "OPTIONS", "POST"],
+        raise_on_status=False  # Hand the last response to the caller's own error handling
+    )
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry_strategy)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    session.hooks['response'].append(metrics.record_response)
+    return session
+
+# Shared by every synchronous HTTP call of the run
+http = create_session()
+
+_async_session = None
+
+def async_session():
+    """Return the aiohttp session shared by the coroutines of the running event loop.
+
+    The session keeps its connections alive between phases; a new one is
+    created when the previous one was closed or belongs to another loop.
+    """
+    global _async_session
+    loop = asyncio.get_running_loop()
+    if _async_session is None or _async_session.closed or _async_session._loop is not loop:
+        connector = aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT)
+        _async_session = aiohttp.ClientSession(
+            connector=connector,
+            headers={'Accept-Encoding': 'gzip, deflate'},
+            trace_configs=[metrics.trace_config()]
+        )
+    return _async_session
+
+async def close_async_session():
+    """Close the shared aiohttp session, if any."""
+    global _async_session
+    if _async_session is not None and not _async_session.closed:
+        await _async_session.close()
+    _async_session = None
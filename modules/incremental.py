@@ -0,0 +1,96 @@
+import json
+import time
+import hashlib
+import logging
+from .config import MERAKI_ORG_ID, FINGERPRINTS_FILE
+from .common import write_json_atomic
+from .models import encode
+from .inventory import inventory
+
+# Meraki keeps one year of configuration changes
+CHANGE_LOG_MAX_AGE = 365 * 24 * 3600
+
+def fingerprint(data):
+    """Return a stable hash of JSON-serializable data."""
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=encode).encode()).hexdigest()
+
+class IncrementalState:
+    """Decide which networks changed since the last fetch and carry the others forward.
+
+    A network is re-fetched when it is new, when its network or device fingerprint
+    differs from the previous run, or when it appears in the organization change log.
+    The previous fetch is read from the inventory store.
+    """
+
+    def __init__(self, last_fetch_time, org_id=MERAKI_ORG_ID, fingerprints_file=FINGERPRINTS_FILE, store=inventory):
+        self.last_fetch_time = last_fetch_time
+        self.org_id = org_id
+        self.fingerprints_file = fingerprints_file
+        self.store = store
+        self.previous = set()  # IDs of the networks of the previous fetch
+        self.fingerprints = {}
+        self.new_fingerprints = {}
+        if last_fetch_time and time.time() - last_fetch_time < CHANGE_LOG_MAX_AGE:
+            self.previous = store.network_ids(org_id)
+            self.fingerprints = self._load(fingerprints_file)
+        if not self.previous:
+            logging.info("No usable previous fetch, running a full sync")
+
+    @property
+    def change_log_t0(self):
+        """Return the change log start time, or None when a full sync is needed."""
+        if not self.previous:
+            return None
+        return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.last_fetch_time))
+
+    def changed_network_ids(self, networks, devices, configuration_changes):
+        """Return the IDs of the networks that must be re-fetched."""
+        devices_by_network = {}
+        for device in devices:
+            devices_by_network.setdefault(device.network_id, []).append(device)
+
+        self.new_fingerprints = {
+            network.id: {
+                'network': fingerprint(network),
+                'devices': fingerprint(devices_by_network.get(network.id, []))
+            }
+            for network in networks
+        }
+        if not self.previous:
+            return set(self.new_fingerprints)
+
+        changed = {
+            network_id for network_id, network_fingerprint in self.new_fingerprints.items()
+            if network_id not in self.previous or self.fingerprints.get(network_id) != network_fingerprint
+        }
+        changed.update(change['networkId'] for change in configuration_changes if change.get('networkId') in self.new_fingerprints)
+        logging.info(f"{len(changed)} of {len(networks)} networks changed since the last fetch")
+        return changed
+
+    def previous_devices(self):
+        """Return the devices of the previous fetch indexed by serial."""
+        return self.store.devices(self.org_id) if self.previous else {}
+
+    def previous_ssids(self, network_id):
+        """Return the SSIDs of a network from the previous fetch."""
+        return self.store.ssids(network_id) if network_id in self.previous else []
+
+    def retry(self, network_id):
+        """Leave the fingerprint of a network out of the saved ones, so the next run fetches it again."""
+        self.new_fingerprints.pop(network_id, None)
+
+    def save(self):
+        """Persist the fingerprints of the current fetch."""
+        try:
+            write_json_atomic(self.fingerprints_file, self.new_fingerprints)
+            logging.info(f"Fingerprints have been written to {self.fingerprints_file}")
+        except IOError as e:
+            logging.error(f"Failed to write fingerprints to {self.fingerprints_file}: {e}")
+
+    def _load(self, filepath):
+        try:
+            with open(filepath) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError) as e:
+            logging.warning(f"Failed to load {filepath}: {e}")
+            return {}
@@ -0,0 +1,262 @@
+import os
+import json
+import sqlite3
+import itertools
+import logging
+import threading
+from .config import INVENTORY_FILE, STREAM_OUTPUT
+from .common import save_to_json, save_to_ndjson, save_network_records
+from .models import Network, Device, Ssid, encode
+
+# Networks upserted per transaction, so a crawl never holds the write lock for long,
+# and read per query, so a reader's memory stays flat whatever the organization size
+BATCH_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS networks (
+    id TEXT PRIMARY KEY, organization_id TEXT, data TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS networks_organization ON networks (organization_id);
+CREATE TABLE IF NOT EXISTS devices (
+    id INTEGER PRIMARY KEY, serial TEXT, network_id TEXT NOT NULL, mac TEXT, data TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS devices_serial ON devices (serial);
+CREATE INDEX IF NOT EXISTS devices_network ON devices (network_id);
+CREATE INDEX IF NOT EXISTS devices_mac ON devices (mac);
+CREATE TABLE IF NOT EXISTS ssids (
+    network_id TEXT NOT NULL, number INTEGER NOT NULL, data TEXT NOT NULL, PRIMARY KEY (network_id, number));
+CREATE TABLE IF NOT EXISTS locations (
+    id INTEGER PRIMARY KEY, key TEXT NOT NULL, data TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS locations_key ON locations (key);
+CREATE TABLE IF NOT EXISTS pushed_locations (
+    key TEXT PRIMARY KEY, hash TEXT NOT NULL, location_id, name TEXT, pushed_at REAL);
+"""
+
+class InventoryStore:
+    """Local SQLite inventory, the system of record of the sync.
+
+    Holds the networks, devices and SSIDs of every organization, the
+    CloudiFi locations prepared from them and the locations last pushed.
+    Devices are indexed by serial, networkId and MAC, locations by the ID of
+    their network. Writes are batched upserts in WAL mode, so an incremental
+    run only rewrites the networks that changed. The JSON result files are
+    exports of it.
+    """
+
+    def __init__(self, path=INVENTORY_FILE):
+        self.path = path
+        self.lock = threading.Lock()  # Shared by the organizations of a multi-organization sync
+        self.conn = None
+
+    def connect(self):
+        """Open the inventory file on first use; call with the lock held."""
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript(SCHEMA)
+        return self.conn
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    def save_networks(self, org_id, networks_data, changed=None, complete=True):
+        """Upsert (network_id, network_data) pairs of an organization in batched transactions.
+
+        Networks outside changed (when given) are already up to date and only
+        kept. With complete, networks of the organization that were not
+        produced are deleted with their devices and SSIDs.
+        """
+        seen = set()
+        batch = []
+        written = 0
+        for network_id, network_data in networks_data:
+            seen.add(network_id)
+            if changed is None or network_id in changed:
+                batch.append((network_id, network_data))
+            if len(batch) >= BATCH_SIZE:
+                written += self._write_networks(org_id, batch)
+                batch = []
+        written += self._write_networks(org_id, batch)
+        deleted = self._delete_missing_networks(org_id, seen) if complete else 0
+        logging.info(f"Inventory of organization {org_id}: {written} networks written, {len(seen) - written} unchanged, {deleted} deleted")
+
+    def organization_ids(self):
+        with self.lock:
+            rows = self.connect().execute("SELECT DISTINCT organization_id FROM networks ORDER BY organization_id").fetchall()
+        return [row[0] for row in rows]
+
+    def network_ids(self, org_id):
+        with self.lock:
+            rows = self.connect().execute("SELECT id FROM networks WHERE organization_id = ?", (str(org_id),)).fetchall()
+        return {row[0] for row in rows}
+
+    def unlocated_network_ids(self, org_id):
+        """Return the networks of an organization with devices that have coordinates but no address yet."""
+        with self.lock:
+            rows = self.connect().execute(
+                "SELECT DISTINCT devices.network_id FROM devices JOIN networks ON networks.id = devices.network_id "
+                "WHERE networks.organization_id = ? AND json_extract(devices.data, '$.lat') IS NOT NULL "
+                "AND json_extract(devices.data, '$.lng') IS NOT NULL AND json_extract(devices.data, '$.country') IS NULL", (str(org_id),)
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def devices(self, org_id):
+        """Return the devices of an organization indexed by serial."""
+        with self.lock:
+            rows = self.connect().execute(
+                "SELECT devices.data FROM devices JOIN networks ON networks.id = devices.network_id "
+                "WHERE networks.organization_id = ? AND devices.serial IS NOT NULL", (str(org_id),)
+            ).fetchall()
+        devices = (Device.from_dict(json.loads(row[0])) for row in rows)
+        return {device.serial: device for device in devices}
+
+    def ssids(self, network_id):
+        with self.lock:
+            rows = self.connect().execute("SELECT data FROM ssids WHERE network_id = ? ORDER BY number", (network_id,)).fetchall()
+        return [Ssid.from_dict(json.loads(row[0])) for row in rows]
+
+    def iter_network_records(self, org_ids=None):
+        """Yield the (network_id, network_data) pairs of the given organizations, or of every organization.
+
+        Networks are read BATCH_SIZE at a time with their devices and SSIDs,
+        and the lock is released between batches.
+        """
+        where, params = '', ()
+        if org_ids is not None:
+            org_ids = [str(org_id) for org_id in org_ids]
+            where, params = f"AND organization_id IN ({', '.join('?' * len(org_ids))})", tuple(org_ids)
+        last_rowid = 0
+        while True:
+            with self.lock:
+                conn = self.connect()
+                networks = conn.execute(
+                    f"SELECT rowid, id, data FROM networks WHERE rowid > ? {where} ORDER BY rowid LIMIT ?", (last_rowid, *params, BATCH_SIZE)
+                ).fetchall()
+                if not networks:
+                    return
+                network_ids = [network_id for _, network_id, _ in networks]
+                placeholders = ', '.join('?' * len(network_ids))
+                devices = conn.execute(f"SELECT network_id, data FROM devices WHERE network_id IN ({placeholders}) ORDER BY id", network_ids).fetchall()
+                ssids = conn.execute(f"SELECT network_id, data FROM ssids WHERE network_id IN ({placeholders}) ORDER BY network_id, number", network_ids).fetchall()
+            devices_by_network = {}
+            for network_id, data in devices:
+                devices_by_network.setdefault(network_id, []).append(Device.from_dict(json.loads(data)))
+            ssids_by_network = {}
+            for network_id, data in ssids:
+                ssids_by_network.setdefault(network_id, []).append(Ssid.from_dict(json.loads(data)))
+            for _, network_id, data in networks:
+                yield network_id, {
+                    'network': Network.from_dict(json.loads(data)),
+                    'devices': devices_by_network.get(network_id, []),
+                    'ssids': ssids_by_network.get(network_id, [])
+                }
+            last_rowid = networks[-1][0]
+
+    def export_json(self, org_id, directory):
+        """Export the devices and per-network records of an organization to the JSON result files."""
+        if STREAM_OUTPUT:
+            # Two passes over the inventory rather than one list of the whole organization
+            save_to_ndjson(
+                (device for _, network_data in self.iter_network_records([org_id]) for device in network_data['devices']),
+                'devices_with_location.json', directory
+            )
+            save_network_records(self.iter_network_records([org_id]), 'networks_devices_ssids.json', directory)
+        else:
+            records = list(self.iter_network_records([org_id]))
+            devices = [device for _, network_data in records for device in network_data['devices']]
+            save_to_json(devices, 'devices_with_location.json', directory)
+            save_to_json(dict(records), 'networks_devices_ssids.json', directory)
+
+    def replace_locations(self, locations):
+        """Store the prepared (network_id, location_data) pairs in place of the previous ones.
+
+        The locations are inserted BATCH_SIZE at a time in a single transaction.
+        Between batches the lock is released, because the locations may be
+        mapped from the inventory's own records.
+        """
+        rows = ((network_id, json.dumps(location_data, default=encode)) for network_id, location_data in locations)
+        with self.lock:
+            conn = self.connect()
+            conn.execute("DELETE FROM locations")  # Opens the transaction, committed once every batch is in
+        count = 0
+        try:
+            while True:
+                batch = list(itertools.islice(rows, BATCH_SIZE))
+                if not batch:
+                    break
+                with self.lock:
+                    conn.executemany("INSERT INTO locations (key, data) VALUES (?, ?)", batch)
+                count += len(batch)
+        except BaseException:
+            with self.lock:
+                conn.rollback()
+            raise
+        with self.lock:
+            conn.commit()
+        return count
+
+    def iter_locations(self):
+        """Yield the prepared (network_id, location_data) pairs in the order they were prepared."""
+        with self.lock:
+            rows = self.connect().execute("SELECT key, data FROM locations ORDER BY id").fetchall()
+        for key, data in rows:
+            yield key, json.loads(data)
+
+    def pushed_locations(self):
+        """Return the pushed location entries ({hash, id, name, pushed_at}) by key."""
+        with self.lock:
+            rows = self.connect().execute("SELECT key, hash, location_id, name, pushed_at FROM pushed_locations").fetchall()
+        return {key: {'hash': hash, 'id': location_id, 'name': name, 'pushed_at': pushed_at} for key, hash, location_id, name, pushed_at in rows}
+
+    def save_pushed_locations(self, entries, forgotten=()):
+        """Upsert the given pushed location entries and delete the forgotten keys in one transaction."""
+        with self.lock:
+            conn = self.connect()
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO pushed_locations (key, hash, location_id, name, pushed_at) VALUES (?, ?, ?, ?, ?)",
+                    ((key, entry['hash'], entry.get('id'), entry.get('name'), entry.get('pushed_at')) for key, entry in entries.items())
+                )
+                conn.executemany("DELETE FROM pushed_locations WHERE key = ?", ((key,) for key in forgotten))
+
+    def _write_networks(self, org_id, batch):
+        if not batch:
+            return 0
+        with self.lock:
+            conn = self.connect()
+            with conn:
+                for network_id, network_data in batch:
+                    conn.execute(
+                        "INSERT INTO networks (id, organization_id, data) VALUES (?, ?, ?) "
+                        "ON CONFLICT (id) DO UPDATE SET organization_id = excluded.organization_id, data = excluded.data",
+                        (network_id, str(org_id), json.dumps(network_data['network'], default=encode))
+                    )
+                    conn.execute("DELETE FROM devices WHERE network_id = ?", (network_id,))
+                    conn.executemany(
+                        "INSERT INTO devices (serial, network_id, mac, data) VALUES (?, ?, ?, ?)",
+                        ((device.serial, network_id, (device.mac or '').lower() or None, json.dumps(device, default=encode)) for device in network_data['devices'])
+                    )
+                    conn.execute("DELETE FROM ssids WHERE network_id = ?", (network_id,))
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO ssids (network_id, number, data) VALUES (?, ?, ?)",
+                        ((network_id, ssid.number, json.dumps(ssid, default=encode)) for ssid in network_data['ssids'])
+                    )
+        return len(batch)
+
+    def _delete_missing_networks(self, org_id, network_ids):
+        with self.lock:
+            conn = self.connect()
+            with conn:
+                missing = [
+                    (network_id,) for (network_id,) in conn.execute("SELECT id FROM networks WHERE organization_id = ?", (str(org_id),))
+                    if network_id not in network_ids
+                ]
+                for statement in ("DELETE FROM devices WHERE network_id = ?", "DELETE FROM ssids WHERE network_id = ?", "DELETE FROM networks WHERE id = ?"):
+                    conn.executemany(statement, missing)
+        return len(missing)
+
+# Shared by every stage of the run
+inventory = InventoryStore()
@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import time
+import aiohttp
+from .config import (MERAKI_BASE_URL, MERAKI_ORG_ID, HEADERS, MERAKI_RATE_LIMIT, MERAKI_CONCURRENCY, HTTP_MAX_RETRIES, ORGANIZATIONS_PER_PAGE,
+                     NETWORKS_PER_PAGE, DEVICES_PER_PAGE, SSID_STATUSES_PER_PAGE, CONFIGURATION_CHANGES_PER_PAGE)
+from .metrics import metrics
+from .http_client import async_session, backoff_delay
+from .response_cache import response_cache
+
+class MerakiAsyncError(Exception):
+    """Custom exception for errors raised by the async Meraki client."""
+    pass
+
+class TokenBucket:
+    """Organization-wide token bucket pacing requests to the Meraki rate limit."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Wait until a request may be sent without exceeding the rate limit."""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Stop handing out tokens for the given number of seconds.
+
+        The bucket restarts empty and refills at rate once the pause ends, so
+        no burst goes out the moment Retry-After expires.
+        """
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+        self.updated = self.paused_until
+
+class AsyncMerakiClient:
+    """Asyncio Meraki client with a bounded worker pool and a shared token bucket."""
+
+    def __init__(self, org_id=MERAKI_ORG_ID, rate=MERAKI_RATE_LIMIT, concurrency=MERAKI_CONCURRENCY, max_retries=HTTP_MAX_RETRIES, journal=None):
+        self.base_url = MERAKI_BASE_URL
+        self.org_id = org_id
+        self.headers = {key: value for key, value in HEADERS.items() if value is not None}
+        self.bucket = TokenBucket(rate)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.max_retries = max_retries
+        self.journal = journal  # Optional CheckpointJournal for resumable listings
+        self.session = None
+
+    async def __aenter__(self):
+        self.session = async_session()  # Pooled connections are kept for the next phase
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.session = None
+
+    def check_api_limits(self, response):
+        """Pause the token bucket when the response reports an exhausted rate limit."""
+        if 'X-Rate-Limit-Remaining' in response.headers and int(response.headers['X-Rate-Limit-Remaining']) == 0:
+            reset_time = int(response.headers.get('X-Rate-Limit-Reset', 1))
+            sleep_time = reset_time - time.time()
+            if sleep_time > 0:
+                logging.warning(f"API limit reached. Pausing requests for {sleep_time} seconds.")
+                self.bucket.pause(sleep_time)
+
+    async def fetch_page(self, url, params=None):
+        """Fetch a single page and return its data with the URL of the next page."""
+        page = response_cache.lookup(url, params)
+        if page is not None and page.fresh:
+            return response_cache.hit(url, page)
+        headers = {**self.headers, **response_cache.validators(page)}
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                metrics.record_retry('GET', url)
+            waiting_since = time.monotonic()
+            await self.bucket.acquire()
+            metrics.record_sleep('GET', url, time.monotonic() - waiting_since)
+            delay = 0
+            async with self.semaphore:
+                try:
+                    async with self.session.get(url, headers=headers, params=params) as response:
+                        self.check_api_limits(response)
+                        if response.status == 429:
+                            retry_after = float(response.headers.get('Retry-After', 1))
+                            logging.warning(f"Rate limit reached. Retrying after {retry_after} seconds.")
+                            self.bucket.pause(retry_after)
+                            continue
+                        if response.status in [500, 502, 503, 504]:
+                            delay = backoff_delay(attempt)
+                            logging.warning(f"Server error {response.status} for {url}. Retrying in {delay} seconds.")
+                        else:
+                            response.raise_for_status()
+                            next_url = response.links.get('next', {}).get('url')
+                            return response_cache.update(
+                                url, params, page, response.status, response.headers, await response.read(), str(next_url) if next_url else None
+                            )
+                except aiohttp.ClientResponseError as e:
+                    logging.error(f"HTTP error occurred while fetching data from {url}: {e}")
+                    raise MerakiAsyncError(f"API error: {e}") from e
+                except aiohttp.ClientError as e:
+                    delay = backoff_delay(attempt)
+                    logging.warning(f"Request error for {url}: {e}. Retrying in {delay} seconds.")
+            metrics.record_sleep('GET', url, delay, 'backoff')
+            await asyncio.sleep(delay)
+        raise MerakiAsyncError(f"Giving up on {url} after {self.max_retries} retries")
+
+    async def fetch_data_with_pagination(self, url, params=None, checkpoint=False, items_key=None):
+        """Fetch all pages of a Meraki listing, journaling them when checkpoint is set."""
+        items = []
+        checkpoint = checkpoint and self.journal is not None
+        if checkpoint:
+            key = self.journal.page_key(url, params)
+            items, next_url = self.journal.resume_pages(key, url)
+            if next_url != url:
+                url, params = next_url, None
+        while url:
+            data, url = await self.fetch_page(url, params)
+            params = None  # The next page URL already carries the query string
+            url = str(url) if url else None
+            if items_key is not None:
+                data = data[items_key]
+            items.extend(data)
+            if checkpoint:
+                self.journal.record_page(key, data, url)
+        return items
+
+    async def get_organizations(self):
+        """Get the organizations the API key has access to."""
+        url = f"{self.base_url}/organizations"
+        logging.info(f"Fetching organizations from {url}")
+        return await self.fetch_data_with_pagination(url, {'perPage': ORGANIZATIONS_PER_PAGE})
+
+    async def get_networks(self):
+        """Get networks for the organization."""
+        url = f"{self.base_url}/organizations/{self.org_id}/networks"
+        logging.info(f"Fetching networks from {url}")
+        return await self.fetch_data_with_pagination(url, {'perPage': NETWORKS_PER_PAGE}, checkpoint=True)
+
+    async def get_organization_devices(self):
+        """Get all devices of the organization in a single paginated listing."""
+        url = f"{self.base_url}/organizations/{self.org_id}/devices"
+        logging.info(f"Fetching organization devices from {url}")
+        return await self.fetch_data_with_pagination(url, {'perPage': DEVICES_PER_PAGE}, checkpoint=True)
+
+    async def get_organization_ssid_statuses(self):
+        """Get the SSIDs broadcast by every access point of the organization."""
+        url = f"{self.base_url}/organizations/{self.org_id}/wireless/ssids/statuses/byDevice"
+        logging.info(f"Fetching organization SSID statuses from {url}")
+        return await self.fetch_data_with_pagination(url, {'perPage': SSID_STATUSES_PER_PAGE}, items_key='items')
+
+    async def get_configuration_changes(self, t0):
+        """Get the organization configuration changes made since t0."""
+        url = f"{self.base_url}/organizations/{self.org_id}/configurationChanges"
+        logging.info(f"Fetching configuration changes since {t0}")
+        return await self.fetch_data_with_pagination(url, {'t0': t0, 'perPage': CONFIGURATION_CHANGES_PER_PAGE})
+
+    async def get_ssids(self, network_id):
+        """Get SSIDs for a given wireless network."""
+        url = f"{self.base_url}/networks/{network_id}/wireless/ssids"
+        return await self.fetch_data_with_pagination(url)
@@ -0,0 +1,263 @@
+import os
+import re
+import json
+import time
+import logging
+import threading
+from copy import deepcopy
+from urllib.parse import urlsplit
+from .config import METRICS_FILE, METRICS_PROM_FILE
+
+# Upper bounds of the request latency histogram, in seconds
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+# Path segments followed by a resource ID in the Meraki and CloudiFi APIs
+ID_COLLECTIONS = {'organizations', 'networks', 'devices', 'ssids', 'locations', 'langs', 'countries', 'timezones', 'templates'}
+# Literal path segments that may follow a collection name, e.g. /wireless/ssids/statuses/byDevice
+LITERAL_SEGMENTS = ID_COLLECTIONS | {'statuses', 'byDevice'}
+
+def endpoint_template(url):
+    """Return (host, path template) of a URL, with resource IDs replaced by {id}."""
+    parts = urlsplit(str(url))
+    segments = parts.path.split('/')
+    for i in range(1, len(segments)):
+        if segments[i - 1] in ID_COLLECTIONS and segments[i] and segments[i] not in LITERAL_SEGMENTS:
+            segments[i] = '{id}'
+    return parts.netloc, re.sub(r'/+$', '', '/'.join(segments)) or '/'
+
+def empty_stats():
+    return {
+        'requests': 0,
+        'statuses': {},
+        'latency_sum': 0.0,
+        'latency_buckets': [0] * len(LATENCY_BUCKETS),
+        'bytes': 0,
+        'retries': 0,
+        'rate_limited': 0,
+        'sleep_seconds': {},
+        'cache': {}
+    }
+
+def subtract_stats(current, previous):
+    """Return the endpoint stats recorded between previous and current."""
+    delta = {}
+    for key, value in current.items():
+        before = previous[key]
+        if isinstance(value, dict):
+            delta[key] = {name: count - before.get(name, 0) for name, count in value.items() if count != before.get(name, 0)}
+        elif isinstance(value, list):
+            delta[key] = [count - previous_count for count, previous_count in zip(value, before)]
+        else:
+            delta[key] = value - before
+    return delta
+
+class Metrics:
+    """Per-endpoint HTTP metrics of a run.
+
+    Requests are grouped by method, host and endpoint template, with their
+    statuses, latency histogram, response bytes, retries, 429 answers, the
+    time spent sleeping on rate limits or backoffs and the response cache
+    lookups.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()  # The pipeline geocodes from a worker thread
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started_at = time.time()
+            self.endpoints = {}
+
+    def endpoint(self, method, url):
+        host, path = endpoint_template(url)
+        key = (method.upper(), host, path)
+        stats = self.endpoints.get(key)
+        if stats is None:
+            stats = self.endpoints[key] = empty_stats()
+        return stats
+
+    def snapshot(self):
+        """Return a copy of the metrics recorded so far, taken now."""
+        copy = Metrics()
+        with self.lock:
+            copy.started_at = self.started_at
+            copy.endpoints = deepcopy(self.endpoints)
+        copy.taken_at = time.time()
+        return copy
+
+    def since(self, previous):
+        """Return the metrics recorded since the previous snapshot, e.g. those of one daemon cycle."""
+        current = self.snapshot()
+        delta = Metrics()
+        delta.started_at = previous.taken_at
+        for key, stats in current.endpoints.items():
+            stats = subtract_stats(stats, previous.endpoints.get(key) or empty_stats())
+            if stats['requests'] or stats['cache'] or stats['sleep_seconds']:
+                delta.endpoints[key] = stats
+        return delta
+
+    def record(self, method, url, status, latency, size=0):
+        """Record one request; status is the HTTP status, or 'error' when no response was received."""
+        with self.lock:
+            stats = self.endpoint(method, url)
+            stats['requests'] += 1
+            stats['statuses'][str(status)] = stats['statuses'].get(str(status), 0) + 1
+            stats['latency_sum'] += latency
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    stats['latency_buckets'][i] += 1
+                    break
+            stats['bytes'] += size or 0
+            if status == 429:
+                stats['rate_limited'] += 1
+
+    def record_response(self, response, *args, **kwargs):
+        """requests response hook, also counting the retries made by the urllib3 retry policy."""
+        self.record(response.request.method, response.url, response.status_code, response.elapsed.total_seconds(), len(response.content))
+        retries = getattr(response.raw, 'retries', None)
+        if retries is not None and retries.history:
+            with self.lock:
+                self.endpoint(response.request.method, response.url)['retries'] += len(retries.history)
+        return response
+
+    def record_bytes(self, method, url, size):
+        with self.lock:
+            self.endpoint(method, url)['bytes'] += size
+
+    def record_retry(self, method, url):
+        with self.lock:
+            self.endpoint(method, url)['retries'] += 1
+
+    def record_sleep(self, method, url, seconds, reason='rate_limit'):
+        """Record time spent waiting before a request to the endpoint."""
+        if seconds <= 0:
+            return
+        with self.lock:
+            sleep_seconds = self.endpoint(method, url)['sleep_seconds']
+            sleep_seconds[reason] = sleep_seconds.get(reason, 0.0) + seconds
+
+    def record_cache(self, method, url, outcome):
+        """Record a response cache lookup: fresh or revalidated (no body downloaded), unchanged, changed or miss."""
+        with self.lock:
+            cache = self.endpoint(method, url)['cache']
+            cache[outcome] = cache.get(outcome, 0) + 1
+
+    def trace_config(self):
+        """Return an aiohttp TraceConfig recording every request of a session."""
+        import aiohttp  # Only loaded by the phases opening a session
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session, context, params):
+            context.started = time.monotonic()
+
+        async def on_request_end(session, context, params):
+            self.record(params.method, params.url, params.response.status, time.monotonic() - context.started)
+
+        async def on_request_exception(session, context, params):
+            self.record(params.method, params.url, 'error', time.monotonic() - context.started)
+
+        async def on_response_chunk_received(session, context, params):
+            self.record_bytes(params.method, params.url, len(params.chunk))
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_end)
+        trace_config.on_request_exception.append(on_request_exception)
+        trace_config.on_response_chunk_received.append(on_response_chunk_received)
+        return trace_config
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'started_at': self.started_at,
+                'duration': time.time() - self.started_at,
+                'latency_buckets': LATENCY_BUCKETS,
+                'endpoints': [
+                    {'method': method, 'host': host, 'endpoint': path, **stats}
+                    for (method, host, path), stats in sorted(self.endpoints.items())
+                ]
+            }
+
+    def log_summary(self, top=10):
+        """Log the endpoints where the run spent the most time."""
+        data = self.to_dict()
+        endpoints = sorted(data['endpoints'], key=lambda e: e['latency_sum'] + sum(e['sleep_seconds'].values()), reverse=True)
+        total_requests = sum(e['requests'] for e in endpoints)
+        logging.info(f"HTTP summary: {total_requests} requests to {len(endpoints)} endpoints in {data['duration']:.1f}s")
+        lookups = {}
+        for e in endpoints:
+            for outcome, count in e['cache'].items():
+                lookups[outcome] = lookups.get(outcome, 0) + count
+        if lookups:
+            hits = lookups.get('fresh', 0) + lookups.get('revalidated', 0)
+            logging.info(f"Response cache: {hits} of {sum(lookups.values())} pages served from the cache ({hits / sum(lookups.values()):.0%}), {lookups}")
+        for e in endpoints[:top]:
+            average = e['latency_sum'] / e['requests'] if e['requests'] else 0
+            logging.info(
+                f"  {e['method']} {e['host']}{e['endpoint']}: {e['requests']} requests, "
+                f"{e['latency_sum']:.1f}s in requests (avg {average * 1000:.0f} ms), "
+                f"{sum(e['sleep_seconds'].values()):.1f}s sleeping, {e['retries']} retries, "
+                f"{e['rate_limited']} rate limited, {e['bytes']} bytes, statuses {e['statuses']}"
+                + (f", cache {e['cache']}" if e['cache'] else '')
+            )
+
+    def to_prometheus(self):
+        """Render the metrics in the Prometheus text exposition format."""
+        data = self.to_dict()
+        lines = [
+            '# HELP meraki_sync_run_duration_seconds Duration of the run so far.',
+            '# TYPE meraki_sync_run_duration_seconds gauge',
+            f"meraki_sync_run_duration_seconds {data['duration']:.3f}"
+        ]
+        series = {
+            'requests_total': ('counter', 'HTTP requests by status.', []),
+            'request_duration_seconds': ('histogram', 'HTTP request latency.', []),
+            'response_bytes_total': ('counter', 'HTTP response bytes.', []),
+            'retries_total': ('counter', 'HTTP requests retried.', []),
+            'rate_limited_total': ('counter', 'HTTP 429 answers.', []),
+            'sleep_seconds_total': ('counter', 'Time spent waiting before requests.', []),
+            'cache_lookups_total': ('counter', 'Response cache lookups by outcome.', []),
+        }
+        for e in data['endpoints']:
+            labels = f'method="{e["method"]}",host="{e["host"]}",endpoint="{e["endpoint"]}"'
+            for status, count in sorted(e['statuses'].items()):
+                series['requests_total'][2].append(f'meraki_sync_http_requests_total{{{labels},status="{status}"}} {count}')
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, e['latency_buckets']):
+                cumulative += count
+                series['request_duration_seconds'][2].append(f'meraki_sync_http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            series['request_duration_seconds'][2].extend([
+                f'meraki_sync_http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {e["requests"]}',
+                f'meraki_sync_http_request_duration_seconds_sum{{{labels}}} {e["latency_sum"]:.6f}',
+                f'meraki_sync_http_request_duration_seconds_count{{{labels}}} {e["requests"]}'
+            ])
+            series['response_bytes_total'][2].append(f'meraki_sync_http_response_bytes_total{{{labels}}} {e["bytes"]}')
+            series['retries_total'][2].append(f'meraki_sync_http_retries_total{{{labels}}} {e["retries"]}')
+            series['rate_limited_total'][2].append(f'meraki_sync_http_rate_limited_total{{{labels}}} {e["rate_limited"]}')
+            for reason, seconds in sorted(e['sleep_seconds'].items()):
+                series['sleep_seconds_total'][2].append(f'meraki_sync_http_sleep_seconds_total{{{labels},reason="{reason}"}} {seconds:.3f}')
+            for outcome, count in sorted(e['cache'].items()):
+                series['cache_lookups_total'][2].append(f'meraki_sync_http_cache_lookups_total{{{labels},outcome="{outcome}"}} {count}')
+
+        for name, (kind, help_text, samples) in series.items():
+            lines += [f"# HELP meraki_sync_http_{name} {help_text}", f"# TYPE meraki_sync_http_{name} {kind}"] + samples
+        return '\n'.join(lines) + '\n'
+
+    def export(self, json_file=METRICS_FILE, prom_file=METRICS_PROM_FILE):
+        """Write the JSON export and the Prometheus textfile; a file given as None is skipped."""
+        try:
+            # Written next to the target and renamed, so collectors never read a partial file
+            for filepath, render in ((json_file, lambda: json.dumps(self.to_dict(), indent=4)), (prom_file, self.to_prometheus)):
+                if filepath is None:
+                    continue
+                content = render()
+                os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+                with open(f"{filepath}.tmp", 'w') as f:
+                    f.write(content)
+                os.replace(f"{filepath}.tmp", filepath)
+            logging.info(f"Metrics have been written to {' and '.join(filepath for filepath in (json_file, prom_file) if filepath)}")
+        except IOError as e:
+            logging.error(f"Failed to write metrics: {e}")
+
+# Shared by every HTTP client of the run
+metrics = Metrics()
@@ -0,0 +1,147 @@
+from dataclasses import dataclass, field
+
+def without_none(data):
+    """Drop the keys of absent fields, so saved records look like the API payloads they came from."""
+    return {key: value for key, value in data.items() if value is not None}
+
+def encode(obj):
+    """json default hook serializing the records below with their API field names."""
+    if hasattr(obj, 'to_dict'):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+@dataclass(slots=True)
+class Network:
+    """Meraki network, reduced to the fields the sync consumes."""
+
+    id: str
+    name: str = None
+    organization_id: str = None
+    product_types: list = field(default_factory=list)
+    time_zone: str = None
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['id'], data.get('name'), data.get('organizationId'), data.get('productTypes') or [], data.get('timeZone'))
+
+    @property
+    def wireless(self):
+        return 'wireless' in self.product_types
+
+    def to_dict(self):
+        return without_none({
+            'id': self.id,
+            'organizationId': self.organization_id,
+            'name': self.name,
+            'productTypes': self.product_types,
+            'timeZone': self.time_zone
+        })
+
+@dataclass(slots=True)
+class Device:
+    """Meraki device with the address fields added by geocoding."""
+
+    serial: str = None
+    network_id: str = None
+    name: str = None
+    model: str = None
+    mac: str = None
+    lat: float = None
+    lng: float = None
+    address: str = None
+    country: str = None
+    city: str = None
+    state: str = None
+    postcode: str = None
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data.get('serial'), data.get('networkId'), data.get('name'), data.get('model'), data.get('mac'),
+            data.get('lat'), data.get('lng'), data.get('address'),
+            data.get('country'), data.get('city'), data.get('state'), data.get('postcode')
+        )
+
+    @property
+    def has_coordinates(self):
+        return self.lat is not None and self.lng is not None
+
+    @property
+    def is_access_point(self):
+        return (self.model or '').startswith('MR')
+
+    def to_dict(self):
+        return without_none({
+            'serial': self.serial,
+            'networkId': self.network_id,
+            'name': self.name,
+            'model': self.model,
+            'mac': self.mac,
+            'lat': self.lat,
+            'lng': self.lng,
+            'address': self.address,
+            'country': self.country,
+            'city': self.city,
+            'state': self.state,
+            'postcode': self.postcode
+        })
+
+@dataclass(slots=True)
+class Ssid:
+    """SSID of a wireless network."""
+
+    number: int
+    name: str = None
+    enabled: bool = True
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['number'], data.get('name'), data.get('enabled', True))
+
+    def to_dict(self):
+        return {'number': self.number, 'name': self.name, 'enabled': self.enabled}
+
+@dataclass(slots=True)
+class Location:
+    """CloudiFi location built from a Meraki network and its first device."""
+
+    name: str
+    lang: str
+    template: str
+    timezone: str
+    country: str
+    address: str
+    postcode: str
+    mac: str
+    alias: str
+
+    def to_dict(self):
+        """Return the CloudiFi location payload."""
+        return {
+            "name": self.name,
+            "lang": self.lang,
+            "template": self.template,
+            "timezone": self.timezone,
+            "country": self.country,
+            "addressLocality": self.address,
+            "postalCode": self.postcode,
+            "streetAddress": self.address,
+            "bandwidthIn": 0,
+            "bandwidthOut": 0,
+            "identifiers": [
+                {
+                    "key": self.mac,
+                    "alias": self.alias
+                }
+            ]
+        }
+
+def parse_network_data(network_data):
+    """Return a network_data record ({'network', 'devices', 'ssids'}) built from records, parsing it if loaded from JSON."""
+    if isinstance(network_data['network'], Network):
+        return network_data
+    return {
+        'network': Network.from_dict(network_data['network']),
+        'devices': [Device.from_dict(device) for device in network_data.get('devices', [])],
+        'ssids': [Ssid.from_dict(ssid) for ssid in network_data.get('ssids', [])]
+    }
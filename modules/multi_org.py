@@ -0,0 +1,114 @@
+import os
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from . import common, meraki_api
+from .config import MERAKI_ORG_IDS, MERAKI_ORG_CONCURRENCY, STREAM_OUTPUT, EXPORT_JSON
+from .fetch_extra_data import MerakiFetcher
+from .meraki_async import AsyncMerakiClient
+from .cloudifi_api import CloudiFi
+from .geocoding import GeocodingStage
+from .inventory import inventory
+
+class MultiOrgSync:
+    """Crawl several Meraki organizations concurrently and push them to CloudiFi in one stage.
+
+    Meraki rate limits each organization separately, so every organization
+    gets its own async client and token bucket. Outputs, checkpoint,
+    fingerprints and last fetch time live in a directory per organization;
+    the geocoder and its cache are shared. An organization that fails is
+    left out of the push and resumes from its checkpoint on the next run.
+    """
+
+    def __init__(self, org_ids=MERAKI_ORG_IDS, concurrency=MERAKI_ORG_CONCURRENCY, geocoder=None, cloudifi=None, geocode=True):
+        self.org_ids = org_ids
+        self.concurrency = concurrency
+        self.geocode = geocode  # Without it, devices are left for the geocode phase
+        self.geocoder = GeocodingStage() if geocoder is None and geocode else geocoder
+        self.cloudifi = cloudifi if cloudifi is not None else CloudiFi()
+
+    async def discover(self):
+        """Return the organizations to sync, listing those of the API key when configured with 'all'."""
+        if [org_id.lower() for org_id in self.org_ids] != ['all']:
+            return list(self.org_ids)
+        async with AsyncMerakiClient() as client:
+            organizations = await client.get_organizations()
+        logging.info(f"Discovered {len(organizations)} organizations")
+        return [organization['id'] for organization in organizations]
+
+    def create_fetcher(self, org_id):
+        data_dir = common.org_data_dir(org_id)
+        return MerakiFetcher(
+            org_id=org_id,
+            data_dir=data_dir,
+            last_fetch_file=os.path.join(data_dir, 'last_fetch.json'),
+            geocoder=self.geocoder,
+            geocode=self.geocode
+        )
+
+    def crawl(self, fetcher):
+        """Build and save the outputs of one prefetched organization; run in a worker thread."""
+        if self.geocoder is not None:
+            self.geocoder.locate_inventory(inventory, fetcher.org_id)  # Devices a fetch phase left without an address
+        if EXPORT_JSON and STREAM_OUTPUT:
+            common.save_to_ndjson(meraki_api.iter_organization_details(fetcher.planner), 'organization_details.json', fetcher.data_dir)
+        elif EXPORT_JSON:
+            common.save_to_json(meraki_api.get_organization_details(fetcher.planner), 'organization_details.json', fetcher.data_dir)
+        if fetcher.fetch_extra_data():
+            return True
+        logging.info(f"Retrying fetch updates of organization {fetcher.org_id} due to an error in the first run")
+        time.sleep(5)
+        return fetcher.fetch_extra_data()
+
+    async def sync_organization(self, org_id, semaphore, executor):
+        """Crawl one organization; return its fetcher, or None when it failed."""
+        async with semaphore:
+            loop = asyncio.get_running_loop()
+            logging.info(f"Syncing organization {org_id}")
+            try:
+                fetcher = self.create_fetcher(org_id)
+                try:
+                    async with AsyncMerakiClient(org_id=org_id, journal=fetcher.journal) as client:
+                        await fetcher.planner.prefetch(client)
+                except Exception as e:
+                    logging.warning(f"Concurrent prefetch of organization {org_id} failed, falling back to sequential fetching: {e}")
+                if await loop.run_in_executor(executor, self.crawl, fetcher):
+                    logging.info(f"Organization {org_id} synced successfully")
+                    return fetcher
+                logging.error(f"Failed to fetch the updates of organization {org_id}")
+            except Exception as e:
+                logging.error(f"Failed to sync organization {org_id}: {e}")
+            return None
+
+    async def fetch(self):
+        """Crawl every organization into the inventory; return the IDs of those that succeeded and of those that failed."""
+        org_ids = await self.discover()
+        logging.info(f"Syncing {len(org_ids)} organizations, {self.concurrency} at a time")
+        semaphore = asyncio.Semaphore(self.concurrency)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            results = await asyncio.gather(*(self.sync_organization(org_id, semaphore, executor) for org_id in org_ids))
+        synced = [fetcher.org_id for fetcher in results if fetcher is not None]
+        failed = [org_id for org_id, fetcher in zip(org_ids, results) if fetcher is None]
+        if failed:
+            logging.error(f"Organizations {', '.join(failed)} failed")
+        return synced, failed
+
+    async def run(self):
+        """Sync every organization, then push their networks to CloudiFi. Return True when none failed."""
+        synced, failed = await self.fetch()
+        if failed:
+            logging.error(f"Organizations {', '.join(failed)} are left out of this push")
+        if not synced:
+            return False
+
+        logging.info("Fetching and saving details from CloudiFi")
+        cf = self.cloudifi
+        await cf.fetch_and_save_details()
+
+        logging.info(f"Preparing location details of {len(synced)} organizations")
+        cf.prepare_location_details(inventory.iter_network_records(synced))
+
+        logging.info("Creating locations in CloudiFi from the inventory")
+        await cf.create_locations_from_saved_data(complete=not failed)  # Locations of failed organizations are not removed
+        return not failed
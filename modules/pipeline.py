@@ -0,0 +1,175 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from . import common, meraki_api
+from .config import MERAKI_CONCURRENCY, CLOUDIFI_CONCURRENCY, PIPELINE_QUEUE_SIZE, STREAM_OUTPUT, EXPORT_JSON, CLOUDIFI_DRY_RUN
+from .meraki_async import AsyncMerakiClient
+from .models import parse_network_data
+from .push_manifest import PushManifest
+from .inventory import inventory
+from .http_client import async_session
+
+class Pipeline:
+    """Stream networks through fetch -> geocode -> map-to-location -> upsert.
+
+    Stages are connected by bounded asyncio queues, so Meraki fetches, geocoding
+    and CloudiFi pushes overlap and the first locations land while the crawl is
+    still running. The inventory and the usual JSON exports are written as side outputs.
+    """
+
+    def __init__(self, fetcher, cloudifi, queue_size=PIPELINE_QUEUE_SIZE):
+        self.fetcher = fetcher
+        self.planner = fetcher.planner
+        self.cloudifi = cloudifi
+        self.queue_size = queue_size
+        self.geocode_executor = ThreadPoolExecutor(max_workers=1)  # The planner is not thread-safe; lookups are pooled by the geocoding stage
+        self.reference_index = None
+        self.manifest = PushManifest()
+        self.existing_locations = None  # Listed when the first location needs to be pushed
+        self.existing_lock = asyncio.Lock()
+        self.planned = []  # (action, network_id, location_data) of a dry run
+        self.removed = []
+        self.networks_data = {}
+        self.location_details = []  # (network_id, location_data) pairs
+        self.report = []
+        self.failures = 0
+
+    async def run(self):
+        """Run every stage to completion, then write the side outputs."""
+        async with AsyncMerakiClient(journal=self.fetcher.journal) as client:
+            session = async_session()
+            # Organization listings and reference data are independent
+            await asyncio.gather(
+                self.planner.prefetch_listings(client),
+                self.cloudifi.fetch_and_save_details()
+            )
+            self.reference_index = self.cloudifi.get_reference_index()
+            self.planner.get_devices_by_network()
+            await self.planner.prefetch_bulk_ssids_async(client)
+
+            networks_queue = asyncio.Queue()
+            geocode_queue = asyncio.Queue(self.queue_size)
+            map_queue = asyncio.Queue(self.queue_size)
+            push_queue = asyncio.Queue(self.queue_size)
+            for network in self.planner.get_networks():
+                networks_queue.put_nowait(network)
+            for _ in range(MERAKI_CONCURRENCY):
+                networks_queue.put_nowait(None)
+
+            await asyncio.gather(
+                self.run_stage('fetch', lambda network: self.fetch(client, network), networks_queue, geocode_queue, MERAKI_CONCURRENCY, 1),
+                self.run_stage('geocode', self.geocode, geocode_queue, map_queue, 1, 1),
+                self.run_stage('map', self.map_to_location, map_queue, push_queue, 1, CLOUDIFI_CONCURRENCY),
+                self.run_stage('push', lambda location: self.push(session, location), push_queue, None, CLOUDIFI_CONCURRENCY, 0)
+            )
+            # Removed locations are only trusted when every network made it through
+            self.removed = self.manifest.removed() if not self.failures else []
+            if not CLOUDIFI_DRY_RUN:
+                self.report += await self.cloudifi.remove_locations(session, self.manifest, self.removed)
+
+        self.geocode_executor.shutdown()
+        self.reference_index.log_summary()
+        self.save_side_outputs()
+        return self.failures == 0
+
+    async def run_stage(self, name, handler, inbox, outbox, workers, next_workers):
+        """Move items from inbox to outbox until every worker has received a None sentinel."""
+        async def work():
+            while True:
+                item = await inbox.get()
+                if item is None:
+                    return
+                try:
+                    result = await handler(item)
+                except Exception as e:
+                    self.failures += 1
+                    logging.error(f"Pipeline stage {name} failed: {e}")
+                    continue
+                if outbox is not None and result is not None:
+                    await outbox.put(result)
+
+        await asyncio.gather(*(work() for _ in range(workers)))
+        for _ in range(next_workers):
+            await outbox.put(None)
+        logging.info(f"Pipeline stage {name} finished")
+
+    async def fetch(self, client, network):
+        ssids = []
+        if self.fetcher.journal.get_network(network.id) is not None:
+            return network, ssids  # Completed before the interruption
+        if network.wireless:
+            ssids = await self.planner.get_ssids_async(client, network.id)
+        return network, ssids
+
+    async def geocode(self, item):
+        network, ssids = item
+        network_data = self.fetcher.journal.get_network(network.id)
+        if network_data is None:
+            loop = asyncio.get_running_loop()
+            devices = await loop.run_in_executor(self.geocode_executor, self.planner.get_network_devices, network.id)
+            network_data = {
+                'network': network,
+                'devices': devices,
+                'ssids': ssids
+            }
+            if not self.planner.ssids_failed(network.id):  # Fetched again on resume
+                self.fetcher.journal.record_network(network.id, network_data)
+        network_data = parse_network_data(network_data)
+        self.networks_data[network.id] = network_data
+        return network.id, network_data
+
+    async def map_to_location(self, item):
+        for location in self.cloudifi.iter_location_details([item], self.reference_index):
+            self.location_details.append(location)
+            return location
+
+    async def push(self, session, location):
+        key, location_data = location
+        action = self.manifest.action(key, location_data)
+        if action == 'unchanged':
+            self.report.append({'name': location_data['name'], 'action': 'unchanged', 'id': self.manifest.entries[key]['id']})
+            return
+        if CLOUDIFI_DRY_RUN:
+            self.planned.append((action, key, location_data))
+            return
+        result = await self.cloudifi.upsert_location(session, await self.get_existing_locations(session), location_data)
+        self.manifest.record(key, location_data, result)
+        self.report.append(result)
+        if result['action'].endswith('_failed'):
+            self.failures += 1
+
+    async def get_existing_locations(self, session):
+        async with self.existing_lock:
+            if self.existing_locations is None:
+                self.existing_locations = self.cloudifi.index_locations(await self.cloudifi.list_locations(session))
+        return self.existing_locations
+
+    def save_side_outputs(self):
+        """Write the artifacts the phase-by-phase run produces."""
+        networks = self.planner.get_networks()
+        networks_data = {network.id: self.networks_data[network.id] for network in networks if network.id in self.networks_data}
+        # Networks that failed keep their previous inventory records
+        changed = self.planner.get_changed_network_ids() if self.planner.state is not None else None
+        inventory.save_networks(self.fetcher.org_id, networks_data.items(), changed, complete=not self.failures)
+        if EXPORT_JSON:
+            data_dir = self.fetcher.data_dir
+            if STREAM_OUTPUT:
+                common.save_to_ndjson(meraki_api.iter_organization_details(self.planner), 'organization_details.json', data_dir)
+            else:
+                common.save_to_json(meraki_api.get_organization_details(self.planner), 'organization_details.json', data_dir)
+            self.fetcher.export_json(networks)
+        self.cloudifi.save_location_details(self.location_details)
+        if CLOUDIFI_DRY_RUN:
+            self.cloudifi.save_push_plan(self.planned, self.removed)
+        else:
+            self.manifest.save()
+            self.cloudifi.save_push_report(self.report)
+
+        # Only a complete run may become the baseline of the next incremental run
+        if self.failures:
+            logging.warning(f"Pipeline finished with {self.failures} failures; last fetch time not updated")
+            return
+        if self.planner.state is not None:
+            self.planner.state.save()
+        common.save_last_fetch_time(self.fetcher.started_at, self.fetcher.last_fetch_file)
+        self.fetcher.journal.complete()
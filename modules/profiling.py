@@ -0,0 +1,240 @@
+import os
+import json
+import time
+import pstats
+import cProfile
+import inspect
+import logging
+import importlib
+import threading
+import tracemalloc
+from .config import PROFILE_DIR, PROFILE_TOP
+from .common import write_json_atomic
+
+# Phases of a run, as (name, module, class, method); every call of them is profiled
+PHASES = [
+    ('prefetch', 'modules.crawl_planner', 'CrawlPlanner', 'prefetch'),
+    ('geocode', 'modules.geocoding', 'GeocodingStage', 'locate_inventory'),
+    ('organization_details', 'modules.meraki_api', None, 'get_organization_details'),
+    ('organization_details', 'modules.meraki_api', None, 'iter_organization_details'),
+    ('extra_data', 'modules.fetch_extra_data', 'MerakiFetcher', 'fetch_extra_data'),
+    ('cloudifi_details', 'modules.cloudifi_api', 'CloudiFi', 'fetch_and_save_details'),
+    ('prepare_locations', 'modules.cloudifi_api', 'CloudiFi', 'prepare_location_details'),
+    ('push_locations', 'modules.cloudifi_api', 'CloudiFi', 'create_locations_from_saved_data'),
+    ('pipeline', 'modules.pipeline', 'Pipeline', 'run'),
+]
+
+def take_snapshot():
+    return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+def function_stats(items):
+    return [
+        {
+            'function': f"{os.path.basename(filename)}:{line}({function})",
+            'calls': calls,
+            'total_time': round(total_time, 4),
+            'cumulative_time': round(cumulative_time, 4)
+        }
+        for (filename, line, function), (_, calls, total_time, cumulative_time, _) in items
+    ]
+
+class PhaseProfile:
+    """cProfile stats, allocations and wall and CPU time of every call of one phase."""
+
+    def __init__(self, name):
+        self.name = name
+        self.profile = cProfile.Profile()
+        self.calls = 0
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.peak_memory = 0
+        self.overhead = 0.0  # Seconds spent taking and comparing snapshots, outside the phase times
+        self.allocations = {}  # Bytes and blocks still allocated at the end of the phase, by source line
+
+    def start(self):
+        started = time.perf_counter()
+        tracemalloc.reset_peak()
+        self.snapshot = take_snapshot()
+        self.overhead += time.perf_counter() - started
+        self.started = (time.perf_counter(), time.process_time())
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        self.wall_time += time.perf_counter() - self.started[0]
+        self.cpu_time += time.process_time() - self.started[1]  # Every thread, e.g. the geocoder workers
+        self.peak_memory = max(self.peak_memory, tracemalloc.get_traced_memory()[1])
+        started = time.perf_counter()
+        for stat in take_snapshot().compare_to(self.snapshot, 'lineno'):
+            if stat.size_diff > 0:
+                frame = stat.traceback[0]
+                location = f"{frame.filename}:{frame.lineno}"
+                size, count = self.allocations.get(location, (0, 0))
+                self.allocations[location] = (size + stat.size_diff, count + stat.count_diff)
+        self.snapshot = None
+        self.overhead += time.perf_counter() - started
+        self.calls += 1
+
+    def to_dict(self, top=PROFILE_TOP):
+        stats = pstats.Stats(self.profile).stats
+        allocations = sorted(self.allocations.items(), key=lambda item: item[1][0], reverse=True)[:top]
+        return {
+            'phase': self.name,
+            'calls': self.calls,
+            'wall_time': round(self.wall_time, 3),
+            'cpu_time': round(self.cpu_time, 3),
+            'cpu_share': round(self.cpu_time / self.wall_time, 3) if self.wall_time else 0.0,  # Low when the phase waits on I/O
+            'peak_memory_mb': round(self.peak_memory / 1024 / 1024, 1),
+            'profiler_overhead': round(self.overhead, 3),
+            # By time spent in the function itself, then including its callees
+            'top_functions': function_stats(sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:top]),
+            'top_cumulative': function_stats(sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:top]),
+            'top_allocations': [
+                {'location': location, 'size_mb': round(size / 1024 / 1024, 3), 'blocks': count}
+                for location, (size, count) in allocations
+            ]
+        }
+
+class Profiler:
+    """Profile the phases of a run and write one report per run under PROFILE_DIR.
+
+    Every phase method is wrapped to record its cProfile stats (of the
+    calling thread), the tracemalloc peak and the allocations it left, and
+    its wall and process CPU time. A phase called while another one runs
+    counts towards the outer one. The report, a .prof file per phase and the
+    change from the previous report are written when the run ends.
+    """
+
+    def __init__(self, command, directory=PROFILE_DIR):
+        self.command = command  # Reports are compared with the previous one of the same command
+        self.directory = directory
+        self.phases = {}
+        self.originals = []
+        self.lock = threading.Lock()
+        self.active = False
+
+    def install(self):
+        self.started = (time.time(), time.perf_counter(), time.process_time())
+        for name, module_name, owner_name, function_name in PHASES:
+            owner = importlib.import_module(module_name)
+            if owner_name is not None:
+                owner = getattr(owner, owner_name)
+            function = getattr(owner, function_name)
+            self.originals.append((owner, function_name, function))
+            setattr(owner, function_name, self.wrap(name, function))
+        # Started once the phase modules are imported, so snapshots only hold the data of the run
+        tracemalloc.start()
+        return self
+
+    def uninstall(self):
+        for owner, function_name, function in reversed(self.originals):
+            setattr(owner, function_name, function)
+        self.originals = []
+
+    def enter(self, name):
+        """Start profiling a phase; return None when another phase is already profiled."""
+        with self.lock:
+            if self.active:
+                return None
+            self.active = True
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = PhaseProfile(name)
+        phase.start()
+        return phase
+
+    def exit(self, phase):
+        if phase is not None:
+            phase.stop()
+            with self.lock:
+                self.active = False
+
+    def wrap(self, name, function):
+        if inspect.iscoroutinefunction(function):
+            async def wrapper(*args, **kwargs):
+                phase = self.enter(name)
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    self.exit(phase)
+        elif inspect.isgeneratorfunction(function):
+            def wrapper(*args, **kwargs):
+                # Profiled while it is consumed, as the streamed output is written
+                phase = self.enter(name)
+                try:
+                    yield from function(*args, **kwargs)
+                finally:
+                    self.exit(phase)
+        else:
+            def wrapper(*args, **kwargs):
+                phase = self.enter(name)
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.exit(phase)
+        return wrapper
+
+    def report(self):
+        wall_time = time.perf_counter() - self.started[1]
+        cpu_time = time.process_time() - self.started[2]
+        phases = [phase.to_dict() for phase in self.phases.values()]
+        return {
+            'command': self.command,
+            'started_at': self.started[0],
+            'wall_time': round(wall_time, 3),
+            'cpu_time': round(cpu_time, 3),
+            'profiler_overhead': round(sum(phase['profiler_overhead'] for phase in phases), 3),
+            # Start-up and the work between phases
+            'unprofiled_wall_time': round(wall_time - sum(phase['wall_time'] + phase['profiler_overhead'] for phase in phases), 3),
+            # Each phase resets the tracemalloc peak, so the run peak is the highest of theirs
+            'peak_memory_mb': round(max([tracemalloc.get_traced_memory()[1] / 1024 / 1024] + [phase['peak_memory_mb'] for phase in phases]), 1),
+            'phases': phases
+        }
+
+    def previous_report(self):
+        """Return the report of the last profiled run of the same command, or None."""
+        try:
+            runs = sorted(os.listdir(self.directory), reverse=True)
+        except FileNotFoundError:
+            return None
+        for run in runs:
+            try:
+                with open(os.path.join(self.directory, run, 'report.json')) as f:
+                    report = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                continue
+            if report.get('command') == self.command:
+                return report
+        return None
+
+    def save(self):
+        """Write the report and the .prof files of the run; return the run directory."""
+        previous = self.previous_report()
+        report = self.report()
+        tracemalloc.stop()
+        run_dir = os.path.join(self.directory, time.strftime('%Y%m%d-%H%M%S', time.localtime(report['started_at'])))
+        os.makedirs(run_dir, exist_ok=True)
+        for phase in self.phases.values():
+            phase.profile.dump_stats(os.path.join(run_dir, f"{phase.name}.prof"))
+        write_json_atomic(os.path.join(run_dir, 'report.json'), report, indent=4)
+        self.log_summary(report, previous)
+        logging.info(f"Profile report written to {run_dir}")
+        return run_dir
+
+    def log_summary(self, report, previous=None):
+        """Log the time and memory of each phase, with the change from the previous report."""
+        before = {phase['phase']: phase for phase in previous['phases']} if previous else {}
+        logging.info(
+            f"Profile: {report['wall_time']:.2f}s wall, {report['cpu_time']:.2f}s CPU, {report['peak_memory_mb']:.1f} MB peak, "
+            f"{report['unprofiled_wall_time']:.2f}s outside the phases, {report['profiler_overhead']:.2f}s of profiler overhead"
+        )
+        for phase in report['phases']:
+            change = ''
+            if phase['phase'] in before:
+                change = (f" ({phase['wall_time'] - before[phase['phase']]['wall_time']:+.2f}s wall, "
+                          f"{phase['peak_memory_mb'] - before[phase['phase']]['peak_memory_mb']:+.1f} MB vs the previous run)")
+            hottest = phase['top_functions'][0]['function'] if phase['top_functions'] else None
+            logging.info(
+                f"  {phase['phase']}: {phase['calls']} calls, {phase['wall_time']:.2f}s wall, {phase['cpu_time']:.2f}s CPU, "
+                f"{phase['peak_memory_mb']:.1f} MB peak{change}; most time spent in {hottest}"
+            )
@@ -0,0 +1,71 @@
+import time
+import logging
+from .incremental import fingerprint
+from .inventory import inventory
+
+# Report actions of successful pushes, recorded in the manifest
+PUSHED_ACTIONS = ('create', 'update', 'unchanged')
+
+class PushManifest:
+    """Content hashes of the locations last pushed to CloudiFi successfully.
+
+    Locations are keyed by the ID of their Meraki network, which survives a
+    device swap. A location whose hash matches the manifest is not sent
+    again; one that is missing from it is added, one whose hash differs is
+    changed, and manifest entries no longer produced by the run are removed,
+    unless their CloudiFi location was matched by a location of the run.
+    Entries live in the pushed_locations table of the inventory store;
+    emptying it forces a full push.
+    """
+
+    def __init__(self, store=inventory):
+        self.store = store
+        self.entries = store.pushed_locations()
+        self.seen = set()
+        self.recorded = set()
+        self.forgotten = set()
+        self.claimed = set()  # CloudiFi location IDs matched or pushed in this run, never to be deleted
+
+    def action(self, key, location_data):
+        """Return 'add', 'change' or 'unchanged' for the location of network key, and mark it as seen in this run."""
+        self.seen.add(key)
+        entry = self.entries.get(key)
+        if entry is None:
+            return 'add'
+        if entry.get('id') is not None:
+            self.claimed.add(entry['id'])
+        return 'unchanged' if entry['hash'] == fingerprint(location_data) else 'change'
+
+    def in_use(self, location_id):
+        """Return True when a location of this run was matched to or pushed as location_id."""
+        return location_id in self.claimed
+
+    def removed(self):
+        """Return the (key, entry) pairs of pushed locations the run did not produce."""
+        return [(key, entry) for key, entry in self.entries.items() if key not in self.seen]
+
+    def record(self, key, location_data, result):
+        """Remember a successfully pushed location, and claim the CloudiFi location it was matched to."""
+        if result.get('id') is not None:
+            self.claimed.add(result['id'])  # Even when the update failed, the location belongs to this network now
+        if result['action'] in PUSHED_ACTIONS:
+            self.recorded.add(key)
+            self.forgotten.discard(key)
+            self.entries[key] = {
+                'hash': fingerprint(location_data),
+                'id': result.get('id'),
+                'name': location_data['name'],
+                'pushed_at': time.time()
+            }
+
+    def forget(self, key):
+        self.entries.pop(key, None)
+        self.recorded.discard(key)
+        self.forgotten.add(key)
+
+    def save(self):
+        """Write the entries recorded or forgotten since the manifest was loaded."""
+        self.store.save_pushed_locations({key: self.entries[key] for key in self.recorded}, self.forgotten)
+        logging.info(f"Push manifest: {len(self.recorded)} locations recorded, {len(self.forgotten)} forgotten, {len(self.entries)} in total")
+        self.recorded.clear()
+        self.forgotten.clear()
@@ -0,0 +1,133 @@
+import re
+import logging
+import unicodedata
+
+# Names that refer to the same entry; Meraki and geocoder spellings on the left,
+# CloudiFi spellings further right. Every name of a group resolves to the same ID.
+COUNTRY_ALIASES = [
+    ["United States", "United States of America", "USA", "US"],
+    ["United Kingdom", "United Kingdom of Great Britain and Northern Ireland", "UK", "Great Britain"],
+    ["Russia", "Russian Federation"],
+    ["South Korea", "Korea, Republic of", "Republic of Korea", "Korea"],
+    ["North Korea", "Korea, Democratic People's Republic of"],
+    ["Vietnam", "Viet Nam"],
+    ["Iran", "Iran, Islamic Republic of"],
+    ["Syria", "Syrian Arab Republic"],
+    ["Laos", "Lao People's Democratic Republic"],
+    ["Bolivia", "Bolivia, Plurinational State of"],
+    ["Venezuela", "Venezuela, Bolivarian Republic of"],
+    ["Tanzania", "Tanzania, United Republic of"],
+    ["Moldova", "Moldova, Republic of"],
+    ["Czechia", "Czech Republic"],
+    ["Türkiye", "Turkey"],
+    ["Netherlands", "The Netherlands", "Nederland"],
+    ["Ivory Coast", "Côte d'Ivoire"],
+    ["Taiwan", "Taiwan, Province of China"],
+    ["Hong Kong", "Hong Kong SAR China"],
+    ["Macau", "Macao"],
+    ["Deutschland", "Germany"],
+    ["France", "République française"],
+    ["España", "Spain"],
+    ["Italia", "Italy"],
+    ["België / Belgique / Belgien", "Belgium"],
+    ["Schweiz/Suisse/Svizzera/Svizra", "Switzerland"],
+]
+
+TIMEZONE_ALIASES = [
+    ["UTC", "Etc/UTC", "Etc/UCT", "Etc/Universal", "Etc/Zulu", "GMT", "Etc/GMT"],
+    ["America/Los_Angeles", "US/Pacific"],
+    ["America/Denver", "US/Mountain"],
+    ["America/Phoenix", "US/Arizona"],
+    ["America/Chicago", "US/Central"],
+    ["America/New_York", "US/Eastern"],
+    ["America/Anchorage", "US/Alaska"],
+    ["Pacific/Honolulu", "US/Hawaii"],
+    ["America/Indiana/Indianapolis", "America/Indianapolis", "US/East-Indiana"],
+    ["America/Toronto", "Canada/Eastern"],
+    ["America/Vancouver", "Canada/Pacific"],
+    ["America/Argentina/Buenos_Aires", "America/Buenos_Aires"],
+    ["America/Sao_Paulo", "Brazil/East"],
+    ["Asia/Kolkata", "Asia/Calcutta"],
+    ["Asia/Ho_Chi_Minh", "Asia/Saigon"],
+    ["Asia/Kathmandu", "Asia/Katmandu"],
+    ["Asia/Yangon", "Asia/Rangoon"],
+    ["Asia/Shanghai", "PRC", "Asia/Chongqing", "Asia/Harbin"],
+    ["Asia/Tokyo", "Japan"],
+    ["Asia/Seoul", "ROK"],
+    ["Asia/Singapore", "Singapore"],
+    ["Australia/Sydney", "Australia/NSW", "Australia/ACT", "Australia/Canberra"],
+    ["Europe/Kyiv", "Europe/Kiev"],
+    ["Europe/London", "GB", "Europe/Belfast"],
+    ["Europe/Istanbul", "Turkey", "Asia/Istanbul"],
+    ["Pacific/Auckland", "NZ"],
+    ["Atlantic/Faroe", "Atlantic/Faeroe"],
+]
+
+LANGUAGE_ALIASES = [
+    ["English", "en", "eng"],
+    ["French", "Français", "fr"],
+    ["German", "Deutsch", "de"],
+    ["Spanish", "Español", "es"],
+    ["Italian", "Italiano", "it"],
+]
+
+# Kind name, key in details.json and alias groups
+REFERENCE_KINDS = {
+    'Country': ('countries', COUNTRY_ALIASES),
+    'Timezone': ('timezones', TIMEZONE_ALIASES),
+    'Language': ('langs', LANGUAGE_ALIASES),
+}
+
+def normalize(name):
+    """Return a case- and accent-insensitive form of a name."""
+    name = unicodedata.normalize('NFKD', str(name))
+    name = ''.join(char for char in name if not unicodedata.combining(char))
+    return re.sub(r'\s+', ' ', name).strip().casefold()
+
+class ReferenceIndex:
+    """O(1) lookup of CloudiFi reference IDs (countries, timezones, langs) by name.
+
+    Built once from details.json. Unresolved names are collected and reported
+    in a single summary instead of being logged per network.
+    """
+
+    def __init__(self, details):
+        self.indexes = {}
+        self.unresolved = {}
+        for kind, (key, aliases) in REFERENCE_KINDS.items():
+            self.indexes[kind] = self.build(details.get(key, {}).get('hydra:member', []), aliases)
+            self.unresolved[kind] = {}
+
+    @staticmethod
+    def build(items, aliases):
+        """Index items by normalized name and by every alias of that name."""
+        groups = {}
+        for group in aliases:
+            normalized_group = [normalize(alias) for alias in group]
+            for alias in normalized_group:
+                groups[alias] = normalized_group
+
+        index = {}
+        for item in items:
+            name = normalize(item['name'])
+            index[name] = item['id']
+            for alias in groups.get(name, []):
+                index.setdefault(alias, item['id'])
+        return index
+
+    def reset_unresolved(self):
+        """Forget the unresolved names, before the index is reused for another run."""
+        self.unresolved = {kind: {} for kind in self.indexes}
+
+    def lookup(self, kind, name):
+        """Return the ID of the named entry, or None if it cannot be resolved."""
+        item_id = self.indexes[kind].get(normalize(name)) if name is not None else None
+        if item_id is None:
+            self.unresolved[kind][name] = self.unresolved[kind].get(name, 0) + 1
+        return item_id
+
+    def log_summary(self):
+        """Log the names that could not be resolved, with their number of occurrences."""
+        for kind, names in self.unresolved.items():
+            if names:
+                logging.warning(f"Unresolved {kind} names: {names}")
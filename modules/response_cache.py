@@ -0,0 +1,162 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from dataclasses import dataclass
+from urllib.parse import urlencode
+from .config import RESPONSE_CACHE, RESPONSE_CACHE_FILE, RESPONSE_CACHE_TTLS, RESPONSE_CACHE_MAX_AGE
+from .metrics import metrics, endpoint_template
+
+# Seconds a cached page is used without a request, by endpoint template. The
+# organization listings drive the incremental change detection, so they are
+# always revalidated; endpoints not listed are never cached.
+DEFAULT_TTLS = {
+    '/organizations/{id}/networks': 0,
+    '/organizations/{id}/devices': 0,
+    '/networks/{id}/devices': 0,
+    '/networks/{id}/wireless/ssids': 3600
+}
+
+@dataclass(slots=True)
+class CachedPage:
+    key: str
+    etag: str
+    last_modified: str
+    digest: str
+    body: bytes
+    next_url: str
+    fresh: bool  # Within the endpoint TTL, usable without a request
+
+class ResponseCache:
+    """Persistent cache of Meraki listing pages keyed by URL and params.
+
+    Every page, including those reached through a pagination cursor, is kept
+    with its ETag, Last-Modified, body digest and next page URL. Within the
+    endpoint TTL a page is served without a request; after it, the page is
+    revalidated with If-None-Match / If-Modified-Since. A 304 or a body with
+    the same digest only refreshes the entry, which is never rewritten.
+    """
+
+    def __init__(self, path=RESPONSE_CACHE_FILE, ttls=None, max_age=RESPONSE_CACHE_MAX_AGE, enabled=RESPONSE_CACHE):
+        self.path = path
+        self.ttls = {**DEFAULT_TTLS, **(RESPONSE_CACHE_TTLS if ttls is None else ttls)}
+        self.max_age = max_age
+        self.enabled = enabled
+        self.lock = threading.Lock()  # Shared by the async client, the organization threads and the sync fallbacks
+        self.conn = None
+
+    def connect(self):
+        """Open the cache file on first use; call with the lock held."""
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, url TEXT NOT NULL, etag TEXT, last_modified TEXT, "
+                "digest TEXT NOT NULL, body BLOB NOT NULL, next_url TEXT, validated_at REAL NOT NULL)"
+            )
+            deleted = self.conn.execute("DELETE FROM responses WHERE validated_at < ?", (time.time() - self.max_age,)).rowcount
+            self.conn.commit()
+            if deleted:
+                logging.info(f"Evicted {deleted} expired response cache entries")
+        return self.conn
+
+    def ttl(self, url):
+        """Return the TTL of the endpoint of url, or None when it is not cached."""
+        if not self.enabled:
+            return None
+        path = endpoint_template(url)[1]
+        for endpoint, ttl in self.ttls.items():
+            if path.endswith(endpoint):
+                return ttl
+        return None
+
+    @staticmethod
+    def key(url, params=None):
+        return f"{url}?{urlencode(sorted(params.items()))}" if params else str(url)
+
+    def lookup(self, url, params=None):
+        """Return the cached page of a request, or None when it is missing or not cacheable."""
+        ttl = self.ttl(url)
+        if ttl is None:
+            return None
+        key = self.key(url, params)
+        with self.lock:
+            row = self.connect().execute(
+                "SELECT etag, last_modified, digest, body, next_url, validated_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return CachedPage(key, *row[:5], fresh=time.time() - row[5] < ttl)
+
+    def validators(self, page):
+        """Return the conditional request headers revalidating page."""
+        headers = {}
+        if page is not None:
+            if page.etag:
+                headers['If-None-Match'] = page.etag
+            if page.last_modified:
+                headers['If-Modified-Since'] = page.last_modified
+        return headers
+
+    def hit(self, url, page):
+        """Return the (data, next_url) of a fresh page."""
+        metrics.record_cache('GET', url, 'fresh')
+        return json.loads(page.body), page.next_url
+
+    def update(self, url, params, page, status, headers, body, next_url):
+        """Return the (data, next_url) of a response, storing its page when the endpoint is cached."""
+        if status == 304 and page is not None:
+            self._touch(page.key, headers.get('ETag') or page.etag, headers.get('Last-Modified') or page.last_modified)
+            metrics.record_cache('GET', url, 'revalidated')
+            return json.loads(page.body), page.next_url
+        if self.ttl(url) is None:
+            return json.loads(body), next_url
+        digest = hashlib.sha256(body).hexdigest()
+        if page is not None and page.digest == digest and page.next_url == next_url:
+            self._touch(page.key, headers.get('ETag'), headers.get('Last-Modified'))
+            metrics.record_cache('GET', url, 'unchanged')
+        else:
+            with self.lock:
+                self.connect().execute(
+                    "INSERT OR REPLACE INTO responses (key, url, etag, last_modified, digest, body, next_url, validated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (self.key(url, params), str(url), headers.get('ETag'), headers.get('Last-Modified'), digest, body, next_url, time.time())
+                )
+                self.conn.commit()
+            metrics.record_cache('GET', url, 'miss' if page is None else 'changed')
+        return json.loads(body), next_url
+
+    def invalidate_networks(self, network_ids):
+        """Drop the cached pages of networks whose configuration changed."""
+        if not self.enabled or not network_ids:
+            return
+        with self.lock:
+            conn = self.connect()
+            deleted = sum(
+                conn.execute("DELETE FROM responses WHERE instr(url, ?) > 0", (f"/networks/{network_id}/",)).rowcount
+                for network_id in network_ids
+            )
+            conn.commit()
+        if deleted:
+            logging.info(f"Invalidated {deleted} cached pages of {len(network_ids)} changed networks")
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    def _touch(self, key, etag, last_modified):
+        with self.lock:
+            self.connect().execute(
+                "UPDATE responses SET etag = ?, last_modified = ?, validated_at = ? WHERE key = ?",
+                (etag, last_modified, time.time(), key)
+            )
+            self.conn.commit()
+
+# Shared by every Meraki client of the run
+response_cache = ResponseCache()
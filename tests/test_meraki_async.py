@@ -0,0 +1,25 @@
+import time
+import asyncio
+import unittest
+from modules.meraki_async import TokenBucket
+
+class TokenBucketTest(unittest.TestCase):
+    def test_acquisitions_after_a_pause_are_paced_at_rate(self):
+        async def acquire_after_pause():
+            bucket = TokenBucket(rate=20)
+            bucket.pause(0.2)
+            resumed_at = bucket.paused_until
+            times = []
+            for _ in range(6):
+                await bucket.acquire()
+                times.append(time.monotonic())
+            return resumed_at, times
+
+        resumed_at, times = asyncio.run(acquire_after_pause())
+        # The bucket restarts empty: the first token is refilled 1 / rate after the pause
+        self.assertGreaterEqual(times[0] - resumed_at, 0.04)
+        for previous, current in zip(times, times[1:]):
+            self.assertGreaterEqual(current - previous, 0.04)
+
+if __name__ == '__main__':
+    unittest.main()